@@ -45,6 +45,7 @@ from gettext import gettext as _
 import lib.observable
 import lib.cache
 import lib.document
+import lib.layer
 import lib.strokemap
 from lib import brush
 from lib import helpers
@@ -340,6 +341,16 @@ class Application(object):
         cache_size = self.preferences.get(
             "ui.rendered_tile_cache_size", lib.cache.DEFAULT_CACHE_SIZE
         )
+        cache_bytes = validation.validate(
+            self.preferences.get(
+                "ui.rendered_tile_cache_bytes", lib.cache.DEFAULT_CACHE_BYTES
+            ),
+            lib.cache.DEFAULT_CACHE_BYTES,
+            int,
+            lambda a: a > 0,
+            "The rendered tile cache budget ({value}) must be a positive "
+            "number of bytes!",
+        )
         default_stack_size = lib.document.DEFAULT_UNDO_STACK_SIZE
         undo_stack_size = self.preferences.setdefault(
             "command.max_undo_stack_size", default_stack_size
@@ -351,10 +362,46 @@ class Application(object):
             lambda a: a > 0,
             "The undo stack size ({value}) must be a positive integer!",
         )
+        # Zero turns the undo history's memory budget off.
+        undo_stack_bytes = validation.validate(
+            self.preferences.get(
+                "command.max_undo_stack_bytes",
+                lib.document.DEFAULT_UNDO_STACK_BYTES,
+            ),
+            lib.document.DEFAULT_UNDO_STACK_BYTES,
+            int,
+            lambda a: a >= 0,
+            "The undo history memory budget ({value}) must be a positive "
+            "number of bytes, or zero!",
+        )
+        default_render_threads = lib.layer.DEFAULT_RENDER_THREADS
+        render_threads = self.preferences.setdefault(
+            "ui.render_threads", default_render_threads
+        )
+        render_threads = validation.validate(
+            render_threads,
+            default_render_threads,
+            int,
+            lambda a: a > 0,
+            "The number of render threads ({value}) must be a positive integer!",
+        )
+        # Zero, the default, turns tile swapping off.
+        tile_swap_bytes = validation.validate(
+            self.preferences.get("document.tile_swap_bytes", 0),
+            0,
+            int,
+            lambda a: a >= 0,
+            "The tile swap memory ceiling ({value}) must be a positive "
+            "number of bytes, or zero!",
+        )
         model = lib.document.Document(
             self.brush,
             cache_size=cache_size,
             max_undo_stack_size=undo_stack_size,
+            render_threads=render_threads,
+            cache_bytes=cache_bytes,
+            tile_swap_bytes=(tile_swap_bytes or None),
+            max_undo_stack_bytes=(undo_stack_bytes or None),
         )
         self.doc = document.Document(self, app_canvas, model)
         app_canvas.set_model(model)
@@ -367,6 +414,7 @@ class Application(object):
             self.brush,
             painting_only=True,
             cache_size=lib.cache.DEFAULT_CACHE_SIZE / 4,
+            cache_bytes=lib.cache.DEFAULT_CACHE_BYTES // 4,
         )
         scratchpad_tdw = tileddrawwidget.TiledDrawWidget()
         scratchpad_tdw.scroll_on_allocate = False
@@ -793,7 +841,8 @@ class Application(object):
         :type strokeinfo: lib.strokemap.StrokeShape
         """
         mb = brushmanager.ManagedBrush(self.brushmanager)
-        mb.brushinfo.load_from_string(strokeinfo.brush_string)
+        parsed = brush.get_parsed_brushinfo(strokeinfo.brush_string)
+        mb.brushinfo.load_from_brushinfo(parsed)
         self.brushmanager.select_brush(mb)
         self.brushmodifier.restore_context_of_selected_brush()
 
@@ -826,6 +875,40 @@ class Application(object):
     def run_garbage_collector_cb(self, action):
         helpers.run_garbage_collector()
 
+    def print_render_cache_stats_cb(self, action):
+        """Logs usage statistics for the rendered tile and brush caches."""
+        docs = [("main", self.doc), ("scratchpad", self.scratchpad_doc)]
+        for name, doc in docs:
+            root = doc.model.layer_stack
+            stats = root.get_render_cache_stats()
+            hit_rate = stats.hit_rate
+            logger.info(
+                "CACHE: %s: %d tiles, %.1f of %.1f MiB, "
+                "%d hits, %d misses (%s), %d evictions",
+                name,
+                stats.items,
+                stats.resident_bytes / 1024.0**2,
+                (stats.max_bytes or 0) / 1024.0**2,
+                stats.hits,
+                stats.misses,
+                "n/a" if hit_rate is None else "%.0f%%" % (hit_rate * 100,),
+                stats.evictions,
+            )
+            root.reset_render_cache_stats()
+        stats = brush.get_parsed_brushinfo_stats()
+        hit_rate = stats.hit_rate
+        logger.info(
+            "CACHE: parsed brushes: %d of %d, %d hits, %d misses (%s), "
+            "%d evictions",
+            stats.items,
+            brush.PARSED_BRUSHINFO_CACHE_SIZE,
+            stats.hits,
+            stats.misses,
+            "n/a" if hit_rate is None else "%.0f%%" % (hit_rate * 100,),
+            stats.evictions,
+        )
+        brush.reset_parsed_brushinfo_stats()
+
     def crash_program_cb(self, action):
         """Tests exception handling."""
         raise Exception("This is a crash caused by the user.")
@@ -2093,18 +2093,50 @@ class Document(CanvasController):  # TODO: rename to "DocumentController"
         self.tdw.renderer.set_double_buffered(not action.get_active())
 
     def vacuum_document_cb(self, action):
-        """Discards empty (all-zeros) tiles."""
+        """Discards empty (all-zeros) tiles, and merges duplicates."""
         r, t = self.model.layer_stack.remove_empty_tiles()
+        merged, freed = self.model.dedup_tiles()
+        logger.info(
+            "Vacuum: merged %d duplicate tiles, freeing %.1f MiB",
+            merged,
+            freed / 1024.0**2,
+        )
         self.app.show_transient_message(
             C_(
                 "Statusbar message: vacuum document",
-                "Vacuum: discarded {removed} of {total} tiles.",
+                "Vacuum: discarded {removed} of {total} tiles, "
+                "merged {merged} duplicates.",
             ).format(
                 removed=r,
                 total=t,
+                merged=merged,
             )
         )
 
+    def print_tile_memory_report_cb(self, action):
+        """Logs how much memory the document's tiles are using."""
+        reports = self.model.get_tile_memory_report()
+        for name in ("layers", "history", "total"):
+            r = reports[name]
+            logger.info(
+                "TILES: %s: %d stores, %d tiles (%d shared), "
+                "%.1f MiB held, %.1f MiB unique, %.1f MiB saved by sharing",
+                name,
+                r.stores,
+                r.tiles,
+                r.shared_tiles,
+                r.total_bytes / 1024.0**2,
+                r.unique_bytes / 1024.0**2,
+                r.saved_bytes / 1024.0**2,
+            )
+        for m in self.model.get_history_memory_usage():
+            logger.info(
+                "TILES: history: %s: %d tiles, %.1f MiB only held by it",
+                m.command.display_name,
+                m.tiles,
+                m.nbytes / 1024.0**2,
+            )
+
     ## Model state reflection
 
     def _input_stroke_ended_cb(self, self_again, event):
@@ -10,6 +10,7 @@
 """Flood fill tool"""
 
 # Imports
+import sys
 import weakref
 from lib.gibindings import Gtk
 from lib.gibindings import Pango
@@ -18,6 +19,7 @@ from gettext import gettext as _
 from lib.gettext import C_
 
 import cairo
+import numpy as np
 
 import gui.mode
 import gui.cursor
@@ -243,7 +245,15 @@ class FloodFillMode(gui.mode.ScrollableModeMixin, gui.mode.DragMode):
             bbox=None,
         )
 
-        tdw.doc.flood_fill(
+        preview = None
+        if opts.preview:
+            preview = tdw.doc.flood_fill_preview(
+                fill_args=fill_args,
+                view_bbox=view_bbox,
+                sample_merged=opts.sample_merged,
+                src_path=opts.src_path,
+            )
+        fill_kwargs = dict(
             fill_args=fill_args,
             view_bbox=view_bbox,
             sample_merged=opts.sample_merged,
@@ -252,6 +262,25 @@ class FloodFillMode(gui.mode.ScrollableModeMixin, gui.mode.DragMode):
             status_cb=status_callback,
         )
         opts.make_new_layer = False
+        if preview is None:
+            tdw.doc.flood_fill(**fill_kwargs)
+            return
+
+        # Show the approximate fill right away. The exact fill runs
+        # once the preview has been drawn, and replaces it when done.
+        level, alpha_tiles = preview
+        overlay = FloodFillPreviewOverlay(
+            tdw, level, alpha_tiles, color.get_rgb(), opts.opacity
+        )
+
+        def _refine_cb():
+            try:
+                tdw.doc.flood_fill(**fill_kwargs)
+            finally:
+                overlay.cleanup()
+            return False
+
+        GLib.idle_add(_refine_cb)
 
     def motion_notify_cb(self, tdw, event):
         """Track position, and update cursor"""
@@ -430,11 +459,96 @@ class FloodFillOverlay(gui.overlays.Overlay):
             cr.stroke()
 
 
+class FloodFillPreviewOverlay(gui.overlays.Overlay):
+    """Overlay showing an approximate fill while the exact one runs
+
+    The preview is a fill of one of the source's mipmaps, so it is
+    blocky when zoomed in. It is tinted with the fill color, whatever
+    the blend mode.
+    """
+
+    def __init__(self, tdw, mipmap_level, alpha_tiles, rgb, opacity):
+        """Initialize, and start showing the preview
+
+        :param tdw: The TiledDrawWidget to show the preview on
+        :param int mipmap_level: The level the preview was filled at
+        :param dict alpha_tiles: Filled fix15 alpha tiles, by tile coord
+        :param tuple rgb: Fill color
+        :param float opacity: Fill opacity
+        """
+        self._tdw = tdw
+        self._scale = 2**mipmap_level
+        self._opacity = opacity
+        self._origin = (0, 0)
+        self._surf = self._make_surface(alpha_tiles, rgb)
+        tdw.model_overlays.append(self)
+        tdw.queue_draw()
+
+    def _make_surface(self, alpha_tiles, rgb):
+        """Convert the filled alpha tiles to a premultiplied Cairo surface"""
+        tiles = {
+            coord: alpha for coord, alpha in alpha_tiles.items() if alpha.any()
+        }
+        if not tiles:
+            return None
+        n = lib.floodfill.N
+        tx0 = min(tx for tx, ty in tiles)
+        ty0 = min(ty for tx, ty in tiles)
+        tx1 = max(tx for tx, ty in tiles)
+        ty1 = max(ty for tx, ty in tiles)
+        w = (tx1 - tx0 + 1) * n
+        h = (ty1 - ty0 + 1) * n
+        surf = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+        stride = surf.get_stride()
+        pixels = np.ndarray(
+            shape=(h, w, 4),
+            dtype="uint8",
+            buffer=surf.get_data(),
+            strides=(stride, 4, 1),
+        )
+        # Cairo's ARGB32 is native-endian 32-bit words
+        if sys.byteorder == "little":
+            channels = (2, 1, 0, 3)  # B, G, R, A in memory
+        else:
+            channels = (1, 2, 3, 0)
+        r_i, g_i, b_i, a_i = channels
+        r, g, b = [int(round(c * 255)) for c in rgb]
+        for (tx, ty), alpha in tiles.items():
+            a8 = (alpha.astype("uint32") * 255 + (1 << 14)) >> 15
+            x = (tx - tx0) * n
+            y = (ty - ty0) * n
+            dst = pixels[y : y + n, x : x + n]
+            dst[..., a_i] = a8
+            dst[..., r_i] = (a8 * r + 127) // 255
+            dst[..., g_i] = (a8 * g + 127) // 255
+            dst[..., b_i] = (a8 * b + 127) // 255
+        surf.mark_dirty()
+        self._origin = (tx0 * n * self._scale, ty0 * n * self._scale)
+        return surf
+
+    def cleanup(self):
+        """Stop showing the preview"""
+        if self in self._tdw.model_overlays:
+            self._tdw.model_overlays.remove(self)
+            self._tdw.queue_draw()
+        self._surf = None
+
+    def paint(self, cr):
+        """Paint the preview, in model coordinates"""
+        if self._surf is None:
+            return
+        cr.translate(*self._origin)
+        cr.scale(self._scale, self._scale)
+        cr.set_source_surface(self._surf, 0, 0)
+        cr.paint_with_alpha(self._opacity)
+
+
 class FloodFillOptionsWidget(Gtk.Grid):
     """Configuration widget for the flood fill tool"""
 
     TOLERANCE_PREF = "flood_fill.tolerance"
     LIM_TO_VIEW_PREF = "flood_fill.limit_to_view"
+    PREVIEW_PREF = "flood_fill.preview"
     SAMPLE_MERGED_PREF = "flood_fill.sample_merged"
     OFFSET_PREF = "flood_fill.offset"
     FEATHER_PREF = "flood_fill.feather"
@@ -449,6 +563,7 @@ class FloodFillOptionsWidget(Gtk.Grid):
 
     DEFAULT_TOLERANCE = 0.05
     DEFAULT_LIM_TO_VIEW = False
+    DEFAULT_PREVIEW = True
     DEFAULT_SAMPLE_MERGED = False
     DEFAULT_MAKE_NEW_LAYER = False
     DEFAULT_BLEND_MODE = 0
@@ -649,6 +764,25 @@ class FloodFillOptionsWidget(Gtk.Grid):
         checkbut.connect("toggled", self._limit_to_view_toggled_cb)
         self._limit_to_view_toggle = checkbut
 
+        row += 1
+        text = C_(
+            "fill options: toggle whether large fills are previewed",
+            "Preview Large Fills",
+        )
+        checkbut = Gtk.CheckButton.new_with_label(text)
+        checkbut.set_tooltip_text(
+            C_(
+                "fill options: Preview Large Fills (tooltip)",
+                "Show a quick, low-resolution version of large fills\n"
+                "while the exact fill is being calculated.",
+            )
+        )
+        self.attach(checkbut, 1, row, 1, 1)
+        active = bool(prefs.get(self.PREVIEW_PREF, self.DEFAULT_PREVIEW))
+        checkbut.set_active(active)
+        checkbut.connect("toggled", self._preview_toggled_cb)
+        self._preview_toggle = checkbut
+
         row += 1
         label = Gtk.Label()
         label.set_markup(
@@ -961,6 +1095,10 @@ class FloodFillOptionsWidget(Gtk.Grid):
     def limit_to_view(self):
         return bool(self._limit_to_view_toggle.get_active())
 
+    @property
+    def preview(self):
+        return bool(self._preview_toggle.get_active())
+
     @property
     def src_path(self):
         row = self._src_combo.get_active_iter()
@@ -1004,6 +1142,9 @@ class FloodFillOptionsWidget(Gtk.Grid):
     def _limit_to_view_toggled_cb(self, checkbut):
         self.app.preferences[self.LIM_TO_VIEW_PREF] = self.limit_to_view
 
+    def _preview_toggled_cb(self, checkbut):
+        self.app.preferences[self.PREVIEW_PREF] = self.preview
+
     def _sample_merged_toggled_cb(self, checkbut):
         self._src_combo.set_sensitive(not self.sample_merged)
         self.app.preferences[self.SAMPLE_MERGED_PREF] = self.sample_merged
@@ -1069,6 +1210,7 @@ class FloodFillOptionsWidget(Gtk.Grid):
         self._make_new_layer_toggle.set_active(self.DEFAULT_MAKE_NEW_LAYER)
         self._src_combo.set_active(0)
         self._limit_to_view_toggle.set_active(self.DEFAULT_LIM_TO_VIEW)
+        self._preview_toggle.set_active(self.DEFAULT_PREVIEW)
         self._sample_merged_toggle.set_active(self.DEFAULT_SAMPLE_MERGED)
         self._opacity_adj.set_value(self.DEFAULT_OPACITY)
         self._offset_adj.set_value(self.DEFAULT_OFFSET)
@@ -0,0 +1,188 @@
+# This file is part of MyPaint.
+# Copyright (C) 2024 by the MyPaint Development Team
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Background rendering of display tiles
+
+The canvas renderer composites the tiles it needs immediately on the
+main thread, but can hand slower refinement work to a `RenderWorker`.
+This renders tiles from a `lib.layer.tree.RenderSnapshot` in a thread
+pool, and posts the finished 8bpc tiles back to the GTK main loop.
+
+"""
+
+## Imports
+
+import contextlib
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from lib.gibindings import GLib
+import lib.tiledsurface as tiledsurface
+import lib.surface
+from lib.surface import TileAccessible
+
+logger = logging.getLogger(__name__)
+
+
+## Module constants
+
+#: Default number of background display rendering threads.
+DEFAULT_THREADS = 2
+
+
+## Class defs
+
+
+class TileBuffer(TileAccessible):
+    """Private 8bpc RGBA tiles, allocated as they're requested.
+
+    >>> buf = TileBuffer()
+    >>> with buf.tile_request(1, 2, readonly=False) as t:
+    ...     t[...] = 255
+    >>> sorted(buf.tiles.keys())
+    [(1, 2)]
+    >>> int(buf.tiles[(1, 2)].min())
+    255
+
+    """
+
+    def __init__(self):
+        super(TileBuffer, self).__init__()
+        self.tiles = {}
+
+    def get_bbox(self):
+        return lib.surface.get_tiles_bbox(self.tiles)
+
+    @contextlib.contextmanager
+    def tile_request(self, tx, ty, readonly):
+        tile = self.tiles.get((tx, ty))
+        if tile is None:
+            N = tiledsurface.N
+            tile = np.zeros((N, N, 4), dtype="uint8")
+            if not readonly:
+                self.tiles[(tx, ty)] = tile
+        yield tile
+
+
+class RenderWorker(object):
+    """Renders display tiles in a pool of background threads.
+
+    Requests are queued to the pool, and each renders its tiles into a
+    private `TileBuffer`. The results are handed to a callback on the
+    main thread via `GLib.idle_add()`, so only that callback needs to
+    touch any GTK or display state.
+
+    The worker threads never drop the last reference to a request's
+    snapshot: finished requests are passed back to the main thread
+    whole, and released there, because freeing the snapshot's surface
+    clones changes the share counts of live tiles.
+
+    """
+
+    def __init__(self, threads=DEFAULT_THREADS):
+        """Initialize, with no threads running yet.
+
+        :param int threads: Maximum number of worker threads.
+
+        """
+        super(RenderWorker, self).__init__()
+        self._threads = threads
+        self._pool = None
+        self._finished = deque()  # [job, ...], for the main thread
+
+    def submit(
+        self,
+        root,
+        snapshot,
+        tiles,
+        mipmap_level,
+        done_cb,
+        opaque_base_tile=None,
+        filter=None,
+    ):
+        """Queues tiles for rendering.
+
+        :param lib.layer.tree.RootLayerStack root: Stack to render.
+        :param lib.layer.tree.RenderSnapshot snapshot: What to render.
+        :param list tiles: The tile indices to render.
+        :param int mipmap_level: Mipmap level of the tile indices.
+        :param callable done_cb: Called as done_cb(tiles, results).
+        :param numpy.ndarray opaque_base_tile: As for render().
+        :param callable filter: Display filter, as for render().
+
+        The callback is invoked on the main thread, with the list of
+        tiles that were requested and a dict of finished 8bpc tiles.
+        If rendering failed, the dict lacks some or all of the tiles.
+
+        """
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(
+                max_workers=self._threads,
+                thread_name_prefix="display-render",
+            )
+        # The job is only ever referenced as a whole by the worker,
+        # so emptying it on the main thread releases the snapshot.
+        job = [
+            root,
+            snapshot,
+            list(tiles),
+            mipmap_level,
+            done_cb,
+            opaque_base_tile,
+            filter,
+            None,  # results
+        ]
+        self._pool.submit(self._render, job)
+
+    def _render(self, job):
+        """Worker thread: render a request, then post the results."""
+        buf = TileBuffer()
+        try:
+            job[0].render_snapshot(
+                job[1],
+                buf,
+                job[2],
+                job[3],
+                opaque_base_tile=job[5],
+                filter=job[6],
+            )
+        except Exception:
+            logger.exception("Background rendering of %d tiles failed", len(job[2]))
+            buf.tiles.clear()
+        job[7] = buf.tiles
+        self._finished.append(job)
+        GLib.idle_add(self._deliver_cb)
+
+    def _deliver_cb(self):
+        """Main thread: release finished jobs, and report their results."""
+        while True:
+            try:
+                job = self._finished.popleft()
+            except IndexError:
+                return False
+            done_cb, tiles, results = job[4], job[2], job[7]
+            del job[:]
+            done_cb(tiles, results)
+
+    def shutdown(self):
+        """Stops the worker threads once their current requests finish.
+
+        Queued requests which haven't started yet are abandoned.
+
+        """
+        pool = self._pool
+        self._pool = None
+        if pool is None:
+            return
+        try:
+            pool.shutdown(wait=False, cancel_futures=True)
+        except TypeError:  # Python < 3.9
+            pool.shutdown(wait=False)
@@ -11,10 +11,12 @@
 ## Imports
 
 import random
+import time
 from math import floor, ceil, log
 import math
 import weakref
 import contextlib
+import functools
 import logging
 
 from lib.gibindings import Gtk
@@ -26,9 +28,12 @@ import numpy as np
 from lib import helpers, tiledsurface, pixbufsurface
 from lib.observable import event
 import lib.layer
+import lib.cache
+import lib.eotf
 from . import cursor
 from .drawutils import render_checks
 from .windowing import clear_focus
+from .renderworker import RenderWorker
 import gui.style
 import lib.color
 import lib.alg
@@ -36,6 +41,28 @@ from lib.pycompat import xrange
 
 logger = logging.getLogger(__name__)
 
+## Module constants
+
+#: Spare tiles kept around the visible area in each display tile atlas.
+#: Pans shorter than this don't need the atlas to be reallocated.
+DISPLAY_ATLAS_MARGIN_TILES = 4
+
+#: How many display tile atlases to keep, one per rendering state.
+#: Two lets panning with lower-quality mipmaps flip back and forth
+#: without discarding the high-quality tiles.
+DISPLAY_ATLAS_COUNT = 2
+
+#: Default time budget for rendering new tiles during one draw, in
+#: seconds. Tiles which don't fit get a coarse placeholder, and are
+#: refined when idle.
+PROGRESSIVE_RENDER_BUDGET = 1.0 / 80
+
+#: Tiles rendered between checks of the progressive render budget.
+PROGRESSIVE_RENDER_CHUNK_TILES = 16
+
+#: How many mipmap levels coarser the placeholder tiles are.
+PROGRESSIVE_COARSE_LEVELS = 2
+
 ## Class definitions
 
 
@@ -663,6 +690,224 @@ def calculate_transformation_matrix(
     return matrix
 
 
+class DisplayTileAtlas(object):
+    """Persistent backing store of rendered tiles for the canvas.
+
+    The atlas holds final 8bpc RGBA tiles for one mipmap level and one
+    rendering state (display filter, alpha check mode, and so on) in a
+    tile-aligned `lib.pixbufsurface.Surface`. It covers the visible area
+    plus a margin, and remembers which of its tiles hold valid content.
+    Tiles stay valid across redraws until the model reports a change in
+    their area, so a redraw only needs to render tiles which are newly
+    exposed or dirty.
+
+    Tiles can also hold an upscaled placeholder rendered from a coarser
+    mipmap level. These count as dirty, but are shown until refined.
+    Refinements requested from a background renderer are tracked with
+    tickets, so that results for tiles which were invalidated while
+    the request was in flight can be discarded.
+
+    """
+
+    def __init__(self, mipmap_level):
+        """Initialize, empty.
+
+        :param int mipmap_level: Level of the tiles held.
+
+        """
+        super(DisplayTileAtlas, self).__init__()
+        self.mipmap_level = mipmap_level
+        self.surface = None
+        self._valid = set()
+        self._placeholders = set()
+        self._requests = {}  # {(tx, ty): ticket}
+        self._next_ticket = 0
+
+    def invalidate(self, x, y, w, h):
+        """Marks the tiles overlapping an area of the model as dirty.
+
+        :param int x: Model X coordinate of the area.
+        :param int y: Model Y coordinate of the area.
+        :param int w: Width of the area, or 0 for everything.
+        :param int h: Height of the area, or 0 for everything.
+
+        """
+        if not (self._valid or self._placeholders or self._requests):
+            return
+        if w == 0 and h == 0:
+            self._valid.clear()
+            self._placeholders.clear()
+            self._requests.clear()
+            return
+        n = tiledsurface.N * (1 << self.mipmap_level)
+        tx1 = int(floor(x / n))
+        ty1 = int(floor(y / n))
+        tx2 = int(floor((x + w - 1) / n))
+        ty2 = int(floor((y + h - 1) / n))
+        self._valid = set(
+            (tx, ty)
+            for (tx, ty) in self._valid
+            if not (tx1 <= tx <= tx2 and ty1 <= ty <= ty2)
+        )
+        self._placeholders = set(
+            (tx, ty)
+            for (tx, ty) in self._placeholders
+            if not (tx1 <= tx <= tx2 and ty1 <= ty <= ty2)
+        )
+        self._requests = dict(
+            ((tx, ty), ticket)
+            for ((tx, ty), ticket) in self._requests.items()
+            if not (tx1 <= tx <= tx2 and ty1 <= ty <= ty2)
+        )
+
+    def prepare(self, view_bbox):
+        """Ensures the atlas covers a view, and returns its surface.
+
+        :param tuple view_bbox: Visible (x1, y1, x2, y2) at this level.
+        :rtype: lib.pixbufsurface.Surface
+
+        If the atlas doesn't cover the view, it's reallocated around it
+        with a margin, and the content of any overlapping tiles is
+        carried over.
+
+        """
+        N = tiledsurface.N
+        x1, y1, x2, y2 = view_bbox
+        tx1, ty1 = x1 // N, y1 // N
+        tx2, ty2 = x2 // N, y2 // N
+        old = self.surface
+        if old is not None:
+            otx2 = old.tx + old.ew // N - 1
+            oty2 = old.ty + old.eh // N - 1
+            if old.tx <= tx1 and old.ty <= ty1 and tx2 <= otx2 and ty2 <= oty2:
+                return old
+        m = DISPLAY_ATLAS_MARGIN_TILES
+        tx1 -= m
+        ty1 -= m
+        tx2 += m
+        ty2 += m
+        new = pixbufsurface.Surface(
+            tx1 * N,
+            ty1 * N,
+            (tx2 - tx1 + 1) * N,
+            (ty2 - ty1 + 1) * N,
+        )
+        valid = set()
+        placeholders = set()
+        if old is not None:
+            new_tiles = new.get_tiles()
+            valid.update(t for t in self._valid if t in new_tiles)
+            placeholders.update(t for t in self._placeholders if t in new_tiles)
+            self._requests = dict(
+                (t, ticket)
+                for (t, ticket) in self._requests.items()
+                if t in new_tiles
+            )
+        if valid or placeholders:
+            # One bulk copy of the overlap, rather than one per tile.
+            ox1, oy1 = max(old.ex, new.ex), max(old.ey, new.ey)
+            ox2 = min(old.ex + old.ew, new.ex + new.ew)
+            oy2 = min(old.ey + old.eh, new.ey + new.eh)
+            src = helpers.gdkpixbuf2numpy(old.epixbuf)
+            dst = helpers.gdkpixbuf2numpy(new.epixbuf)
+            dst[oy1 - new.ey : oy2 - new.ey, ox1 - new.ex : ox2 - new.ex] = src[
+                oy1 - old.ey : oy2 - old.ey, ox1 - old.ex : ox2 - old.ex
+            ]
+        self.surface = new
+        self._valid = valid
+        self._placeholders = placeholders
+        return new
+
+    def get_dirty_tiles(self, bbox):
+        """Lists the tiles in an area which need rendering.
+
+        :param tuple bbox: Area (x, y, w, h) at this level.
+        :rtype: list
+
+        """
+        N = tiledsurface.N
+        x, y, w, h = bbox
+        valid = self._valid
+        return [
+            (tx, ty)
+            for ty in xrange(y // N, (y + h - 1) // N + 1)
+            for tx in xrange(x // N, (x + w - 1) // N + 1)
+            if (tx, ty) not in valid
+        ]
+
+    def mark_valid(self, tiles):
+        """Records that some tiles now hold up to date content."""
+        self._valid.update(tiles)
+        self._placeholders.difference_update(tiles)
+
+    def mark_placeholders(self, tiles):
+        """Records that some dirty tiles now hold a coarse placeholder."""
+        self._placeholders.update(tiles)
+
+    def get_placeholder_tiles(self):
+        """Lists the tiles showing placeholders, which need refining."""
+        return list(self._placeholders)
+
+    def filter_placeholders(self, tiles):
+        """Lists those of some dirty tiles which have no placeholder."""
+        placeholders = self._placeholders
+        return [t for t in tiles if t not in placeholders]
+
+    def filter_unrequested(self, tiles):
+        """Lists those of some tiles which aren't already requested."""
+        requests = self._requests
+        return [t for t in tiles if t not in requests]
+
+    def request_tiles(self, tiles):
+        """Records a request for background rendering of some tiles.
+
+        :returns: A ticket for `accept()`.
+        :rtype: int
+
+        """
+        ticket = self._next_ticket
+        self._next_ticket += 1
+        for t in tiles:
+            self._requests[t] = ticket
+        return ticket
+
+    def accept(self, ticket, tiles):
+        """Closes a request, returning the tiles that are still wanted.
+
+        :param int ticket: From `request_tiles()`.
+        :param list tiles: The tiles that were requested.
+        :rtype: list
+
+        Tiles invalidated, requested again, or moved outside the atlas
+        since the request was made are not returned.
+
+        """
+        requests = self._requests
+        surf_tiles = self.surface.get_tiles()
+        wanted = []
+        for t in tiles:
+            if requests.get(t) != ticket:
+                continue
+            del requests[t]
+            if t in surf_tiles:
+                wanted.append(t)
+        return wanted
+
+    def get_pixbuf(self, bbox):
+        """Gets a pixbuf sharing the atlas's memory for an area.
+
+        :param tuple bbox: Area (x, y, w, h) at this level.
+        :rtype: GdkPixbuf.Pixbuf
+
+        Painting only what's needed keeps the per-draw conversion done
+        by `Gdk.cairo_set_source_pixbuf()` proportional to the area.
+
+        """
+        surf = self.surface
+        x, y, w, h = bbox
+        return surf.epixbuf.new_subpixbuf(x - surf.ex, y - surf.ey, w, h)
+
+
 class CanvasRenderer(Gtk.DrawingArea, DrawCursorMixin):
     """Render the document model to screen.
 
@@ -735,7 +980,27 @@ class CanvasRenderer(Gtk.DrawingArea, DrawCursorMixin):
         self._hq_rendering = True
         self._restore_hq_rendering_timeout_id = None
 
+        # Rendered tiles kept across redraws, keyed by rendering state
+        self._display_atlases = lib.cache.LRUCache(
+            capacity=DISPLAY_ATLAS_COUNT,
+        )
+
+        # Progressive rendering: time budget per draw (None to turn it
+        # off), and the idle refinement of placeholder tiles.
+        self.render_time_budget = PROGRESSIVE_RENDER_BUDGET
+        self._refine_job = None
+        self._refine_src_id = None
+
+        # The layer stack snapshot background refinement renders from.
+        # It's reused until the model next changes.
+        self._render_snapshot = None
+
+        # Placeholders are refined by background threads if there's a
+        # worker, or in idle callbacks on the main thread if not.
+        self.render_worker = RenderWorker()
+
         self.connect("configure-event", self._configure_event_cb)
+        self.connect("unrealize", self._unrealize_cb)
 
     def _init_alpha_checks(self):
         """Initialize the alpha check backgrounds"""
@@ -853,6 +1118,10 @@ class CanvasRenderer(Gtk.DrawingArea, DrawCursorMixin):
     def canvas_modified_cb(self, model, x, y, w, h):
         """Handles area redraw notifications from the underlying model"""
 
+        self._render_snapshot = None
+        for atlas in self._display_atlases.values():
+            atlas.invalidate(x, y, w, h)
+
         if self._insensitive_state_content:
             return False
 
@@ -865,6 +1134,10 @@ class CanvasRenderer(Gtk.DrawingArea, DrawCursorMixin):
             self.queue_draw()
             return
 
+        self._queue_draw_model_area(x, y, w, h)
+
+    def _queue_draw_model_area(self, x, y, w, h):
+        """Queues a redraw of an area of the model."""
         # Create an expose event with the event bbox rotated/zoomed.
         corners = [(x, y), (x + w, y), (x, y + h), (x + w, y + h)]
         corners = [self.model_to_display(x, y) for (x, y) in corners]
@@ -971,6 +1244,13 @@ class CanvasRenderer(Gtk.DrawingArea, DrawCursorMixin):
         self._invalidate_cached_transform_matrix()
         self.queue_draw()
 
+    def _unrealize_cb(self, widget):
+        # Abandon queued background work, and what it was for.
+        if self.render_worker is not None:
+            self.render_worker.shutdown()
+        self._display_atlases.clear()
+        self._render_snapshot = None
+
     def is_translation_only(self):
         return self.rotation == 0.0 and self.scale == 1.0 and not self.mirrored
 
@@ -1056,12 +1336,11 @@ class CanvasRenderer(Gtk.DrawingArea, DrawCursorMixin):
             return surf
 
         # Render just what we need.
-        transformation, surface, sparse, mipmap_level, clip_rect = self._render_prepare(
-            cr
-        )
         display_filter = None
         if use_filter:
             display_filter = self.display_filter
+        prep = self._render_prepare(cr)
+        transformation, surface, sparse, mipmap_level, clip_rect, bbox = prep
         self._render_execute(
             cr,
             transformation,
@@ -1069,6 +1348,7 @@ class CanvasRenderer(Gtk.DrawingArea, DrawCursorMixin):
             sparse,
             mipmap_level,
             clip_rect,
+            bbox,
             filter=display_filter,
         )
         surf.flush()
@@ -1108,14 +1388,19 @@ class CanvasRenderer(Gtk.DrawingArea, DrawCursorMixin):
             cr.paint()
 
         # Prep a pixbuf-surface aligned to the model to render into.
-        # This also applies the transformation.
-        transformation, surface, sparse, mipmap_level, clip_rect = self._render_prepare(
-            cr
+        # This also applies the transformation. Normally it's the
+        # persistent atlas, but visualization needs fresh pixels, and
+        # overlays or special viewing modes can't be kept around.
+        use_atlas = (
+            (not self.visualize_rendering)
+            and self.overlay_layer is None
+            and model.layer_stack.get_render_is_cacheable()
         )
+        prep = self._render_prepare(cr, use_atlas=use_atlas)
+        transformation, surface, sparse, mipmap_level, clip_rect, model_bbox = prep
 
         # not sure if it is a good idea to clip so tightly
         # has no effect right now because device_bbox is always smaller
-        model_bbox = surface.x, surface.y, surface.w, surface.h
         cr.rectangle(*model_bbox)
         cr.clip()
 
@@ -1132,6 +1417,7 @@ class CanvasRenderer(Gtk.DrawingArea, DrawCursorMixin):
             sparse,
             mipmap_level,
             clip_rect,
+            model_bbox,
             filter=self.display_filter,
         )
 
@@ -1265,7 +1551,7 @@ class CanvasRenderer(Gtk.DrawingArea, DrawCursorMixin):
         tile_rect = helpers.Rect(*bbox)
         return clip_rect.overlaps(tile_rect)
 
-    def _render_prepare(self, cr):
+    def _render_prepare(self, cr, use_atlas=False):
         """Prepares a blank pixbuf & other details for later rendering.
 
         Called when handling "draw" events. The size and shape of the
@@ -1274,6 +1560,12 @@ class CanvasRenderer(Gtk.DrawingArea, DrawCursorMixin):
         region that expresses what we've been asked to redraw, and by
         the TDW's own view transformation of the document.
 
+        If use_atlas is true, the returned surface is instead the
+        persistent `DisplayTileAtlas` surface for the current rendering
+        state, which may already hold valid tiles. The area to redraw
+        is returned separately as an (x, y, w, h) model_bbox at the
+        chosen mipmap level.
+
         """
         # Determine what to draw, and the nature of the reveal.
         allocation = self.get_allocation()
@@ -1318,14 +1610,58 @@ class CanvasRenderer(Gtk.DrawingArea, DrawCursorMixin):
             y2 += 1
         x1, y1 = int(floor(x1)), int(floor(y1))
         x2, y2 = int(ceil(x2)), int(ceil(y2))
+        model_bbox = (x1, y1, x2 - x1 + 1, y2 - y1 + 1)
+
+        if use_atlas:
+            # Size the atlas for the whole view, not just this redraw.
+            inverse = cairo.Matrix(*list(transformation))
+            inverse.invert()
+            corners = [
+                inverse.transform_point(x_, y_)
+                for (x_, y_) in [(x, y), (x + w, y), (x, y + h), (x + w, y + h)]
+            ]
+            xs = [int(floor(c[0])) - 1 for c in corners] + [x1]
+            ys = [int(floor(c[1])) - 1 for c in corners] + [y1]
+            xs += [int(ceil(c[0])) + 1 for c in corners] + [x2]
+            ys += [int(ceil(c[1])) + 1 for c in corners] + [y2]
+            view_bbox = (min(xs), min(ys), max(xs), max(ys))
+            atlas = self._get_display_atlas(mipmap_level)
+            surface = atlas.prepare(view_bbox)
+            return transformation, surface, sparse, mipmap_level, clip_rect, model_bbox
 
         # We always render with alpha to get hardware acceleration,
         # even when we could avoid using the alpha channel. Speedup
         # factor 3 for ATI/Radeon Xorg driver (and hopefully others).
         # https://bugs.freedesktop.org/show_bug.cgi?id=28670
 
-        surface = pixbufsurface.Surface(x1, y1, x2 - x1 + 1, y2 - y1 + 1)
-        return transformation, surface, sparse, mipmap_level, clip_rect
+        surface = pixbufsurface.Surface(*model_bbox)
+        return transformation, surface, sparse, mipmap_level, clip_rect, model_bbox
+
+    def _get_display_atlas(self, mipmap_level):
+        """Gets the tile atlas for the current rendering state.
+
+        :param int mipmap_level: The mipmap level being rendered.
+        :rtype: DisplayTileAtlas
+
+        Atlases are keyed by everything which affects the final
+        pixels of a tile apart from the model's content, which is
+        handled by invalidation. Atlases for the least recently used
+        states are discarded.
+
+        """
+        render_is_opaque = self.doc.layer_stack.get_render_is_opaque()
+        key = (
+            mipmap_level,
+            self.display_filter,
+            self._draw_real_alpha_checks,
+            render_is_opaque,
+            lib.eotf.eotf(),
+        )
+        atlas = self._display_atlases.get(key)
+        if atlas is None:
+            atlas = DisplayTileAtlas(mipmap_level)
+            self._display_atlases[key] = atlas
+        return atlas
 
     def _render_execute(
         self,
@@ -1335,11 +1671,19 @@ class CanvasRenderer(Gtk.DrawingArea, DrawCursorMixin):
         sparse,
         mipmap_level,
         clip_rect,
+        model_bbox,
         filter=None,
     ):
         """Renders tiles into a prepared pixbufsurface, then blits it."""
         translation_only = self.is_translation_only()
 
+        # Is this the surface of a persistent atlas?
+        atlas = None
+        for candidate in self._display_atlases.values():
+            if candidate.surface is surface:
+                atlas = candidate
+                break
+
         if self.visualize_rendering:
             surface.pixbuf.fill(int(random.random() * 0xFF) << 16)
 
@@ -1348,7 +1692,10 @@ class CanvasRenderer(Gtk.DrawingArea, DrawCursorMixin):
             fake_alpha_check_tile = self._fake_alpha_check_tile
 
         # Determine which tiles to render.
-        tiles = list(surface.get_tiles())
+        if atlas is not None:
+            tiles = atlas.get_dirty_tiles(model_bbox)
+        else:
+            tiles = list(surface.get_tiles())
         if sparse:
             tiles = [
                 (tx, ty)
@@ -1364,26 +1711,279 @@ class CanvasRenderer(Gtk.DrawingArea, DrawCursorMixin):
 
         # Composite each stack of tiles in the exposed area
         # into the pixbufsurface.
-        self.doc._layers.render(
-            surface,
-            tiles,
-            mipmap_level,
-            overlay=self.overlay_layer,
-            opaque_base_tile=fake_alpha_check_tile,
-            filter=filter,
-        )
+        if atlas is not None:
+            self._render_atlas_progressive(
+                atlas,
+                tiles,
+                mipmap_level,
+                fake_alpha_check_tile,
+                filter,
+            )
+        else:
+            self.doc._layers.render(
+                surface,
+                tiles,
+                mipmap_level,
+                overlay=self.overlay_layer,
+                opaque_base_tile=fake_alpha_check_tile,
+                filter=filter,
+            )
 
         # Set the surface's underlying pixbuf as the source, then paint
         # it with Cairo. We don't care if it's pixelized at high zoom-in
         # levels: in fact, it'll look sharper and better.
-        Gdk.cairo_set_source_pixbuf(
-            cr, surface.pixbuf, round(surface.x), round(surface.y)
-        )
+        pixbuf = surface.pixbuf
+        if atlas is not None:
+            pixbuf = atlas.get_pixbuf(model_bbox)
+        x, y = model_bbox[0:2]
+        Gdk.cairo_set_source_pixbuf(cr, pixbuf, round(x), round(y))
         if self.scale > self.pixelize_threshold:
             pattern = cr.get_source()
             pattern.set_filter(cairo.FILTER_NEAREST)
         cr.paint()
 
+    ## Progressive rendering
+
+    def _render_atlas_progressive(
+        self, atlas, tiles, mipmap_level, opaque_base_tile, filter
+    ):
+        """Renders dirty atlas tiles for a draw, within the time budget.
+
+        Tiles are rendered nearest-first to the last painting position.
+        Any which don't fit in `render_time_budget` are given a coarse
+        placeholder, and are refined later in an idle callback.
+
+        """
+        budget = self.render_time_budget
+        render_args = (mipmap_level, opaque_base_tile, filter)
+        if not budget:
+            self._render_atlas_tiles(atlas, tiles, None, *render_args)
+            return
+        deadline = time.time() + budget
+        tiles = self._prioritize_tiles(tiles, mipmap_level)
+        n = self._render_atlas_tiles(atlas, tiles, deadline, *render_args)
+        remaining = atlas.filter_placeholders(tiles[n:])
+        if remaining:
+            coarse = self._render_placeholders(atlas, remaining, *render_args)
+            if not coarse:
+                self._render_atlas_tiles(atlas, remaining, None, *render_args)
+        if not atlas.get_placeholder_tiles():
+            return
+        if self.render_worker is not None:
+            self._submit_refinement(atlas, *render_args)
+            return
+        self._refine_job = (atlas,) + render_args
+        if self._refine_src_id is None:
+            self._refine_src_id = GLib.idle_add(self._refine_idle_cb)
+
+    def _render_atlas_tiles(
+        self, atlas, tiles, deadline, mipmap_level, opaque_base_tile, filter
+    ):
+        """Renders tiles into an atlas in chunks, until a deadline.
+
+        :param float deadline: time.time() to stop at, or None.
+        :returns: The number of leading tiles rendered.
+        :rtype: int
+
+        """
+        if deadline is None:
+            chunk = max(1, len(tiles))
+        else:
+            chunk = PROGRESSIVE_RENDER_CHUNK_TILES
+        n = 0
+        while n < len(tiles):
+            batch = tiles[n : n + chunk]
+            self.doc._layers.render(
+                atlas.surface,
+                batch,
+                mipmap_level,
+                opaque_base_tile=opaque_base_tile,
+                filter=filter,
+            )
+            atlas.mark_valid(batch)
+            n += len(batch)
+            if deadline is not None and time.time() > deadline:
+                break
+        return n
+
+    def _render_placeholders(
+        self, atlas, tiles, mipmap_level, opaque_base_tile, filter
+    ):
+        """Fills atlas tiles with upscaled ones from a coarser mipmap.
+
+        :returns: False if there's no coarser level to use.
+        :rtype: bool
+
+        Each coarse tile covers a square block of atlas tiles, so this
+        renders a small fraction of the tiles needed at full detail.
+
+        """
+        N = tiledsurface.N
+        k = min(
+            PROGRESSIVE_COARSE_LEVELS,
+            tiledsurface.MAX_MIPMAP_LEVEL - mipmap_level,
+        )
+        if k <= 0:
+            return False
+        f = 1 << k
+        n = N // f
+        coarse_tiles = sorted(set((tx >> k, ty >> k) for (tx, ty) in tiles))
+        ctx1 = min(c[0] for c in coarse_tiles)
+        cty1 = min(c[1] for c in coarse_tiles)
+        ctx2 = max(c[0] for c in coarse_tiles)
+        cty2 = max(c[1] for c in coarse_tiles)
+        scratch = pixbufsurface.Surface(
+            ctx1 * N,
+            cty1 * N,
+            (ctx2 - ctx1 + 1) * N,
+            (cty2 - cty1 + 1) * N,
+        )
+        self.doc._layers.render(
+            scratch,
+            coarse_tiles,
+            mipmap_level + k,
+            opaque_base_tile=opaque_base_tile,
+            filter=filter,
+        )
+        src_tiles = scratch.get_tiles()
+        dst_tiles = atlas.surface.get_tiles()
+        for tx, ty in tiles:
+            src = src_tiles[(tx >> k, ty >> k)]
+            sx = (tx & (f - 1)) * n
+            sy = (ty & (f - 1)) * n
+            block = src[sy : sy + n, sx : sx + n]
+            dst_tiles[(tx, ty)][...] = block.repeat(f, axis=0).repeat(f, axis=1)
+        atlas.mark_placeholders(tiles)
+        return True
+
+    def _prioritize_tiles(self, tiles, mipmap_level):
+        """Sorts tiles nearest-first to the last painting position.
+
+        The centre of the view is used if nothing's been painted yet.
+
+        """
+        pos = self._tdw.last_painting_pos
+        if pos is None:
+            alloc = self.get_allocation()
+            pos = self.display_to_model(alloc.width / 2.0, alloc.height / 2.0)
+        n = tiledsurface.N * (1 << mipmap_level)
+        px = pos[0] / n - 0.5
+        py = pos[1] / n - 0.5
+        return sorted(tiles, key=lambda t: (t[0] - px) ** 2 + (t[1] - py) ** 2)
+
+    def _refine_idle_cb(self):
+        """Idle callback: replaces placeholder tiles with detailed ones."""
+        job = self._refine_job
+        atlas = job and job[0]
+        still_valid = (
+            atlas is not None
+            and self.get_window() is not None
+            and atlas in self._display_atlases.values()
+            and job[3] is self.display_filter
+            and self.overlay_layer is None
+            and self.doc.layer_stack.get_render_is_cacheable()
+        )
+        tiles = still_valid and atlas.get_placeholder_tiles()
+        if not tiles:
+            # A later draw reschedules this if it's still needed.
+            self._refine_job = None
+            self._refine_src_id = None
+            return False
+        mipmap_level = job[1]
+        tiles = self._prioritize_tiles(tiles, mipmap_level)
+        deadline = time.time() + (self.render_time_budget or 0)
+        n = self._render_atlas_tiles(atlas, tiles, deadline, *job[1:])
+        self._queue_draw_atlas_tiles(tiles[:n], mipmap_level)
+        return True
+
+    def _queue_draw_atlas_tiles(self, tiles, mipmap_level):
+        """Queues a redraw of refined atlas tiles.
+
+        The tiles are valid now, so the redraw just paints them.
+
+        """
+        if not tiles:
+            return
+        size = tiledsurface.N * (1 << mipmap_level)
+        txs = [t[0] for t in tiles]
+        tys = [t[1] for t in tiles]
+        x = min(txs) * size
+        y = min(tys) * size
+        w = (max(txs) + 1) * size - x
+        h = (max(tys) + 1) * size - y
+        self._queue_draw_model_area(x, y, w, h)
+
+    def _submit_refinement(self, atlas, mipmap_level, opaque_base_tile, filter):
+        """Queues placeholder tiles for background rendering.
+
+        Tiles are sent nearest-first in small batches, so the ones
+        near the pointer come back soonest. The main thread's part is
+        just taking a snapshot of the layer stack, which shares its
+        tiles copy-on-write. All the batches share the one snapshot,
+        and so do later passes, until the model changes again.
+
+        """
+        tiles = atlas.filter_unrequested(atlas.get_placeholder_tiles())
+        if not tiles:
+            return
+        tiles = self._prioritize_tiles(tiles, mipmap_level)
+        root = self.doc.layer_stack
+        snapshot = self._get_render_snapshot(root, mipmap_level)
+        chunk = PROGRESSIVE_RENDER_CHUNK_TILES
+        for i in xrange(0, len(tiles), chunk):
+            batch = tiles[i : i + chunk]
+            ticket = atlas.request_tiles(batch)
+            done_cb = functools.partial(
+                self._refinement_done_cb,
+                atlas,
+                ticket,
+                mipmap_level,
+            )
+            self.render_worker.submit(
+                root,
+                snapshot,
+                batch,
+                mipmap_level,
+                done_cb,
+                opaque_base_tile=opaque_base_tile,
+                filter=filter,
+            )
+
+    def _get_render_snapshot(self, root, mipmap_level):
+        """Gets a snapshot of the layer stack for background rendering.
+
+        :param lib.layer.tree.RootLayerStack root: The layer stack.
+        :param int mipmap_level: Highest mipmap level to be rendered.
+        :rtype: lib.layer.tree.RenderSnapshot
+
+        Copying the tile dicts costs time in proportion to the size of
+        the document, so the snapshot is kept and reused for any
+        mipmap level it covers. `canvas_modified_cb()` drops it.
+
+        """
+        cached = self._render_snapshot
+        if cached is not None:
+            cached_root, snapshot = cached
+            if cached_root is root and snapshot.mipmap_level >= mipmap_level:
+                return snapshot
+        snapshot = root.get_render_snapshot(mipmap_level=mipmap_level)
+        self._render_snapshot = (root, snapshot)
+        return snapshot
+
+    def _refinement_done_cb(self, atlas, ticket, mipmap_level, tiles, results):
+        """Idle callback: blit tiles finished by the render worker."""
+        tiles = atlas.accept(ticket, tiles)
+        if atlas not in self._display_atlases.values():
+            return False
+        atlas_tiles = atlas.surface.get_tiles()
+        done = [t for t in tiles if t in results]
+        for t in done:
+            atlas_tiles[t][...] = results[t]
+        atlas.mark_valid(done)
+        if self.get_window() is not None:
+            self._queue_draw_atlas_tiles(done, mipmap_level)
+        return False
+
     def scroll(self, dx, dy, ongoing=True):
         self.translation_x -= dx
         self.translation_y -= dy
@@ -42,6 +42,24 @@ class Autosaveable:
     def autosave_dirty(self, value):
         """Setter for the dirty flag"""
         self.__autosave_dirty = bool(value)
+        if value:
+            self.__save_revision = self.save_revision + 1
+
+    @property
+    def save_revision(self):
+        """Count of the times the object has been flagged as dirty
+
+        :rtype: int
+
+        Unlike `autosave_dirty`, this is never reset. Other kinds of
+        save can compare it against a value they recorded earlier to
+        tell whether data they wrote back then is still current.
+        """
+        try:
+            return self.__save_revision
+        except AttributeError:
+            self.__save_revision = 0
+            return self.__save_revision
 
     @property
     def autosave_uuid(self):
@@ -70,7 +88,7 @@ class Autosaveable:
         be skipped.
 
         :param unicode oradir: Root of OpenRaster-like structure
-        :param lib.idletask.Processor taskproc: Output: queue of tasks
+        :param lib.idletask.ThreadedProcessor taskproc: Output: task queue
         :param set manifest: Output: files in data/ to retain afterward
         :param tuple bbox: frame bounding box, (x,y,w,h)
         :param \*\*kwargs: To be passed to underlying save routines.
@@ -89,14 +107,14 @@ class Autosaveable:
            which indexes its own files,
            and includes the XML elements from its children.
 
-        Auto-recovery saving needs to be split into small tasks so that
-        it doesn't interfere too much with foreground processing.
+        Auto-recovery saving is split into small tasks, which run in a
+        background thread so they don't hold up foreground processing.
         Individual PNG tile strips or small file copies have about the
-        right granularity.
+        right granularity: stopping the queue waits for the current one.
 
-        It follows that snapshots should be used for auto-saving,
-        because the user can make changes between the queued tasks
-        as the queue is run.
+        It follows that snapshots must be used for auto-saving,
+        because the user can make changes while the queue is run.
+        Tasks must not touch GTK, or any live document state.
 
         The returned element should contain sub-elements for any
         sub-layers, and the queue operation should recursively call this
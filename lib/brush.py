@@ -11,11 +11,15 @@ import logging
 import copy
 import math
 import json
+import hashlib
+
+import numpy as np
 
 from lib import mypaintlib
 from lib import helpers
 from lib import brushsettings
 from lib.eotf import eotf
+from lib.cache import LRUCache
 from lib.pycompat import unicode
 from lib.pycompat import PY3
 
@@ -40,6 +44,10 @@ STRING_VALUE_SETTINGS = set(
 )
 OLDFORMAT_BRUSHFILE_VERSION = 2
 
+#: Number of distinct parsed brush settings strings to keep.
+#: See get_parsed_brushinfo().
+PARSED_BRUSHINFO_CACHE_SIZE = 64
+
 BRUSH_SETTINGS = set([s.cname for s in brushsettings.settings])
 ALL_SETTINGS = BRUSH_SETTINGS.union(STRING_VALUE_SETTINGS)
 
@@ -642,6 +650,18 @@ class Brush(mypaintlib.PythonBrush):
         brushinfo.observers.append(self._update_from_brushinfo)
         self._update_from_brushinfo(ALL_SETTINGS)
 
+    def release_brushinfo(self):
+        """Stop propagating changes from the BrushInfo to this brush
+
+        Call this when done with a brush made from a shared BrushInfo,
+        so that the BrushInfo doesn't keep the brush alive.
+
+        """
+        try:
+            self.brushinfo.observers.remove(self._update_from_brushinfo)
+        except ValueError:
+            pass
+
     def stroke_to(self, *args):
         """Delegates to mypaintlib with information about color space
 
@@ -652,6 +672,28 @@ class Brush(mypaintlib.PythonBrush):
         args += (linear,)
         return super(Brush, self).stroke_to(*args)
 
+    def stroke_to_events(self, backend, events):
+        """Replay an array of recorded events in one call
+
+        :param backend: The surface's C++ backend to paint to.
+        :param numpy.ndarray events: Events, shape (n, 9), as
+            returned by lib.stroke.Stroke.get_events().
+        :returns: The number of events replayed.
+        :rtype: int
+
+        This paints exactly what calling stroke_to() for every row
+        would, but the loop runs in native code. Read-only arrays,
+        like those decoded from old strokes, are used without copying.
+
+        """
+        events = np.require(events, dtype="float64", requirements=["C", "A"])
+        if events.ndim != 2 or events.shape[1] != 9:
+            raise ValueError(
+                "events: expected shape (n, 9), not %r" % (events.shape,)
+            )
+        linear = eotf() != 1.0
+        return super(Brush, self).stroke_to_events(backend, events, linear)
+
     def _update_from_brushinfo(self, settings):
         """Updates changed low-level settings from the BrushInfo"""
 
@@ -695,6 +737,54 @@ class Brush(mypaintlib.PythonBrush):
                 self.set_mapping_point(setting.index, input.index, i, x, y)
 
 
+## Parsed brush cache
+
+_PARSED_BRUSHINFO_CACHE = LRUCache(capacity=PARSED_BRUSHINFO_CACHE_SIZE)
+
+
+def _brush_string_key(settings_str):
+    """Content hash of a brush settings string, for the parsed cache"""
+    if isinstance(settings_str, unicode):
+        settings_str = settings_str.encode("utf-8")
+    return hashlib.sha1(settings_str).digest()
+
+
+def get_parsed_brushinfo(settings_str):
+    """Get a shared BrushInfo parsed from a settings string
+
+    :param settings_str: Brush settings, as saved with strokes.
+    :returns: A parsed BrushInfo, which must be treated as read-only.
+    :rtype: BrushInfo
+
+    Replaying strokes and restoring brushes from the strokemap would
+    otherwise parse the same few settings strings over and over.
+    Parsed results are cached by a hash of their content, so strokes
+    and strokemap shapes painted with the same brush share one.
+    Callers which need to change the settings must take a clone().
+
+    """
+    key = _brush_string_key(settings_str)
+    info = _PARSED_BRUSHINFO_CACHE.get(key)
+    if info is None:
+        info = BrushInfo(settings_str)
+        _PARSED_BRUSHINFO_CACHE[key] = info
+    return info
+
+
+def get_parsed_brushinfo_stats():
+    """Get usage statistics for the parsed brush cache
+
+    :rtype: lib.cache.CacheStats
+
+    """
+    return _PARSED_BRUSHINFO_CACHE.stats()
+
+
+def reset_parsed_brushinfo_stats():
+    """Reset the parsed brush cache's hit and miss counters"""
+    _PARSED_BRUSHINFO_CACHE.reset_stats()
+
+
 if __name__ == "__main__":
     import doctest
 
@@ -7,23 +7,147 @@
 # (at your option) any later version.
 
 from collections import OrderedDict
+from collections import namedtuple
 
 DEFAULT_CACHE_SIZE = 16384
 
+#: Default memory budget for byte-limited caches: 256 MiB.
+#: That's 4096 8bpc RGBA tiles, enough for a couple of 4K screens.
+DEFAULT_CACHE_BYTES = 256 * 1024 * 1024
+
+
+_CACHE_STATS_FIELDS = (
+    "hits",
+    "misses",
+    "evictions",
+    "items",
+    "resident_bytes",
+    "max_bytes",
+)
+
+
+class CacheStats(namedtuple("CacheStats", _CACHE_STATS_FIELDS)):
+    """Usage statistics for an LRUCache.
+
+    :ivar int hits: Successful lookups since the last reset.
+    :ivar int misses: Failed lookups since the last reset.
+    :ivar int evictions: Entries dropped to stay within the limits.
+    :ivar int items: Number of entries currently held.
+    :ivar int resident_bytes: Total size of the entries currently held.
+    :ivar int max_bytes: The byte budget, or None if unlimited.
+
+    """
+
+    @property
+    def hit_rate(self):
+        """Fraction of lookups which were hits, or None if no lookups"""
+        accesses = self.hits + self.misses
+        if accesses == 0:
+            return None
+        return self.hits / float(accesses)
+
+
+def nbytes(item):
+    """Default sizing function for byte-limited caches.
+
+    :param item: A NumPy array, a bytes-like object, or a dict of them.
+    :returns: The number of bytes of data held by item.
+    :rtype: int
+
+    >>> nbytes(b"12345")
+    5
+    >>> nbytes({1: b"12", 2: b"345"})
+    5
+
+    """
+    if isinstance(item, dict):
+        return sum(nbytes(v) for v in item.values())
+    try:
+        return int(item.nbytes)
+    except AttributeError:
+        return len(item)
+
 
 class LRUCache(object):
-    """Least-recently-used cache with dict-like usage"""
+    """Least-recently-used cache with dict-like usage
+
+    The cache can be limited by the number of items it holds,
+    or by the total size of those items in bytes, or both.
+
+    >>> c = LRUCache(capacity=3)
+    >>> for k in "abcd":
+    ...     c[k] = k.upper()
+    >>> sorted(c._cache.keys())
+    ['b', 'c', 'd']
+    >>> c.get("a") is None
+    True
+    >>> c["b"]
+    'B'
+    >>> c.stats()
+    CacheStats(hits=1, misses=1, evictions=1, items=3, resident_bytes=0, max_bytes=None)
+
+    When a byte budget is used, a sizing function measures each item
+    as it is stored. Entries are evicted oldest first until the total
+    fits within the budget again.
+
+    >>> c = LRUCache(capacity=None, max_bytes=10, sizeof=nbytes)
+    >>> c["a"] = b"1234"
+    >>> c["b"] = b"5678"
+    >>> c.resident_bytes
+    8
+    >>> c["a"]
+    b'1234'
+    >>> c["c"] = b"9abc"
+    >>> sorted(c._cache.keys())
+    ['a', 'c']
+    >>> c.resident_bytes
+    8
+    >>> c.evictions
+    1
+
+    Replacing an item re-measures it.
+
+    >>> c["a"] = b"12"
+    >>> c.resident_bytes
+    6
+
+    An item that is bigger than the entire budget is not stored.
+
+    >>> c["d"] = b"0123456789ab"
+    >>> "d" in c
+    False
+    >>> c.resident_bytes
+    6
+
+    """
 
     # The idea for using an OrderedDict comes from Kun Xi -
     # http://www.kunxi.org/blog/2014/05/lru-cache-in-python/
 
     _SENTINEL = object()
 
-    def __init__(self, capacity=DEFAULT_CACHE_SIZE):
+    def __init__(self, capacity=DEFAULT_CACHE_SIZE, max_bytes=None, sizeof=None):
+        """Initialize, with limits.
+
+        :param int capacity: Max number of items, or None for no limit.
+        :param int max_bytes: Max total size of items, or None.
+        :param callable sizeof: Returns the size of an item in bytes.
+
+        If max_bytes is set and sizeof is not, the `nbytes()` function
+        defined in this module is used.
+
+        """
+        if max_bytes is not None and sizeof is None:
+            sizeof = nbytes
         self._capacity = capacity
+        self._max_bytes = max_bytes
+        self._sizeof = sizeof
         self._cache = OrderedDict()
+        self._sizes = {}
+        self._resident_bytes = 0
         self._hits = 0
         self._misses = 0
+        self._evictions = 0
 
     def __repr__(self):
         hitrate = 1.0
@@ -32,17 +156,77 @@ class LRUCache(object):
         if accesses > 0:
             hitrate = self._hits / accesses
             missrate = self._misses / accesses
-        return "<LRUCache c: %d/%d h: %.0f%% m: %.0f%%>" % (
+        return "<LRUCache c: %d/%s b: %d/%s h: %.0f%% m: %.0f%% e: %d>" % (
             len(self._cache),
             self._capacity,
+            self._resident_bytes,
+            self._max_bytes,
             hitrate * 100,
             missrate * 100,
+            self._evictions,
         )
 
-    def clear(self):
-        self._cache.clear()
+    ## Statistics
+
+    @property
+    def hits(self):
+        """Number of successful lookups since the last stats reset"""
+        return self._hits
+
+    @property
+    def misses(self):
+        """Number of failed lookups since the last stats reset"""
+        return self._misses
+
+    @property
+    def evictions(self):
+        """Number of items evicted to stay within the cache's limits"""
+        return self._evictions
+
+    @property
+    def resident_bytes(self):
+        """Total size of the items held, if they're being measured"""
+        return self._resident_bytes
+
+    @property
+    def max_bytes(self):
+        """The cache's byte budget (read/write; None means no limit)"""
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, n):
+        if n is not None and self._sizeof is None:
+            raise ValueError("A byte budget needs a sizeof function")
+        self._max_bytes = n
+        self._evict(0, 0)
+
+    def stats(self):
+        """Get a snapshot of the cache's usage statistics.
+
+        :rtype: CacheStats
+
+        """
+        return CacheStats(
+            hits=self._hits,
+            misses=self._misses,
+            evictions=self._evictions,
+            items=len(self._cache),
+            resident_bytes=self._resident_bytes,
+            max_bytes=self._max_bytes,
+        )
+
+    def reset_stats(self):
+        """Reset the hit, miss, and eviction counters."""
         self._hits = 0
         self._misses = 0
+        self._evictions = 0
+
+    ## Dict-like interface
+
+    def clear(self):
+        self._cache.clear()
+        self._sizes.clear()
+        self._resident_bytes = 0
 
     def __len__(self):
         return len(self._cache)
@@ -50,6 +234,18 @@ class LRUCache(object):
     def __contains__(self, key):
         return key in self._cache
 
+    def keys(self):
+        """Returns a list of the keys, least recently used first."""
+        return list(self._cache.keys())
+
+    def values(self):
+        """Returns a list of the items, least recently used first.
+
+        Like `keys()`, this doesn't count as a lookup.
+
+        """
+        return list(self._cache.values())
+
     def __getitem__(self, key):
         item = self.get(key, self._SENTINEL)
         if item is self._SENTINEL:
@@ -66,21 +262,87 @@ class LRUCache(object):
             self._misses += 1
             return default
 
+    def peek(self, key, default=None):
+        """Get an item without counting a lookup or making it recent.
+
+        Use this with `touch()` when whether a lookup succeeds depends
+        on more than whether the key is present.
+
+        >>> c = LRUCache()
+        >>> c["a"] = {1: "x"}
+        >>> c.peek("a").get(2) is None
+        True
+        >>> c.touch("a", hit=False)
+        >>> c.stats()[0:2]
+        (0, 1)
+
+        """
+        return self._cache.get(key, default)
+
+    def touch(self, key, hit=True):
+        """Count a lookup, making the key the most recent if it's a hit."""
+        if hit and key in self._cache:
+            self._cache.move_to_end(key)
+            self._hits += 1
+        else:
+            self._misses += 1
+
     def pop(self, key, default=_SENTINEL):
+        """Remove an item, and return it.
+
+        Popping is invalidation rather than a lookup,
+        so it doesn't affect the hit and miss counters.
+
+        """
         try:
             item = self._cache.pop(key)
-            self._hits += 1
-            return item
         except KeyError:
-            self._misses += 1
             if default is LRUCache._SENTINEL:
                 raise
             return default
+        self._resident_bytes -= self._sizes.pop(key, 0)
+        return item
 
     def __setitem__(self, key, item):
-        try:
-            self._cache.pop(key)
-        except KeyError:
-            while len(self._cache) >= self._capacity:
-                self._cache.popitem(last=False)
+        size = 0
+        if self._sizeof is not None:
+            size = int(self._sizeof(item))
+        if key in self._cache:
+            self.pop(key)
+        if self._max_bytes is not None and size > self._max_bytes:
+            return
+        self._evict(size, 1)
         self._cache[key] = item
+        if self._sizeof is not None:
+            self._sizes[key] = size
+            self._resident_bytes += size
+
+    def _evict(self, incoming_bytes, incoming_items):
+        """Evict the oldest items to make room for incoming ones."""
+        capacity = self._capacity
+        max_bytes = self._max_bytes
+        while self._cache:
+            over_capacity = (
+                capacity is not None
+                and len(self._cache) + incoming_items > capacity
+            )
+            over_budget = (
+                max_bytes is not None
+                and self._resident_bytes + incoming_bytes > max_bytes
+            )
+            if not (over_capacity or over_budget):
+                break
+            key, item = self._cache.popitem(last=False)
+            self._resident_bytes -= self._sizes.pop(key, 0)
+            self._evictions += 1
+
+
+def _test():
+    """Run doctest strings"""
+    import doctest
+
+    doctest.testmod()
+
+
+if __name__ == "__main__":
+    _test()
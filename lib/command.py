@@ -11,6 +11,8 @@
 ## Imports
 
 from collections import deque
+from collections import namedtuple
+from collections import Counter
 from warnings import warn
 from copy import deepcopy
 import weakref
@@ -19,6 +21,7 @@ from logging import getLogger
 
 import lib.layer
 import lib.layer.data
+import lib.tiledsurface
 from . import helpers
 from lib.observable import event
 import lib.stroke
@@ -30,13 +33,82 @@ logger = getLogger(__name__)
 ## Command stack and action interface
 
 
+class CommandMemory(namedtuple("CommandMemory", ["command", "tiles", "nbytes"])):
+    """Memory retained by one command in the undo history.
+
+    :ivar Command command: The command.
+    :ivar int tiles: Tiles only this command holds on to.
+    :ivar int nbytes: Pixel data in those tiles.
+
+    Tiles also held by live layers or by other commands in the
+    history are not counted, since dropping the command would not
+    free them. Tiles shared by several commands still count towards
+    CommandStack.get_retained_bytes(), though.
+
+    """
+
+
 class CommandStack(object):
-    """Undo/redo stack"""
+    """Undo/redo stack
+
+    The undo stack is limited to a number of commands, and optionally
+    to a memory budget for the tiles that only the history holds.
+
+    >>> from lib.tiledsurface import TileStore, _Tile
+    >>> class _Snapshot(Command):
+    ...     def __init__(self, ntiles):
+    ...         self.store = TileStore(
+    ...             dict(((i, 0), _Tile()) for i in range(ntiles))
+    ...         )
+    ...     def redo(self):
+    ...         pass
+    >>> tile_bytes = _Tile().nbytes
+    >>> stack = CommandStack(10, max_bytes=5 * tile_bytes)
+    >>> for n in (2, 1, 3, 0):
+    ...     stack.do(_Snapshot(n))
+    >>> [m.tiles for m in stack.get_memory_usage()]
+    [1, 3, 0]
+    >>> stack.get_retained_bytes() == 4 * tile_bytes
+    True
+
+    Tiles held by more than one command count once towards the total,
+    though not towards any one command.
+
+    >>> shared = _Snapshot(2)
+    >>> twin = _Snapshot(0)
+    >>> twin.store = shared.store.copy()
+    >>> stack.do(shared)
+    >>> stack.do(twin)
+    >>> [m.tiles for m in stack.get_memory_usage()][-2:]
+    [0, 0]
+    >>> stack.get_retained_bytes() == 5 * tile_bytes
+    True
+    >>> stack.do(_Snapshot(1))
+    >>> [m.tiles for m in stack.get_memory_usage()]
+    [0, 0, 0, 1]
+    >>> stack.get_retained_bytes() == 3 * tile_bytes
+    True
+
+    """
+
+    def __init__(self, max_stack_size, max_bytes=None, get_live_stores=None, **kwargs):
+        """Initialize, with limits
+
+        :param int max_stack_size: Max number of commands to keep.
+        :param int max_bytes: Max bytes of tiles held only by the
+            history, or None for no limit.
+        :param callable get_live_stores: Returns the TileStores of the
+            live document, whose tiles cost the history nothing.
 
-    def __init__(self, max_stack_size, **kwargs):
+        """
         super(CommandStack, self).__init__()
         assert isinstance(max_stack_size, int) and max_stack_size > 0
+        assert max_bytes is None or max_bytes > 0
         self.max_stack_size = max_stack_size
+        self.max_bytes = max_bytes
+        self._get_live_stores = get_live_stores
+        self._command_tiles = {}  # {command: set of tiles}
+        self._live_tiles = {}  # {id(store): (weakref, revision, tiles)}
         self.undo_stack = deque()
         self.redo_stack = deque()
         self.stack_updated()
@@ -53,9 +125,13 @@ class CommandStack(object):
         self.stack_updated()
 
     def _discard_undo(self):
+        for command in self.undo_stack:
+            self._command_tiles.pop(command, None)
         self.undo_stack = deque()
 
     def _discard_redo(self):
+        for command in self.redo_stack:
+            self._command_tiles.pop(command, None)
         self.redo_stack = deque()
 
     def do(self, command):
@@ -79,6 +155,10 @@ class CommandStack(object):
         if completed is False:
             command.undo()
         else:
+            # The previous command may have been updated since it was
+            # last measured, e.g. by more painting.
+            if self.undo_stack:
+                self._command_tiles.pop(self.undo_stack[-1], None)
             self.undo_stack.append(command)
             self.reduce_undo_history()
             self.stack_updated()
@@ -93,6 +173,7 @@ class CommandStack(object):
             return
         command = self.undo_stack.pop()
         command.undo()
+        self._command_tiles.pop(command, None)
         self.redo_stack.append(command)
         self.stack_updated()
         return command
@@ -117,14 +198,139 @@ class CommandStack(object):
             command.undo()
         else:
             self.redo_stack.pop()
+            self._command_tiles.pop(command, None)
             self.undo_stack.append(command)
             self.stack_updated()
         return command
 
     def reduce_undo_history(self):
-        """Trims the undo stack"""
+        """Trims the undo stack
+
+        The oldest commands are dropped until both the command count
+        and the memory budget are respected. The most recent command
+        is always kept, even if it's over budget on its own.
+        """
         while len(self.undo_stack) > self.max_stack_size:
-            self.undo_stack.popleft()
+            self._command_tiles.pop(self.undo_stack.popleft(), None)
+        if self.max_bytes is None:
+            return
+        # The history can't hold more than all the tile arrays there
+        # are, and that's cheap to know. Don't measure unless needed.
+        if lib.tiledsurface.get_resident_tile_bytes() <= self.max_bytes:
+            return
+        holders, is_live = self._get_history_holders()
+        retained = sum(t.nbytes for t in holders if not is_live(t))
+        if retained <= self.max_bytes:
+            return
+        # Dropping a command frees the tiles nothing else holds,
+        # so the total can be kept up to date without remeasuring.
+        dropped = 0
+        while retained > self.max_bytes and len(self.undo_stack) > 1:
+            command = self.undo_stack.popleft()
+            for t in self._command_tiles.pop(command, None) or ():
+                holders[t] -= 1
+                if holders[t] == 0 and not is_live(t):
+                    retained -= t.nbytes
+            dropped += 1
+        logger.debug(
+            "Dropped %d commands to keep the undo history within "
+            "%d bytes (now %d)",
+            dropped,
+            self.max_bytes,
+            retained,
+        )
+
+    ## Memory accounting
+
+    def get_memory_usage(self):
+        """Get the memory retained by each command in the history
+
+        :returns: one entry per command, undo stack then redo stack,
+            oldest first
+        :rtype: list of CommandMemory
+
+        """
+        commands = list(self.undo_stack) + list(self.redo_stack)
+        holders, is_live = self._get_history_holders()
+        usage = []
+        for command in commands:
+            tiles = self._get_command_tiles(command)
+            own = [t for t in tiles if holders[t] == 1 and not is_live(t)]
+            usage.append(
+                CommandMemory(
+                    command=command,
+                    tiles=len(own),
+                    nbytes=sum(t.nbytes for t in own),
+                )
+            )
+        return usage
+
+    def get_retained_bytes(self):
+        """Total bytes of tiles that only the history holds
+
+        :rtype: int
+
+        Each tile counts once, however many commands hold it.
+
+        """
+        holders, is_live = self._get_history_holders()
+        return sum(t.nbytes for t in holders if not is_live(t))
+
+    def _get_history_holders(self):
+        """Internal: count the commands holding each history tile
+
+        :returns: a Counter of tiles, and a predicate for live tiles
+        :rtype: tuple
+
+        """
+        holders = Counter()
+        for command in list(self.undo_stack) + list(self.redo_stack):
+            holders.update(self._get_command_tiles(command))
+        live_sets = self._get_live_tile_sets()
+
+        def _is_live(tile):
+            return any(tile in tiles for tiles in live_sets)
+
+        return holders, _is_live
+
+    def _get_live_tile_sets(self):
+        """Internal: the sets of tiles in each live store, cached
+
+        Only the stores which have changed since the last call are
+        read again, so after a stroke it's usually just the one.
+
+        """
+        if self._get_live_stores is None:
+            return []
+        old_cache = self._live_tiles
+        cache = {}
+        live_sets = []
+        for store in self._get_live_stores():
+            entry = old_cache.get(id(store))
+            if entry is not None:
+                ref, revision, tiles = entry
+                if ref() is not store or revision != store.revision:
+                    entry = None
+            if entry is None:
+                revision = store.revision
+                tiles = frozenset(t for (pos, t) in store.snapshot_items())
+                entry = (weakref.ref(store), revision, tiles)
+            cache[id(store)] = entry
+            live_sets.append(entry[2])
+        self._live_tiles = cache
+        return live_sets
+
+    def _get_command_tiles(self, command):
+        """Internal: the set of tiles a command holds, cached"""
+        tiles = self._command_tiles.get(command)
+        if tiles is None:
+            tiles = set()
+            for store in lib.tiledsurface.find_tile_stores(command):
+                tiles.update(t for (pos, t) in store.snapshot_items())
+            tiles.discard(lib.tiledsurface.transparent_tile)
+            tiles.discard(lib.tiledsurface.mipmap_dirty_tile)
+            self._command_tiles[command] = tiles
+        return tiles
 
     def get_last_command(self):
         """Returns the most recently performed command"""
@@ -139,6 +345,7 @@ class CommandStack(object):
             return None
         old_name = cmd.display_name
         cmd.update(**kwargs)
+        self._command_tiles.pop(cmd, None)
         if old_name != cmd.display_name:
             self.stack_updated()
         return cmd
@@ -19,6 +19,7 @@ from os.path import join
 import xml.etree.ElementTree as ET
 from warnings import warn
 import shutil
+import copy
 from datetime import datetime
 from collections import namedtuple
 import json
@@ -40,6 +41,7 @@ from lib.observable import event
 from lib.observable import ObservableDict
 import lib.pixbuf
 from lib.cache import DEFAULT_CACHE_SIZE
+from lib.cache import DEFAULT_CACHE_BYTES
 from lib.errors import FileHandlingError
 from lib.errors import AllocationError
 import lib.idletask
@@ -47,6 +49,7 @@ from lib.gettext import C_
 import lib.xml
 import lib.glib
 import lib.feedback
+import lib.floodfill
 import lib.layervis
 from lib.pycompat import unicode
 
@@ -58,6 +61,16 @@ logger = logging.getLogger(__name__)
 DEFAULT_RESOLUTION = 72
 DEFAULT_UNDO_STACK_SIZE = 40
 
+#: Default memory budget for tiles held only by the undo history: 1 GiB.
+DEFAULT_UNDO_STACK_BYTES = 1024 * 1024 * 1024
+
+#: Mipmap tiles regenerated per idle callback, after edits.
+MIPMAP_IDLE_BATCH_TILES = 64
+
+#: Quiet time after the last edit before mipmaps are regenerated, in ms.
+#: Regenerating them mid-stroke is wasted work: the next dab redirties them.
+MIPMAP_IDLE_DELAY = 500
+
 N = tiledsurface.N
 
 CACHE_APP_SUBDIR_NAME = "mypaint"
@@ -280,13 +293,21 @@ class Document(object):
         cache_dir=None,
         cache_size=DEFAULT_CACHE_SIZE,
         max_undo_stack_size=DEFAULT_UNDO_STACK_SIZE,
+        render_threads=layer.DEFAULT_RENDER_THREADS,
+        cache_bytes=DEFAULT_CACHE_BYTES,
+        tile_swap_bytes=None,
+        max_undo_stack_bytes=None,
     ):
         """Initialize
 
         :param brushinfo: the lib.brush.BrushInfo instance to use
         :param painting_only: only use painting layers
         :param cache_dir: use an existing cache dir
-        :param cache_size: size of the layer render cache
+        :param cache_size: max tile locations in the layer render cache
+        :param render_threads: number of threads used for rendering tiles
+        :param cache_bytes: memory budget for the layer render cache
+        :param tile_swap_bytes: memory ceiling for layer tiles, or None
+        :param max_undo_stack_bytes: memory budget for undo history, or None
 
         If painting_only is true, then no tempdir will be created by the
         document when it is initialized or cleared.
@@ -296,17 +317,35 @@ class Document(object):
         this is set; it's assumed that you're importing into a parent
         document.
 
+        If tile_swap_bytes is set, the least recently used layer and
+        undo history tiles are swapped out to a file in the cache dir
+        when their arrays take up more memory than that. Swapping needs
+        a cache dir that the document manages itself.
+
+        If max_undo_stack_bytes is set, the oldest undo history is
+        dropped when the tiles that only the history holds take up
+        more memory than that. See lib.command.CommandStack.
+
         """
         object.__init__(self)
         if not brushinfo:
             brushinfo = brush.BrushInfo()
             brushinfo.load_defaults()
-        self._layers = layer.RootLayerStack(self, cache_size=cache_size)
+        self._layers = layer.RootLayerStack(
+            self,
+            cache_size=cache_size,
+            render_threads=render_threads,
+            cache_bytes=cache_bytes,
+        )
         self._layers.layer_content_changed += self._canvas_modified_cb
         self.brush = brush.Brush(brushinfo)
         self.brush.brushinfo.observers.append(self.brushsettings_changed_cb)
         self.stroke = None
-        self.command_stack = command.CommandStack(max_undo_stack_size)
+        self.command_stack = command.CommandStack(
+            max_undo_stack_size,
+            max_bytes=max_undo_stack_bytes,
+            get_live_stores=self._layers.get_tile_stores,
+        )
 
         # Cache and auto-saving to the cache
         self._painting_only = painting_only
@@ -329,8 +368,21 @@ class Document(object):
         self._autosave_processor = None
         self._autosave_countdown_id = None
         self._autosave_dirty = False
+        self._ora_save_record = None
+        self._tile_swap_bytes = tile_swap_bytes
+        self._tile_swap = None
+        self._mipmap_processor = None
+        self._mipmap_delay_id = None
+        self._last_canvas_edit_time = 0.0
+        if not painting_only:
+            # Regenerates mipmaps after edits, so zooming out is smooth
+            self._mipmap_processor = lib.idletask.Processor()
         if (not painting_only) and self._owns_cache_dir:
-            self._autosave_processor = lib.idletask.Processor()
+            self._autosave_processor = lib.idletask.ThreadedProcessor(
+                name="autosave",
+                done_cb=self._autosave_done_cb,
+                error_cb=self._autosave_error_cb,
+            )
             self.command_stack.stack_updated += self._command_stack_updated_cb
             self.effective_bbox_changed += self._effective_bbox_changed_cb
 
@@ -397,6 +449,11 @@ class Document(object):
             doc_cache_dir = doc_cache_dir.decode(sys.getfilesystemencoding())
         logger.debug("Created working-doc cache dir %r", doc_cache_dir)
         self._cache_dir = doc_cache_dir
+        if self._tile_swap_bytes is not None:
+            self._tile_swap = tiledsurface.TileSwap(
+                doc_cache_dir,
+                self._tile_swap_bytes,
+            )
         # Start the cache updater, which kicks off background autosaves,
         # and updates an activity canary file.
         # Not a perfect solution, but maybe a better cross-platform one
@@ -421,6 +478,9 @@ class Document(object):
             return
         self._stop_cache_updater()
         self._stop_autosave_writes()
+        if self._tile_swap is not None:
+            self._tile_swap.close()
+            self._tile_swap = None
         shutil.rmtree(self._cache_dir, ignore_errors=True)
         if os.path.exists(self._cache_dir):
             logger.error(
@@ -440,6 +500,11 @@ class Document(object):
         This method is called by the main app's exit routine
         after confirmation.
         """
+        if self._mipmap_processor is not None:
+            self._mipmap_processor.stop()
+        if self._mipmap_delay_id is not None:
+            GLib.source_remove(self._mipmap_delay_id)
+            self._mipmap_delay_id = None
         self._cleanup_cache_dir()
 
     ## Document-specific settings dict.
@@ -520,6 +585,7 @@ class Document(object):
         os.utime(activity_file_path, None)
         if self._autosave_dirty:
             self._start_autosave_countdown()
+        self.swap_out_tiles()
         return True
 
     ## Autosave flag
@@ -596,14 +662,17 @@ class Document(object):
         self._autosave_countdown_id = None
         return False
 
-    ## Queued autosave writes: low priority & chunked
+    ## Queued autosave writes: in a background thread
 
     def _queue_autosave_writes(self):
         """Add autosaved backup tasks to the background processor
 
         These tasks consist of nicely chunked writes for all layers
         whose data has changed, plus a few extra structural and
-        bookkeeping ones.
+        bookkeeping ones. Everything they need is snapshotted here,
+        and they run in the autosave worker thread. The outcome is
+        reported back on the main thread, to `_autosave_done_cb()` or
+        `_autosave_error_cb()`.
 
         """
         if not self._cache_dir:
@@ -694,6 +763,9 @@ class Document(object):
             oradir=oradir,
             manifest=manifest,
         )
+        # Everything's snapshotted, so any further updates made while
+        # the writes are running will need another autosave.
+        self._autosave_dirty = False
 
     def _autosave_thumbnail_cb(self, rootstack, bbox, filename):
         """Autosaved backup task: write Thumbnails/thumbnail.png
@@ -769,13 +841,38 @@ class Document(object):
                 "autosave: missing %r (listed in the manifest)",
                 path,
             )
-        self._autosave_dirty = False
-        logger.debug("autosave: all done, doc marked autosave-clean")
         return False
 
+    def _autosave_done_cb(self):
+        """Autosave finished (main thread)"""
+        assert not self._painting_only
+        if self._autosave_dirty:
+            logger.debug("autosave: all done, but doc updated meanwhile")
+            self._start_autosave_countdown()
+        else:
+            logger.debug("autosave: all done, doc is autosave-clean")
+
+    def _autosave_error_cb(self, exc):
+        """Autosave failed: leave the doc dirty for a retry (main thread)
+
+        Layers are flagged to be written out in full next time,
+        because the failed run may have skipped some of their files.
+
+        """
+        assert not self._painting_only
+        logger.error("autosave: abandoned after an error: %s", exc)
+        self._autosave_dirty = True
+        for l in self.layer_stack.deepiter():
+            l.autosave_dirty = True
+        self.layer_stack.background_layer.autosave_dirty = True
+        self._start_autosave_countdown()
+
     def _stop_autosave_writes(self):
         assert not self._painting_only
         logger.debug("autosave stopped: clearing task queue")
+        if self._autosave_processor.has_work():
+            self._autosave_dirty = True
+        # Waits for the worker to finish writing its current chunk.
         self._autosave_processor.stop()
 
     def _command_stack_updated_cb(self, cmdstack):
@@ -934,6 +1031,7 @@ class Document(object):
         and the document-specific settings.
         """
         self.sync_pending_changes()
+        self._ora_save_record = None
         self.layer_view_manager.clear()
         self._layers.symmetry_unset = True
         self._layers.set_symmetry_state(
@@ -1061,9 +1159,70 @@ class Document(object):
         This is a little quirky, but allows big areas to be filled
         rapidly as needed on blank layers.
         """
-        bbox = helpers.Rect(*tuple(self.get_effective_bbox()))
         if not self.layer_stack.current.get_fillable():
             make_new_layer = True
+        fill_args.bbox = self._get_flood_fill_bbox(fill_args, view_bbox)
+        cmd = command.FloodFill(
+            self, fill_args, sample_merged, src_path, make_new_layer, status_cb
+        )
+        self.do(cmd)
+
+    def flood_fill_preview(
+        self,
+        fill_args,
+        view_bbox=None,
+        sample_merged=False,
+        src_path=None,
+    ):
+        """Quickly fills a reduced-size copy of the fill source
+
+        :param fill_args: fill arguments object
+        :type fill_args: lib.floodfill.FloodFillArguments
+        :param view_bbox: Bounding box of the view, restricts fill if present
+        :type view_bbox: lib.helpers.Rect
+        :param sample_merged: Use all visible layers when sampling
+        :type sample_merged: bool
+        :param src_path: Path to layer used as reference (if not active layer)
+        :type src_path: tuple or None
+        :returns: (mipmap_level, alpha_tiles), or None
+        :rtype: tuple
+
+        Parameters are the same as for flood_fill(), and the same
+        limits apply. If the fill would cover so few tiles that the
+        full-size fill is fast anyway, or if the source layer can't
+        provide a preview, None is returned. Otherwise the fill is run
+        against a mipmap of the source, and its alpha tiles are
+        returned for display. Nothing in the document is changed, and
+        fill_args is not modified.
+        """
+        if sample_merged:
+            return None
+        layers = self.layer_stack
+        if src_path is not None:
+            src_layer = layers.deepget(src_path)
+        else:
+            src_layer = layers.current
+        if src_layer is None:
+            return None
+        bbox = self._get_flood_fill_bbox(fill_args, view_bbox)
+        level = lib.floodfill.preview_level(bbox)
+        if level == 0:
+            return None
+        fill_args = copy.copy(fill_args)
+        fill_args.bbox = bbox
+        tiles = src_layer.flood_fill_preview(fill_args, level)
+        if tiles is None:
+            return None
+        return (level, tiles)
+
+    def _get_flood_fill_bbox(self, fill_args, view_bbox):
+        """Get the bounding box limiting a flood fill
+
+        See flood_fill() for how the limits are calculated.
+
+        :rtype: lib.helpers.Rect
+        """
+        bbox = helpers.Rect(*tuple(self.get_effective_bbox()))
         if bbox.empty():
             xs = [i[0] for i in fill_args.seeds]
             ys = [i[1] for i in fill_args.seeds]
@@ -1086,17 +1245,51 @@ class Document(object):
                 bbox = view_bbox
             elif bbox.overlaps(view_bbox):
                 bbox = bbox.intersection(view_bbox)
-        fill_args.bbox = bbox
-        cmd = command.FloodFill(
-            self, fill_args, sample_merged, src_path, make_new_layer, status_cb
-        )
-        self.do(cmd)
+        return bbox
 
     ## Graphical refresh
 
     def _canvas_modified_cb(self, root, layer, x, y, w, h):
         """Internal callback: forwards redraw nofifications"""
         self.canvas_area_modified(x, y, w, h)
+        proc = self._mipmap_processor
+        if proc is None:
+            return
+        # Hold off regenerating mipmaps until the edits pause.
+        proc.stop()
+        self._last_canvas_edit_time = time.time()
+        if self._mipmap_delay_id is None:
+            self._mipmap_delay_id = GLib.timeout_add(
+                MIPMAP_IDLE_DELAY,
+                self._mipmap_delay_cb,
+            )
+
+    def _mipmap_delay_cb(self):
+        """Timeout callback: start regenerating mipmaps once it's quiet"""
+        quiet_ms = (time.time() - self._last_canvas_edit_time) * 1000
+        if quiet_ms < MIPMAP_IDLE_DELAY:
+            self._mipmap_delay_id = GLib.timeout_add(
+                int(MIPMAP_IDLE_DELAY - quiet_ms) + 1,
+                self._mipmap_delay_cb,
+            )
+            return False
+        self._mipmap_delay_id = None
+        proc = self._mipmap_processor
+        if not proc.has_work():
+            proc.add_work(self._regenerate_mipmaps_idle_cb)
+        return False
+
+    def _regenerate_mipmaps_idle_cb(self):
+        """Idle task: regenerates a batch of dirty layer mipmap tiles
+
+        :returns: whether there's more to do
+        :rtype: bool
+
+        """
+        for layer in self.layer_stack.deepiter():
+            if layer.regenerate_mipmaps(MIPMAP_IDLE_BATCH_TILES):
+                return True
+        return False
 
     @event
     def canvas_area_modified(self, x, y, w, h):
@@ -1186,6 +1379,87 @@ class Document(object):
         self.sync_pending_changes()
         return self.command_stack.get_last_command()
 
+    ## Tile memory accounting
+
+    def get_tile_memory_report(self):
+        """Account for the memory used by the document's tiles
+
+        :returns: reports for "layers", "history", and "total"
+        :rtype: dict of lib.tiledsurface.TileMemoryReport
+
+        The "layers" report covers the surfaces of the live layers,
+        including their mipmaps. The "history" report covers tiles
+        held by the undo and redo stacks but not the live layers.
+        Tiles shared between the two are counted in both of them,
+        but only once in the total.
+
+        """
+        live, history = self._get_tile_stores()
+        return {
+            "layers": tiledsurface.get_tile_memory_report(live),
+            "history": tiledsurface.get_tile_memory_report(history),
+            "total": tiledsurface.get_tile_memory_report(live + history),
+        }
+
+    def get_history_memory_usage(self):
+        """Account for the memory retained by each command in the history
+
+        :returns: one entry per command, undo stack then redo stack
+        :rtype: list of lib.command.CommandMemory
+
+        """
+        self.sync_pending_changes()
+        return self.command_stack.get_memory_usage()
+
+    def swap_out_tiles(self):
+        """Swap out cold tiles if tile data exceeds its memory ceiling
+
+        :returns: number of tiles swapped out, and the bytes freed
+        :rtype: tuple
+
+        This does nothing unless the document was created with a
+        tile_swap_bytes ceiling. It's called periodically while the
+        document is open, and must not be called mid-stroke.
+        See lib.tiledsurface.TileSwap.
+
+        """
+        if self._tile_swap is None:
+            return (0, 0)
+        # Walking the document and its history is only worth it
+        # if the running total of tile memory is over the ceiling.
+        if not self._tile_swap.over_budget:
+            return (0, 0)
+        live, history = self._get_tile_stores()
+        return self._tile_swap.trim(live + history)
+
+    def dedup_tiles(self):
+        """Make identical tiles in the document share their memory
+
+        :returns: number of tiles replaced, and the bytes freed by that
+        :rtype: tuple
+
+        See lib.tiledsurface.dedup_tiles().
+
+        """
+        self.sync_pending_changes()
+        live, history = self._get_tile_stores()
+        return tiledsurface.dedup_tiles(live + history)
+
+    def _get_tile_stores(self):
+        """Lists the tile stores of the live layers, and of the history"""
+        live = self.layer_stack.get_tile_stores()
+        live_ids = set(id(s) for s in live)
+        stack = self.command_stack
+        history = [
+            s
+            for s in tiledsurface.find_tile_stores(
+                [stack.undo_stack, stack.redo_stack],
+                exclude=(self, self.layer_stack),
+            )
+            if id(s) not in live_ids
+        ]
+        return live, history
+
     ## Utility methods
 
     def get_bbox(self):
@@ -1766,25 +2040,67 @@ class Document(object):
 
     save_jpeg = save_jpg
 
-    @fileutils.via_tempfile
     def save_ora(self, filename, options=None, **kwargs):
-        """Saves OpenRaster data to a file"""
-        logger.info("save_ora: %r (%r, %r)", filename, options, kwargs)
-        t0 = time.time()
-        self.sync_pending_changes(flush=True)
-        thumbnail = _save_layers_to_new_orazip(
-            self.layer_stack,
+        """Saves OpenRaster data to a file
+
+        Saving is incremental when the file is the one this document
+        was last saved to, and it hasn't been changed since. The data
+        of layers which haven't changed either is copied over from it,
+        rather than being encoded all over again.
+
+        """
+        target = os.path.realpath(filename)
+        record = self._ora_save_record
+        if record is not None:
+            if record.path != target or record.stat != _file_stat_key(target):
+                record = None
+        thumbnail, written_keys = self._save_ora_via_tempfile(
             filename,
-            bbox=tuple(self.get_user_bbox()),
-            xres=self._xres if self._xres else None,
-            yres=self._yres if self._yres else None,
-            frame_active=self.frame_enabled,
-            settings=dict(self._settings),
+            record,
+            options=options,
             **kwargs
         )
-        logger.info("%.3fs save_ora total", time.time() - t0)
+        self._ora_save_record = _OraSaveRecord(
+            path=target,
+            stat=_file_stat_key(target),
+            written_keys=written_keys,
+        )
         return thumbnail
 
+    @fileutils.via_tempfile
+    def _save_ora_via_tempfile(self, filename, record, options=None, **kwargs):
+        """Internal: save_ora() to a tempfile, maybe reusing data"""
+        logger.info("save_ora: %r (%r, %r)", filename, options, kwargs)
+        t0 = time.time()
+        self.sync_pending_changes(flush=True)
+        reuse_from = None
+        if record is not None:
+            try:
+                reuse_zip = zipfile.ZipFile(record.path)
+            except Exception:
+                logger.exception("Cannot reuse data from %r", record.path)
+            else:
+                reuse_from = (reuse_zip, record.written_keys)
+        written_keys = {}
+        try:
+            thumbnail = _save_layers_to_new_orazip(
+                self.layer_stack,
+                filename,
+                bbox=tuple(self.get_user_bbox()),
+                xres=self._xres if self._xres else None,
+                yres=self._yres if self._yres else None,
+                frame_active=self.frame_enabled,
+                settings=dict(self._settings),
+                reuse_from=reuse_from,
+                written_keys=written_keys,
+                **kwargs
+            )
+        finally:
+            if reuse_from is not None:
+                reuse_from[0].close()
+        logger.info("%.3fs save_ora total", time.time() - t0)
+        return (thumbnail, written_keys)
+
     @staticmethod
     def _compat_check(image_elem, filename, **kwargs):
         target_version = image_elem.attrib.get(_ORA_MYPAINT_VERSION, None)
@@ -2011,6 +2327,18 @@ class Document(object):
         return self._layer_view_manager
 
 
+_OraSaveRecord = namedtuple("_OraSaveRecord", ["path", "stat", "written_keys"])
+
+
+def _file_stat_key(path):
+    """Internal: key which changes when a file is written to, or None"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime)
+
+
 def _save_layers_to_new_orazip(
     root_stack,
     filename,
@@ -2020,6 +2348,9 @@ def _save_layers_to_new_orazip(
     frame_active=False,
     progress=None,
     settings=None,
+    threads=None,
+    reuse_from=None,
+    written_keys=None,
     **kwargs
 ):
     """Save a root layer stack to a new OpenRaster zipfile
@@ -2032,10 +2363,18 @@ def _save_layers_to_new_orazip(
     :param frame_active: True if the frame is enabled
     :param progress: Unsized UI feedback object
     :type progress: lib.feedback.Progress or None
+    :param int threads: Threads for encoding layer PNGs (None: default)
+    :param tuple reuse_from: An earlier save to copy unchanged data from,
+        as (open zipfile, written_keys dict from that save)
+    :param dict written_keys: Output: filled in for reuse next time
     :param \*\*kwargs: Passed through to root_stack.save_to_openraster()
     :rtype: GdkPixbuf
     :returns: Thumbnail preview image (256x256 max) of what was saved
 
+    Layer PNGs are encoded concurrently, but the members of the zipfile
+    are written in the same order as a serial save would write them.
+    See lib.helpers.OrderedZipWriter.
+
     >>> from lib.gibindings import GdkPixbuf
     >>> from lib.layer.test import make_test_stack
     >>> root, leaves = make_test_stack()
@@ -2062,104 +2401,113 @@ def _save_layers_to_new_orazip(
     if not isinstance(tempdir, unicode):
         tempdir = tempdir.decode(sys.getfilesystemencoding())
 
-    orazip = zipfile.ZipFile(
-        filename,
-        "w",
-        compression=zipfile.ZIP_STORED,
-    )
-
-    # The mimetype entry must be first
-    helpers.zipfile_writestr(orazip, "mimetype", lib.xml.OPENRASTER_MEDIA_TYPE)
-
-    # Update the initially-selected flag on all layers
-    # Also get the data bounding box as we go
-    data_bbox = helpers.Rect()
-    for s_path, s_layer in root_stack.walk():
-        selected = s_path == root_stack.current_path
-        s_layer.initially_selected = selected
-        data_bbox.expand_to_include_rect(s_layer.get_bbox())
-    data_bbox = tuple(data_bbox)
-
-    # First 90%: save the layer stack
-    image = ET.Element("image")
-    if bbox is None:
-        bbox = data_bbox
-    x0, y0, w0, h0 = bbox
-    image.attrib["w"] = str(w0)
-    image.attrib["h"] = str(h0)
-    image.attrib[_ORA_EOTF_ATTR] = str(lib.eotf.eotf())
-    root_stack_path = ()
-    root_stack_elem = root_stack.save_to_openraster(
-        orazip,
-        tempdir,
-        root_stack_path,
-        data_bbox,
-        bbox,
-        progress=progress.open(90),
-        **kwargs
+    orazip = helpers.OrderedZipWriter(
+        zipfile.ZipFile(
+            filename,
+            "w",
+            compression=zipfile.ZIP_STORED,
+        ),
+        threads=threads,
+        reuse_from=reuse_from,
     )
-    image.append(root_stack_elem)
-
-    # Frame-enabled state
-    frame_active_value = "true" if frame_active else "false"
-    image.attrib[_ORA_FRAME_ACTIVE_ATTR] = frame_active_value
 
-    # Document-specific settings dict.
-    if settings is not None:
+    # Queued work is abandoned, and the temporary files removed,
+    # if anything goes wrong.
+    try:
+        with orazip:
+
+            # The mimetype entry must be first
+            helpers.zipfile_writestr(orazip, "mimetype", lib.xml.OPENRASTER_MEDIA_TYPE)
+
+            # Update the initially-selected flag on all layers
+            # Also get the data bounding box as we go
+            data_bbox = helpers.Rect()
+            for s_path, s_layer in root_stack.walk():
+                selected = s_path == root_stack.current_path
+                s_layer.initially_selected = selected
+                data_bbox.expand_to_include_rect(s_layer.get_bbox())
+            data_bbox = tuple(data_bbox)
+
+            # First 90%: save the layer stack
+            image = ET.Element("image")
+            if bbox is None:
+                bbox = data_bbox
+            x0, y0, w0, h0 = bbox
+            image.attrib["w"] = str(w0)
+            image.attrib["h"] = str(h0)
+            image.attrib[_ORA_EOTF_ATTR] = str(lib.eotf.eotf())
+            root_stack_path = ()
+            root_stack_elem = root_stack.save_to_openraster(
+                orazip,
+                tempdir,
+                root_stack_path,
+                data_bbox,
+                bbox,
+                progress=progress.open(90),
+                **kwargs
+            )
+            image.append(root_stack_elem)
 
-        # Py2/Py3: always feed writestr() a UTF-8 encoded byte string.
-        json_data = json.dumps(dict(settings), indent=2)
-        if isinstance(json_data, unicode):
-            json_data = json_data.encode("utf-8")
-        assert isinstance(json_data, bytes)
+            # Frame-enabled state
+            frame_active_value = "true" if frame_active else "false"
+            image.attrib[_ORA_FRAME_ACTIVE_ATTR] = frame_active_value
 
-        zip_path = _ORA_JSON_SETTINGS_ZIP_PATH
-        helpers.zipfile_writestr(orazip, zip_path, json_data)
-        image.attrib[_ORA_JSON_SETTINGS_ATTR] = zip_path
+            # Document-specific settings dict.
+            if settings is not None:
 
-    # MyPaint version
-    image.attrib[_ORA_MYPAINT_VERSION] = lib.meta.MYPAINT_VERSION
+                # Py2/Py3: always feed writestr() a UTF-8 encoded byte string.
+                json_data = json.dumps(dict(settings), indent=2)
+                if isinstance(json_data, unicode):
+                    json_data = json_data.encode("utf-8")
+                assert isinstance(json_data, bytes)
 
-    # Resolution info
-    if xres and yres:
-        image.attrib["xres"] = str(xres)
-        image.attrib["yres"] = str(yres)
+                zip_path = _ORA_JSON_SETTINGS_ZIP_PATH
+                helpers.zipfile_writestr(orazip, zip_path, json_data)
+                image.attrib[_ORA_JSON_SETTINGS_ATTR] = zip_path
 
-    # OpenRaster version declaration
-    image.attrib["version"] = lib.xml.OPENRASTER_VERSION
+            # MyPaint version
+            image.attrib[_ORA_MYPAINT_VERSION] = lib.meta.MYPAINT_VERSION
 
-    # Last 10%: previews.
-    # Thumbnail preview (256x256)
-    thumbnail = root_stack.render_thumbnail(
-        bbox,
-        progress=progress.open(1),
-    )
-    tmpfile = join(tempdir, "tmp.png")
-    lib.pixbuf.save(thumbnail, tmpfile, "png")
-    orazip.write(tmpfile, "Thumbnails/thumbnail.png")
-    os.remove(tmpfile)
-
-    # Save fully rendered image too
-    tmpfile = os.path.join(tempdir, "mergedimage.png")
-    root_stack.save_as_png(
-        tmpfile,
-        *bbox,
-        alpha=False,
-        background=True,
-        progress=progress.open(9),
-        **kwargs
-    )
-    orazip.write(tmpfile, "mergedimage.png")
-    os.remove(tmpfile)
+            # Resolution info
+            if xres and yres:
+                image.attrib["xres"] = str(xres)
+                image.attrib["yres"] = str(yres)
 
-    # Prettification
-    lib.xml.indent_etree(image)
-    xml = ET.tostring(image, encoding="UTF-8")
+            # OpenRaster version declaration
+            image.attrib["version"] = lib.xml.OPENRASTER_VERSION
 
-    # Finalize
-    helpers.zipfile_writestr(orazip, "stack.xml", xml)
-    orazip.close()
-    os.rmdir(tempdir)
+            # Last 10%: previews.
+            # Thumbnail preview (256x256)
+            thumbnail = root_stack.render_thumbnail(
+                bbox,
+                progress=progress.open(1),
+            )
+            tmpfile = join(tempdir, "tmp.png")
+            lib.pixbuf.save(thumbnail, tmpfile, "png")
+            helpers.zipfile_write_tempfile(orazip, tmpfile, "Thumbnails/thumbnail.png")
+
+            # Save fully rendered image too
+            tmpfile = os.path.join(tempdir, "mergedimage.png")
+            root_stack.save_as_png(
+                tmpfile,
+                *bbox,
+                alpha=False,
+                background=True,
+                progress=progress.open(9),
+                **kwargs
+            )
+            helpers.zipfile_write_tempfile(orazip, tmpfile, "mergedimage.png")
+
+            # Prettification
+            lib.xml.indent_etree(image)
+            xml = ET.tostring(image, encoding="UTF-8")
+
+            # Finalize
+            helpers.zipfile_writestr(orazip, "stack.xml", xml)
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+    if written_keys is not None:
+        written_keys.update(orazip.written_keys)
 
     progress.close()
     return thumbnail
@@ -41,6 +41,9 @@ static void
 png_write_error_callback (png_structp png_save_ptr,
                           png_const_charp error_msg)
 {
+    // write() releases the GIL while encoding rows, so take it back
+    // before touching the Python error state.
+    PyGILState_STATE gstate = PyGILState_Ensure();
     // we don't trust libpng to call the error callback only once, so
     // check for already-set error
     if (!PyErr_Occurred()) {
@@ -51,6 +54,7 @@ png_write_error_callback (png_structp png_save_ptr,
             PyErr_Format(PyExc_RuntimeError, "Error writing PNG: %s", error_msg);
         }
     }
+    PyGILState_Release(gstate);
     longjmp (png_jmpbuf(png_save_ptr), 1);
 }
 
@@ -252,8 +256,11 @@ ProgressivePNGWriter::write(PyObject *arr_obj)
     png_bytep rowdata = NULL;
     png_bytep row_p = NULL;
     int row = 0;
+    bool too_many_rows = false;
     char *err_text = NULL;
     PyObject *err_type = PyExc_RuntimeError;
+    // Set while the GIL is released; volatile because of setjmp().
+    PyThreadState * volatile thread_state = NULL;
 
     if (! state) {
         err_type = PyExc_RuntimeError;
@@ -294,6 +301,10 @@ ProgressivePNGWriter::write(PyObject *arr_obj)
     assert(PyArray_STRIDE(arr, 2) == 1);
 
     if (setjmp(png_jmpbuf(state->png_ptr))) {
+        if (thread_state) {
+            PyEval_RestoreThread(thread_state);
+            thread_state = NULL;
+        }
         if (PyErr_Occurred()) {
             state->cleanup();
             return NULL;
@@ -306,19 +317,26 @@ ProgressivePNGWriter::write(PyObject *arr_obj)
     rowstride = PyArray_STRIDE(arr, 0);
     rowdata = (png_bytep)PyArray_DATA(arr);
     row_p = (png_bytep)rowdata;
+
+    // Compression is the slow part, and it doesn't need Python, so
+    // other threads can encode their own PNGs at the same time.
+    thread_state = PyEval_SaveThread();
     for (row=0; row<rowcount; row++) {
         png_write_row(state->png_ptr, row_p);
-        if (! state->check_valid()) {
-            state->cleanup();
-            return NULL;
-        }
         row_p += rowstride;
         if (++(state->y) > state->height) {
-            err_type = PyExc_RuntimeError;
-            err_text = "too many pixel rows written";
-            goto errexit;
+            too_many_rows = true;
+            break;
         }
     }
+    PyEval_RestoreThread(thread_state);
+    thread_state = NULL;
+
+    if (too_many_rows) {
+        err_type = PyExc_RuntimeError;
+        err_text = "too many pixel rows written";
+        goto errexit;
+    }
     Py_RETURN_NONE;
 
   errexit:
@@ -376,6 +394,9 @@ static void
 png_read_error_callback (png_structp png_read_ptr,
                          png_const_charp error_msg)
 {
+    // The progressive loader releases the GIL while decoding rows,
+    // so take it back before touching the Python error state.
+    PyGILState_STATE gstate = PyGILState_Ensure();
     // we don't trust libpng to call the error callback only once, so
     // check for already-set error
     if (!PyErr_Occurred()) {
@@ -388,6 +409,7 @@ png_read_error_callback (png_structp png_read_ptr,
                          error_msg);
         }
     }
+    PyGILState_Release(gstate);
     longjmp (png_jmpbuf(png_read_ptr), 1);
 }
 
@@ -438,6 +460,8 @@ load_png_fast_progressive (char *filename,
     FILE *fp = NULL;
     uint32_t width, height;
     uint32_t rows_left;
+    // Set while the GIL is released; volatile because of setjmp().
+    PyThreadState * volatile thread_state = NULL;
     png_byte color_type;
     png_byte bit_depth;
     bool have_alpha;
@@ -527,6 +551,10 @@ load_png_fast_progressive (char *filename,
     }
 
     if (setjmp(png_jmpbuf(png_ptr))) {
+        if (thread_state) {
+            PyEval_RestoreThread(thread_state);
+            thread_state = NULL;
+        }
         goto cleanup;
     }
 
@@ -827,7 +855,11 @@ load_png_fast_progressive (char *filename,
             }
         }
 
-        // Populate the strip of memory with pixels decoded from the PNG stream
+        // Populate the strip of memory with pixels decoded from the PNG stream.
+        // Decoding doesn't need Python, so other threads can process the
+        // previous strips meanwhile. The callback's array is kept alive
+        // by our reference to it.
+        thread_state = PyEval_SaveThread();
         png_read_rows(png_ptr, row_pointers, NULL, rows);
         rows_left -= rows;
 
@@ -857,6 +889,8 @@ load_png_fast_progressive (char *filename,
             }
             free(input_buffer);
         }
+        PyEval_RestoreThread(thread_state);
+        thread_state = NULL;
         free(row_pointers);
         Py_DECREF(obj);
     } //while (rows_left)
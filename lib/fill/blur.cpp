@@ -12,6 +12,14 @@
 
 #include <cmath>
 
+// Standard deviation of the gaussian for a nominal blur radius
+static float
+blur_sigma(int r)
+{
+    // Equations nicked from Krita
+    return 0.3 * r + 0.3;
+}
+
 // Generate gaussian multiplicands used for blurring.
 // They are stored and used with fixed-point arithmetic
 static const std::vector<fix15_short_t>
@@ -19,8 +27,7 @@ blur_factors(int r)
 {
     constexpr double pi = 3.141592653589793;
 
-    // Equations nicked from Krita
-    float sigma = 0.3 * r + 0.3;
+    float sigma = blur_sigma(r);
     int prelim_size = 6 * std::ceil(sigma + 1);
     float mul = 1 / sqrt(2 * pi * sigma * sigma);
     float exp_mul = 1 / (2 * sigma * sigma);
@@ -38,9 +45,89 @@ blur_factors(int r)
     return factors;
 }
 
+// Below this nominal radius, the box cascade differs visibly from the
+// gaussian, and the gaussian's own kernel is short enough to be cheap.
+static const int BOX_BLUR_MIN_RADIUS = 10;
+
+// Number of box blurs approximating one gaussian pass
+static const int BOX_BLUR_PASSES = 3;
+
+// Half-widths of the box blurs whose cascade best approximates
+// a gaussian with the given nominal radius, keeping within the
+// given kernel radius. Empty if the exact gaussian should be used.
+static const std::vector<int>
+box_blur_radii(int r, int kernel_radius, bool exact)
+{
+    std::vector<int> radii;
+    if (exact || r < BOX_BLUR_MIN_RADIUS) return radii;
+
+    // Widths from "Fast Almost-Gaussian Filtering" (Kovesi, 2010):
+    // m boxes of odd width wl and the rest of width wl + 2, chosen so
+    // that the total variance is as close as possible to sigma^2.
+    const int n = BOX_BLUR_PASSES;
+    const double var = blur_sigma(r) * blur_sigma(r);
+    int wl = std::floor(std::sqrt(12 * var / n + 1));
+    if (wl % 2 == 0) wl--;
+    const int wu = wl + 2;
+    const double m_ideal =
+        (12 * var - n * wl * wl - 4 * n * wl - 3 * n) / (-4 * wl - 4);
+    const int m = std::round(m_ideal);
+    int total = 0;
+    for (int i = 0; i < n; ++i) {
+        radii.push_back(((i < m) ? wl : wu) / 2);
+        total += radii.back();
+    }
+    // The input only extends kernel_radius pixels past the tile
+    if (total > kernel_radius) radii.clear();
+    return radii;
+}
+
+// Box blur a row: out[i] is the rounded mean of in[i] .. in[i + 2h]
+static void
+box_blur_row(const chan_t* in, chan_t* out, int n_out, int h)
+{
+    const fix15_t w = 2 * h + 1;
+    fix15_t sum = 0;
+    for (int i = 0; i < 2 * h; ++i) {
+        sum += in[i];
+    }
+    for (int i = 0; i < n_out; ++i) {
+        sum += in[i + 2 * h];
+        out[i] = (sum + h) / w;
+        sum -= in[i];
+    }
+}
+
+// Box blur columns, keeping a running sum per column so that
+// rows are read sequentially: out[y] is the mean of in[y] .. in[y + 2h]
+static void
+box_blur_columns(chan_t** in, chan_t** out, int n_out, int h, fix15_t* sums)
+{
+    const fix15_t w = 2 * h + 1;
+    for (int x = 0; x < N; ++x) {
+        sums[x] = 0;
+    }
+    for (int y = 0; y < 2 * h; ++y) {
+        for (int x = 0; x < N; ++x) {
+            sums[x] += in[y][x];
+        }
+    }
+    for (int y = 0; y < n_out; ++y) {
+        const chan_t* add_row = in[y + 2 * h];
+        const chan_t* sub_row = in[y];
+        chan_t* out_row = out[y];
+        for (int x = 0; x < N; ++x) {
+            sums[x] += add_row[x];
+            out_row[x] = (sums[x] + h) / w;
+            sums[x] -= sub_row[x];
+        }
+    }
+}
+
 // Allocate memory for input and intermediate buffers
-GaussBlurrer::GaussBlurrer(int r)
-    : factors(blur_factors(r)), radius((factors.size() - 1) / 2)
+GaussBlurrer::GaussBlurrer(int r, bool exact)
+    : factors(blur_factors(r)), radius((factors.size() - 1) / 2),
+      box_radii(box_blur_radii(r, radius, exact)), rows_cached(false)
 {
     // Suppress uninitialization warning, the output
     // array is always fully populated before use
@@ -57,6 +144,16 @@ GaussBlurrer::GaussBlurrer(int r)
     for (int i = 0; i < width; ++i) {
         input_vertical[i] = new chan_t[N];
     }
+    output_row = new fix15_t[N];
+    // Ping-pong buffers between the passes of the box cascade
+    box_row_a = new chan_t[width];
+    box_row_b = new chan_t[width];
+    box_rows_a = new chan_t*[width];
+    box_rows_b = new chan_t*[width];
+    for (int i = 0; i < width; ++i) {
+        box_rows_a[i] = box_radii.empty() ? nullptr : new chan_t[N];
+        box_rows_b[i] = box_radii.empty() ? nullptr : new chan_t[N];
+    }
 }
 
 GaussBlurrer::~GaussBlurrer()
@@ -65,9 +162,16 @@ GaussBlurrer::~GaussBlurrer()
     for (int i = 0; i < width; ++i) {
         delete[] input_full[i];
         delete[] input_vertical[i];
+        delete[] box_rows_a[i];
+        delete[] box_rows_b[i];
     }
     delete[] input_full;
     delete[] input_vertical;
+    delete[] output_row;
+    delete[] box_row_a;
+    delete[] box_row_b;
+    delete[] box_rows_a;
+    delete[] box_rows_b;
 }
 
 PyObject*
@@ -75,6 +179,11 @@ GaussBlurrer::blur(bool can_update, GridVector input_grid)
 {
     initiate(can_update, input_grid);
 
+    // The intermediate rows of the tile above can only be reused
+    // if they were calculated, i.e. if that tile wasn't skipped.
+    bool reuse_rows = can_update && rows_cached;
+    rows_cached = false;
+
     if (input_is_fully_opaque()) return ConstTiles::ALPHA_OPAQUE();
 
     if (input_is_fully_transparent()) return ConstTiles::ALPHA_TRANSPARENT();
@@ -84,8 +193,38 @@ GaussBlurrer::blur(bool can_update, GridVector input_grid)
     // Create output buffer
     PixelBuffer<chan_t> out_buf = new_alpha_tile();
 
-    // Blur each row from input to intermediate buffer
-    for (int y = 0; y < N + 2 * r; ++y) {
+    // Shift the overlapping rows up from the previous tile,
+    // the same way initiate() does for the input rows.
+    int first_row = 0;
+    if (reuse_rows) {
+        for (int i = 0; i < r * 2; ++i) {
+            chan_t* tmp = input_vertical[i];
+            input_vertical[i] = input_vertical[N + i];
+            input_vertical[N + i] = tmp;
+        }
+        first_row = r * 2;
+    }
+
+    if (box_radii.empty()) {
+        blur_rows_exact(first_row);
+        rows_cached = true;
+        blur_columns_exact(out_buf);
+    }
+    else {
+        blur_rows_boxed(first_row);
+        rows_cached = true;
+        blur_columns_boxed(out_buf);
+    }
+
+    return out_buf.array_ob;
+}
+
+// Blur each row from input to intermediate buffer
+void
+GaussBlurrer::blur_rows_exact(int first_row)
+{
+    const int r = radius;
+    for (int y = first_row; y < N + 2 * r; ++y) {
         for (int x = 0; x < N; ++x) {
             fix15_t blurred = 0;
             for (int xoffs = -r; xoffs < r + 1; xoffs++) {
@@ -95,20 +234,79 @@ GaussBlurrer::blur(bool can_update, GridVector input_grid)
             input_vertical[y][x] = fix15_short_clamp(blurred);
         }
     }
+}
 
-    // Blur each column from intermediate to output buffer
-    for (int x = 0; x < N; ++x) {
-        for (int y = 0; y < N; ++y) {
-            fix15_t blurred = 0;
-            for (int yoffs = -r; yoffs < r + 1; yoffs++) {
-                fix15_t in = input_vertical[y + yoffs + r][x];
-                blurred += fix15_mul(in, factors[yoffs + r]);
+// Blur columns from intermediate to output buffer, a row at a time
+// so that the intermediate rows are read sequentially.
+void
+GaussBlurrer::blur_columns_exact(PixelBuffer<chan_t>& out_buf)
+{
+    const int r = radius;
+    for (int y = 0; y < N; ++y) {
+        for (int x = 0; x < N; ++x) {
+            output_row[x] = 0;
+        }
+        for (int yoffs = -r; yoffs < r + 1; yoffs++) {
+            const chan_t* in_row = input_vertical[y + yoffs + r];
+            const fix15_t fac = factors[yoffs + r];
+            for (int x = 0; x < N; ++x) {
+                output_row[x] += fix15_mul(in_row[x], fac);
             }
-            out_buf(x, y) = fix15_short_clamp(blurred);
+        }
+        for (int x = 0; x < N; ++x) {
+            out_buf(x, y) = fix15_short_clamp(output_row[x]);
         }
     }
+}
 
-    return out_buf.array_ob;
+// Box blur each row from input to intermediate buffer. The cascade
+// reaches less far than the gaussian's kernel, so the input is read
+// from an offset, and each pass produces a shorter row.
+void
+GaussBlurrer::blur_rows_boxed(int first_row)
+{
+    int reach = 0;
+    for (int h : box_radii) {
+        reach += h;
+    }
+    const int offset = radius - reach;
+    for (int y = first_row; y < N + 2 * radius; ++y) {
+        const chan_t* src = input_full[y] + offset;
+        int n_out = N + 2 * reach;
+        for (size_t i = 0; i < box_radii.size(); ++i) {
+            const int h = box_radii[i];
+            n_out -= 2 * h;
+            bool last = i + 1 == box_radii.size();
+            chan_t* dst = i % 2 ? box_row_b : box_row_a;
+            if (last) dst = input_vertical[y];
+            box_blur_row(src, dst, n_out, h);
+            src = dst;
+        }
+    }
+}
+
+// Box blur columns from intermediate to output buffer
+void
+GaussBlurrer::blur_columns_boxed(PixelBuffer<chan_t>& out_buf)
+{
+    int reach = 0;
+    for (int h : box_radii) {
+        reach += h;
+    }
+    chan_t** src = input_vertical + (radius - reach);
+    int n_out = N + 2 * reach;
+    for (size_t i = 0; i < box_radii.size(); ++i) {
+        const int h = box_radii[i];
+        n_out -= 2 * h;
+        chan_t** dst = i % 2 ? box_rows_b : box_rows_a;
+        box_blur_columns(src, dst, n_out, h, output_row);
+        src = dst;
+    }
+    for (int y = 0; y < N; ++y) {
+        for (int x = 0; x < N; ++x) {
+            out_buf(x, y) = src[y][x];
+        }
+    }
 }
 
 void
@@ -160,11 +358,11 @@ blur_strand(
 
 void
 blur_worker(
-    int radius, StrandQueue& queue, AtomicDict tiles,
+    int radius, bool exact, StrandQueue& queue, AtomicDict tiles,
     std::promise<AtomicDict> result, Controller& status_controller)
 {
     AtomicDict blurred;
-    GaussBlurrer bucket(radius);
+    GaussBlurrer bucket(radius, exact);
     Strand strand;
     while (status_controller.running() && queue.pop(strand)) {
         blur_strand(strand, tiles, bucket, blurred, status_controller);
@@ -176,16 +374,24 @@ blur_worker(
 void
 blur(
     int radius, PyObject* blurred, PyObject* tiles, PyObject* strands,
-    Controller& status_controller)
+    Controller& status_controller, bool exact)
 {
     if (radius <= 0 || !PyDict_Check(tiles) || !PyList_CheckExact(strands)) {
         printf("Invalid blur parameters!\n");
         return;
     }
 
+    auto worker = [exact](
+                      int radius, StrandQueue& queue, AtomicDict tiles,
+                      std::promise<AtomicDict> result,
+                      Controller& status_controller) {
+        blur_worker(
+            radius, exact, queue, tiles, std::move(result), status_controller);
+    };
+
     const int min_strands_per_worker = 2;
     StrandQueue work_queue(strands);
     process_strands(
-        blur_worker, radius, min_strands_per_worker, std::ref(work_queue),
+        worker, radius, min_strands_per_worker, std::ref(work_queue),
         AtomicDict(tiles), AtomicDict(blurred), status_controller);
 }
@@ -19,11 +19,20 @@
   The blur is performed in two passes. First the full input is blurred
   horizontally, writing the output to an intermediate array. Secondly the
   intermediate array is blurred vertically, writing the output into a new tile.
+
+  When working down a strand, the top 2*radius rows of the intermediate
+  array are the bottom rows of the previous tile's, and are reused instead
+  of being blurred again.
+
+  For larger radii, each pass approximates the gaussian with a cascade of
+  three box blurs, using running sums. The cost per pixel then does not
+  depend on the radius. Small radii, or exact=true, use the gaussian
+  multiplicands directly.
 */
 class GaussBlurrer
 {
   public:
-    explicit GaussBlurrer(int radius);
+    GaussBlurrer(int radius, bool exact);
     ~GaussBlurrer();
     PyObject* blur(bool can_update, GridVector input);
 
@@ -34,12 +43,28 @@ class GaussBlurrer
     // to the tiles in the most recent call to initiate
     bool input_is_fully_opaque();
     bool input_is_fully_transparent();
+    // Horizontal and vertical passes, for the two kinds of blur
+    void blur_rows_exact(int first_row);
+    void blur_columns_exact(PixelBuffer<chan_t>& out_buf);
+    void blur_rows_boxed(int first_row);
+    void blur_columns_boxed(PixelBuffer<chan_t>& out_buf);
     // Blur factors used to calculate the value of every blurred pixel
     // based on its horizontal
     const std::vector<fix15_short_t> factors;
     const int radius;
+    // Half-widths of the box cascade, empty if the exact blur is used
+    const std::vector<int> box_radii;
     chan_t** input_full;
     chan_t** input_vertical;
+    // Row accumulator for the vertical pass
+    fix15_t* output_row;
+    // Intermediate buffers for the box cascade (unused if exact)
+    chan_t* box_row_a;
+    chan_t* box_row_b;
+    chan_t** box_rows_a;
+    chan_t** box_rows_b;
+    // Whether input_vertical holds the previous tile's horizontal blur
+    bool rows_cached;
 };
 
 
@@ -23,7 +23,8 @@ void blur(
     PyObject* blurred, // Dictionary holding the result of the operation
     PyObject* tiles, // Input tiles, NxNx1 uint16 numpy arrays
     PyObject* strands, // List of lists of vertically contiguous coordinates
-    Controller& status_controller // cancellation and status data
+    Controller& status_controller, // cancellation and status data
+    bool exact = false // Always use the gaussian, not the box approximation
     );
 
 #endif //BLUR_SWIG_HPP
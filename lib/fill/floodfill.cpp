@@ -134,7 +134,7 @@ Filler::pixel_fill_alpha(const rgba& px)
 bool
 Filler::check_enqueue(
     const int x, const int y, bool check, const rgba& src_pixel,
-    const chan_t& dst_pixel)
+    const chan_t& dst_pixel, std::queue<coord>& seed_queue)
 {
     if (dst_pixel != 0) return true;
     bool match = pixel_fill_alpha(src_pixel) > 0;
@@ -172,7 +172,8 @@ Filler::tile_uniformity(bool empty_tile, PyObject* src_arr)
 
 void
 Filler::queue_seeds(
-    PyObject* seeds, PixelBuffer<rgba>& src, PixelBuffer<chan_t> dst)
+    PyObject* seeds, PixelBuffer<rgba>& src, PixelBuffer<chan_t> dst,
+    std::queue<coord>& seed_queue)
 {
     Py_ssize_t num_seeds = PySequence_Size(seeds);
     for (Py_ssize_t i = 0; i < num_seeds; ++i) {
@@ -198,7 +199,7 @@ Filler::queue_seeds(
 void
 Filler::queue_ranges(
     edge origin, PyObject* seeds, bool input_marks[N], PixelBuffer<rgba>& src,
-    PixelBuffer<chan_t>& dst)
+    PixelBuffer<chan_t>& dst, std::queue<coord>& seed_queue)
 {
 #ifdef HEAVY_DEBUG
     assert(PySequence_Check(seeds));
@@ -291,10 +292,11 @@ Filler::fill(
     // prior to constructing the output seed segment lists
     bool input_seeds[N] = {0,};
 
+    std::queue<coord> seed_queue;
     if (seed_origin == edges::none) { // Initial seeds, a list of coordinates
-        queue_seeds(seeds, src, dst);
+        queue_seeds(seeds, src, dst, seed_queue);
     } else {
-        queue_ranges(seed_origin, seeds, input_seeds, src, dst);
+        queue_ranges(seed_origin, seeds, input_seeds, src, dst, seed_queue);
     } // Seed queue populated
 
     // 0-initialized arrays used to mark points reached on
@@ -303,7 +305,9 @@ Filler::fill(
     bool _n[N] = {0,}, _e[N] = {0,}, _s[N] = {0,}, _w[N] = {0,};
     bool* edge_marks[] = {_n, _e, _s, _w};
 
-    // Fill loop
+    // Fill loop: no Python API use, so other threads can run meanwhile.
+    // The caller keeps src_o and dst_o alive for the duration.
+    Py_BEGIN_ALLOW_THREADS
     while (!seed_queue.empty()) {
 
         int x0 = seed_queue.front().x;
@@ -342,13 +346,15 @@ Filler::fill(
 
                 if (y > 0) {
                     look_above = check_enqueue( //check/enqueue above
-                        x, y-1, look_above, src_px.above(), dst_px.above());
+                        x, y-1, look_above, src_px.above(), dst_px.above(),
+                        seed_queue);
                 } else {
                     _n[x] = true; // On northern edge
                 }
                 if (y < (N - 1)) {
                     look_below = check_enqueue( // check/enqueue below
-                        x, y+1, look_below, src_px.below(), dst_px.below());
+                        x, y+1, look_below, src_px.below(), dst_px.below(),
+                        seed_queue);
                 } else {
                     _s[x] = true; // On southern edge
                 }
@@ -361,6 +367,7 @@ Filler::fill(
             }
         }
     }
+    Py_END_ALLOW_THREADS
 
     if (seed_origin != edges::none) {
         // Remove incoming seeds from outgoing seeds
@@ -395,6 +402,8 @@ rgba_tile_from_alpha_tile(
     PyObject* dst_arr = PyArray_ZEROS(3, dims, NPY_USHORT, 0);
     PixelBuffer<rgba> dst_buf(dst_arr);
     PixelBuffer<chan_t> src_buf(src);
+    // Pure pixel work: let other threads composite their tiles meanwhile
+    Py_BEGIN_ALLOW_THREADS
     for (int y = min_y; y <= max_y; ++y) {
         int x = min_x;
         PixelRef<chan_t> src_px = src_buf.get_pixel(x, y);
@@ -403,5 +412,6 @@ rgba_tile_from_alpha_tile(
             dst_px.write(rgba(fill_r, fill_g, fill_b, src_px.read()));
         }
     }
+    Py_END_ALLOW_THREADS
     return dst_arr;
 }
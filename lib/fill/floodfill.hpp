@@ -28,6 +28,10 @@ typedef edges::edge edge;
 /*
   Implements the pixel threshold test function and uses it in the
   fill, alpha flooding, and tile uniformity/fillability methods
+
+  A Filler holds no state between calls, so one instance can be used
+  by several threads at once. The scanline part of fill() runs with
+  the GIL released.
 */
 class Filler
 {
@@ -35,7 +39,6 @@ class Filler
     const rgba target_color;
     const rgba target_color_premultiplied;
     const fix15_t tolerance;
-    std::queue<coord> seed_queue;
 
   public:
     Filler(int targ_r, int targ_g, int targ_b, int targ_a, double tol);
@@ -60,20 +63,22 @@ class Filler
     chan_t pixel_fill_alpha(const rgba& src_px);
     // Queue seeds from a python list of (x, y) coordinate tuples
     void queue_seeds(
-        PyObject* seeds, PixelBuffer<rgba>& src, PixelBuffer<chan_t> dst);
+        PyObject* seeds, PixelBuffer<rgba>& src, PixelBuffer<chan_t> dst,
+        std::queue<coord>& seed_queue);
     // Queue seeds from a python list of [start, end] range tuples
     // paired with an input origin direction indicating the side of
     // the tile that the ranges apply to.
     // Ranges are left->right, top->down, and end-inclusive.
     void queue_ranges(
         edge direction, PyObject* seeds, bool marks[N],
-        PixelBuffer<rgba>& src, PixelBuffer<chan_t>& dst);
+        PixelBuffer<rgba>& src, PixelBuffer<chan_t>& dst,
+        std::queue<coord>& seed_queue);
     // Check if a pixel is a valid fill candidate (unfilled & within threshold)
     // Put it in the seed queue if true.
     // Return value means: "enqueue valid neighbours on same row".
     bool check_enqueue(
         const int x, const int y, bool check, const rgba& src_px,
-        const chan_t& dst_px);
+        const chan_t& dst_px, std::queue<coord>& seed_queue);
 };
 
 /*
@@ -10,9 +10,20 @@
 #include "morphology.hpp"
 #include "fill_constants.hpp"
 
+#include <algorithm>
 #include <cmath>
 #include <tuple>
 
+// Below this radius, the chord lookup table is cheap enough
+// that trying the distance based morph first doesn't pay off.
+static const int DISTANCE_MORPH_MIN_RADIUS = 8;
+
+// Pixels which can't be decided by distance are computed directly from
+// the partially opaque input pixels around them, unless the estimated
+// cost of that is more than this fraction of the cost of populating
+// the chord lookup table.
+static const int DISTANCE_MORPH_MAX_COST_FACTOR = 2;
+
 /*
   Get the width of a horizontal chord, located at a given vertical distance
   from the center of the circle for a circular structuring element with the
@@ -29,8 +40,11 @@ chord_width(int radius, int y_offset)
     return 1 + 2 * hw;
 }
 
-Morpher::Morpher(int radius)
-    : radius(radius), height(radius * 2 + 1), se_chords(height)
+Morpher::Morpher(int radius, bool chords_only)
+    : radius(radius), height(radius * 2 + 1), se_chords(height),
+      lut_current(false),
+      use_distance(!chords_only && radius >= DISTANCE_MORPH_MIN_RADIUS),
+      num_partial(0), num_undecided(0)
 {
     // Create structuring element
 
@@ -69,6 +83,21 @@ Morpher::Morpher(int radius)
             lookup_table[h][w] = new chan_t[num_types];
         }
     }
+
+    if (use_distance) {
+        for (int y = 0; y <= radius; ++y) {
+            half_widths.push_back(-se_chords[radius + y].x_offset);
+        }
+        below_lim.resize(N * width);
+        below_any.resize(N * width);
+        above_lim.resize(width);
+        above_any.resize(width);
+        distances.resize(width);
+        spans.resize(N + 1);
+        lim_hits.resize(N * N);
+        any_hits.resize(N * N);
+        partial.resize(width);
+    }
 }
 Morpher::~Morpher()
 {
@@ -189,7 +218,18 @@ Morpher::morph(bool can_update, PixelBuffer<chan_t>& dst)
 {
     const int r = radius;
 
-    if (can_update) {
+    // Decide what can be decided by distance, and skip the lookup
+    // table entirely if the rest is cheap to compute directly.
+    const bool decided = use_distance;
+    if (decided) decide_by_distance<init, lim>();
+    if (decided && partial_cost_is_low()) {
+        morph_from_partial<init, lim, cmp>(dst);
+        // The lookup table must be fully populated on its next use
+        lut_current = false;
+        return;
+    }
+
+    if (can_update && lut_current) {
         populate_row<cmp>(0, 2 * radius);
         rotate_lut();
     } else {
@@ -201,10 +241,16 @@ Morpher::morph(bool can_update, PixelBuffer<chan_t>& dst)
     for (int y = 0; y < N; ++y) {
         for (int x = 0; x < N; ++x) {
             chan_t ext = init;
-            for (int c = 0; c < height; ++c) {
-                chord& ch = se_chords[c];
-                ext = cmp(ext, lookup_table[c][x + ch.x_offset + r][ch.length_index]);
-                if (ext == lim) break;
+            if (decided && lim_hits[y * N + x]) {
+                ext = lim;
+            } else if (!decided || any_hits[y * N + x]) {
+                for (int c = 0; c < height; ++c) {
+                    chord& ch = se_chords[c];
+                    ext = cmp(
+                        ext,
+                        lookup_table[c][x + ch.x_offset + r][ch.length_index]);
+                    if (ext == lim) break;
+                }
             }
             dst_px.write(ext);
             dst_px.move_x(1);
@@ -214,6 +260,155 @@ Morpher::morph(bool can_update, PixelBuffer<chan_t>& dst)
             rotate_lut();
         }
     }
+    lut_current = true;
+}
+
+/*
+  Mark the pixels of an output row which are within the structuring
+  element of an input pixel of interest, given the vertical distance
+  from the row to the nearest such pixel in each input column (any
+  distance larger than the radius meaning that there is none).
+*/
+void
+Morpher::spread_row(const int* dists, char* hits)
+{
+    const int r = radius;
+    std::fill(spans.begin(), spans.end(), 0);
+    for (int x = 0; x < N + 2 * r; ++x) {
+        if (dists[x] > r) continue;
+        const int hw = half_widths[dists[x]];
+        const int start = MAX(0, x - r - hw);
+        const int end = MIN(N - 1, x - r + hw);
+        if (start > end) continue;
+        spans[start]++;
+        spans[end + 1]--;
+    }
+    int open = 0;
+    for (int x = 0; x < N; ++x) {
+        open += spans[x];
+        hits[x] = open > 0;
+    }
+}
+
+/*
+  Find the output pixels which can reach a limit valued input pixel,
+  and those which can only reach initial valued input pixels, using
+  distances, and collect the partially opaque input pixels. The cost
+  of this is proportional to the size of the input, whatever the radius.
+*/
+template <chan_t init, chan_t lim>
+void
+Morpher::decide_by_distance()
+{
+    const int r = radius;
+    const int width = N + 2 * r;
+    const int far = r + 1;
+
+    // Vertical distances to the nearest pixels of interest below (or at)
+    // each pixel of the rows corresponding to output rows.
+    for (int x = 0; x < width; ++x) {
+        above_lim[x] = far;
+        above_any[x] = far;
+    }
+    for (int y = width - 1; y >= r; --y) {
+        const chan_t* row = input[y];
+        for (int x = 0; x < width; ++x) {
+            const chan_t v = row[x];
+            above_lim[x] = v == lim ? 0 : MIN(above_lim[x] + 1, far);
+            above_any[x] = v != init ? 0 : MIN(above_any[x] + 1, far);
+        }
+        if (y < r + N) {
+            std::copy(
+                above_lim.begin(), above_lim.end(),
+                below_lim.begin() + (y - r) * width);
+            std::copy(
+                above_any.begin(), above_any.end(),
+                below_any.begin() + (y - r) * width);
+        }
+    }
+
+    // Combine with the distances looking up, and mark the output pixels
+    // which are within the structuring element of a pixel of interest.
+    for (int x = 0; x < width; ++x) {
+        above_lim[x] = far;
+        above_any[x] = far;
+    }
+    num_partial = 0;
+    num_undecided = 0;
+    for (int y = 0; y < width; ++y) {
+        const chan_t* row = input[y];
+        std::vector<std::pair<int, chan_t>>& row_partial = partial[y];
+        row_partial.clear();
+        for (int x = 0; x < width; ++x) {
+            const chan_t v = row[x];
+            above_lim[x] = v == lim ? 0 : MIN(above_lim[x] + 1, far);
+            above_any[x] = v != init ? 0 : MIN(above_any[x] + 1, far);
+            if (v != init && v != lim) {
+                row_partial.push_back(std::make_pair(x, v));
+            }
+        }
+        num_partial += row_partial.size();
+        if (y < r || y >= r + N) continue;
+        const int out_y = y - r;
+        char* row_lim_hits = &lim_hits[out_y * N];
+        char* row_any_hits = &any_hits[out_y * N];
+        for (int x = 0; x < width; ++x) {
+            distances[x] = MIN(above_lim[x], below_lim[out_y * width + x]);
+        }
+        spread_row(&distances[0], row_lim_hits);
+        for (int x = 0; x < width; ++x) {
+            distances[x] = MIN(above_any[x], below_any[out_y * width + x]);
+        }
+        spread_row(&distances[0], row_any_hits);
+        for (int x = 0; x < N; ++x) {
+            num_undecided += row_any_hits[x] && !row_lim_hits[x];
+        }
+    }
+}
+
+/*
+  Whether computing the undecided pixels from the partially opaque input
+  pixels is likely to be cheaper than populating the lookup table.
+*/
+bool
+Morpher::partial_cost_is_low()
+{
+    const long cost = (long)num_undecided * (height + num_partial);
+    const long lut_cost = (long)N * (N + 2 * radius) * se_lengths.size();
+    return cost * DISTANCE_MORPH_MAX_COST_FACTOR <= lut_cost;
+}
+
+/*
+  Write the output of a morph after decide_by_distance(), computing
+  the undecided pixels directly from the partially opaque input pixels
+  within their structuring elements.
+*/
+template <chan_t init, chan_t lim, op cmp>
+void
+Morpher::morph_from_partial(PixelBuffer<chan_t>& dst)
+{
+    const int r = radius;
+    PixelRef<chan_t> dst_px = dst.get_pixel(0, 0);
+    for (int y = 0; y < N; ++y) {
+        for (int x = 0; x < N; ++x) {
+            chan_t ext = init;
+            if (lim_hits[y * N + x]) {
+                ext = lim;
+            } else if (any_hits[y * N + x]) {
+                const int cx = x + r;
+                for (int c = 0; c < height; ++c) {
+                    const int hw = half_widths[abs(c - r)];
+                    for (auto& px : partial[y + c]) {
+                        if (abs(px.first - cx) <= hw) {
+                            ext = cmp(ext, px.second);
+                        }
+                    }
+                }
+            }
+            dst_px.write(ext);
+            dst_px.move_x(1);
+        }
+    }
 }
 
 void
@@ -323,11 +518,11 @@ morph_strand(
 
 void
 morph_worker(
-    int offset, StrandQueue& queue, AtomicDict tiles,
+    int offset, bool chords_only, StrandQueue& queue, AtomicDict tiles,
     std::promise<AtomicDict> result, Controller& status_controller)
 {
     AtomicDict morphed;
-    Morpher bucket(abs(offset));
+    Morpher bucket(abs(offset), chords_only);
     Strand strand;
     while (status_controller.running() && queue.pop(strand)) {
         morph_strand(offset, strand, tiles, bucket, morphed, status_controller);
@@ -341,17 +536,27 @@ morph_worker(
 void
 morph(
     int offset, PyObject* morphed, PyObject* tiles, PyObject* strands,
-    Controller& status_controller)
+    Controller& status_controller, bool chords_only)
 {
     if (offset == 0 || offset > N || offset < -N || !PyDict_Check(tiles) ||
         !PyList_CheckExact(strands)) {
         printf("Invalid morph parameters!\n");
         return;
     }
+
+    auto worker = [chords_only](
+                      int offset, StrandQueue& queue, AtomicDict tiles,
+                      std::promise<AtomicDict> result,
+                      Controller& status_controller) {
+        morph_worker(
+            offset, chords_only, queue, tiles, std::move(result),
+            status_controller);
+    };
+
     const int min_strands_per_worker = 4;
     StrandQueue work_queue (strands);
     process_strands(
-        morph_worker, offset, min_strands_per_worker, work_queue,
+        worker, offset, min_strands_per_worker, std::ref(work_queue),
         AtomicDict(tiles), AtomicDict(morphed), status_controller);
 }
 
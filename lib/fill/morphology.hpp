@@ -13,6 +13,9 @@
 #include "fill_common.hpp"
 #include "morphology_swig.hpp"
 
+#include <utility>
+#include <vector>
+
 /*
   Chords make up the structuring elements used to perform morphological
   transformations (erosion/dilation etc.).
@@ -44,12 +47,21 @@ typedef chan_t op(chan_t, chan_t);
   for the given radius - rotated/updated whenever possible.
 
   Output array to store morphed alpha values (consider removing/replacing).
+
+  For larger radii, most output pixels are decided by distances first:
+  a pixel is set to the limit value if there is a limit valued input pixel
+  within the structuring element, and left at the initial value if every
+  input pixel within it has the initial value. Both tests are separable,
+  so their cost does not grow with the radius. The pixels in between,
+  which see partially opaque input pixels but no limit valued ones, are
+  computed directly from those input pixels if there are few enough of
+  them, or with the lookup table if not. The output is the same either way.
 */
 
 class Morpher
 {
   public:
-    explicit Morpher(int radius);
+    explicit Morpher(int radius, bool chords_only = false);
     ~Morpher();
     template <chan_t init, chan_t lim, op cmp>
     void morph(bool can_update, PixelBuffer<chan_t>& dst);
@@ -63,6 +75,12 @@ class Morpher
     void rotate_lut();
     template <op cmp>
     void populate_row(int, int);
+    void spread_row(const int* dists, char* hits);
+    template <chan_t init, chan_t lim>
+    void decide_by_distance();
+    bool partial_cost_is_low();
+    template <chan_t init, chan_t lim, op cmp>
+    void morph_from_partial(PixelBuffer<chan_t>& dst);
 
     int radius; // structuring element radius
     int height; // structuring element height
@@ -70,6 +88,23 @@ class Morpher
     std::vector<int> se_lengths; // structuring element chord lengths
     chan_t*** lookup_table; // lookup table for UW algorithm (y-offset, x, type)
     chan_t** input; // input 2d array populated by 3x3 input tile grid
+    bool lut_current; // lookup table was used for the last morph
+
+    // Distance based morph data, only allocated if it is used
+    bool use_distance; // try decide_by_distance() for this radius
+    std::vector<int> half_widths; // chord half width by vertical distance
+    std::vector<int> below_lim; // N x width vertical distances (looking down)
+    std::vector<int> below_any;
+    std::vector<int> above_lim; // width running vertical distances
+    std::vector<int> above_any;
+    std::vector<int> distances; // width combined vertical distances
+    std::vector<int> spans; // N + 1 span start/end counts
+    std::vector<char> lim_hits; // N x N pixels reaching a limit value
+    std::vector<char> any_hits; // N x N pixels reaching a non-initial value
+    // Partially opaque input pixels, (x, value) by input row
+    std::vector<std::vector<std::pair<int, chan_t>>> partial;
+    int num_partial; // number of partially opaque input pixels
+    int num_undecided; // number of output pixels not decided by distance
 };
 
 #endif //MORPHOLOGY_HPP
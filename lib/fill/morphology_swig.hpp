@@ -22,7 +22,8 @@ void morph(
     PyObject* morphed, // Dictionary holding the result of the operation
     PyObject* tiles, // Input tiles, NxNx1 uint16 numpy arrays
     PyObject* strands, // Strands of contiguous tile coordinates
-    Controller& status_controller // cancellation and status data
+    Controller& status_controller, // cancellation and status data
+    bool chords_only = false // Never use the distance based morph
     );
 
 #endif //MORPHOLOGY_SWIG_HPP
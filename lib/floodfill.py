@@ -9,6 +9,11 @@
 """This module implements tile-based floodfill and related operations."""
 
 import logging
+import contextlib
+import multiprocessing
+from collections import deque
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import threading
@@ -42,6 +47,53 @@ _GAPLESS_TILE.flags.writeable = False
 
 EDGE = myplib.edges
 
+#: Number of threads used for the per-tile stages of a fill.
+#: A value of 1 means that tiles are processed serially.
+try:
+    DEFAULT_FILL_THREADS = min(4, multiprocessing.cpu_count())
+except NotImplementedError:
+    DEFAULT_FILL_THREADS = 1
+
+#: Most tiles a fill preview may cover, at the level it's run at.
+#: Keeps the preview's fill within a frame or so. See preview_level().
+PREVIEW_MAX_TILES = 64
+
+#: Tiles composited per batch of concurrent work.
+_COMPOSITE_BATCH_SIZE = 64
+
+_fill_pool = None
+_fill_pool_lock = threading.Lock()
+
+
+def _get_fill_pool():
+    """Get the shared fill worker pool, or None if working serially"""
+    global _fill_pool
+    if DEFAULT_FILL_THREADS <= 1:
+        return None
+    with _fill_pool_lock:
+        if _fill_pool is None:
+            _fill_pool = ThreadPoolExecutor(
+                max_workers=DEFAULT_FILL_THREADS,
+                thread_name_prefix="floodfill",
+            )
+    return _fill_pool
+
+
+def _map_tiles(func, jobs):
+    """Call func(*job) for each job, on the fill pool if possible
+
+    :returns: The results, in the same order as the jobs.
+    :rtype: list
+
+    The functions are run concurrently, so each job must only write
+    to tiles that no other job in the same call touches.
+
+    """
+    pool = _get_fill_pool()
+    if pool is None or len(jobs) < 2:
+        return [func(*job) for job in jobs]
+    return list(pool.map(lambda job: func(*job), jobs))
+
 
 class GapClosingOptions:
     """Container of parameters for gap closing fill operations
@@ -58,7 +110,7 @@ def enqueue_overflows(queue, tile_coord, seeds, tiles_bbox, *p):
     """Conditionally add (coordinate, seed list, data...) tuples to a queue.
 
     :param queue: the queue which may be appended
-    :type queue: list
+    :type queue: collections.deque
     :param tile_coord: the 2d coordinate in the middle of the seed coordinates
     :type tile_coord: (int, int)
     :param seeds: 4-tuple of seed lists for n, e, s, w, relative to tile_coord
@@ -263,6 +315,65 @@ class FloodFillArguments(object):
             myplib.CombineDestinationIn,
         ]
 
+    def at_mipmap_level(self, mipmap_level):
+        """Get a copy of these arguments, scaled down to a mipmap level
+
+        :param int mipmap_level: Mipmap level, 0 meaning full size.
+        :rtype: FloodFillArguments
+
+        Positions, the bounding box, and the distance parameters are
+        all divided by 2**mipmap_level. Used for previews.
+
+        >>> args = FloodFillArguments(
+        ...     (100, 50), {(100, 50), (7, 9)}, (0, 0, 0), 0.1, 9, 3, None,
+        ...     myplib.CombineNormal, False, 1.0, False, (8, 8, 400, 200),
+        ... )
+        >>> args2 = args.at_mipmap_level(2)
+        >>> args2.target_pos, sorted(args2.seeds)
+        ((25, 12), [(1, 2), (25, 12)])
+        >>> args2.offset, args2.feather, tuple(args2.bbox)
+        (2, 1, (2, 2, 100, 50))
+
+        """
+        scale = 2**mipmap_level
+
+        def _scale_pos(pos):
+            x, y = pos
+            return (int(x // scale), int(y // scale))
+
+        def _scale_dist(d):
+            return int(round(d / float(scale)))
+
+        gap_closing_options = self.gap_closing_options
+        if gap_closing_options is not None:
+            gap_closing_options = GapClosingOptions(
+                max(1, _scale_dist(gap_closing_options.max_gap_size)),
+                gap_closing_options.retract_seeps,
+            )
+        bbox = self.bbox
+        if bbox is not None:
+            x, y, w, h = bbox
+            x0, y0 = _scale_pos((x, y))
+            x1, y1 = -(-(x + w) // scale), -(-(y + h) // scale)
+            bbox = lib.helpers.Rect(x0, y0, int(x1 - x0), int(y1 - y0))
+        offset = _scale_dist(self.offset)
+        if self.offset and not offset:
+            offset = 1 if self.offset > 0 else -1
+        return FloodFillArguments(
+            target_pos=_scale_pos(self.target_pos),
+            seeds={_scale_pos(p) for p in self.seeds},
+            color=self.color,
+            tolerance=self.tolerance,
+            offset=offset,
+            feather=_scale_dist(self.feather),
+            gap_closing_options=gap_closing_options,
+            mode=self.mode,
+            lock_alpha=self.lock_alpha,
+            opacity=self.opacity,
+            framed=self.framed,
+            bbox=bbox,
+        )
+
     def no_op(self):
         """If true, compositing will never alter the output layer
 
@@ -308,10 +419,27 @@ def _flood_fill(src, args, dst, handler):
     :type dst: lib.tiledsurface.MyPaintSurface
     :param handler: controller used to track state and cancel fill
     :type handler: FillHandler
+    """
+    result = _fill_alphas(src, args, handler)
+    if result is None:
+        return
+    filled, tiles_bbox, trim_result = result
+    if handler.run:
+        composite(handler, args, trim_result, filled, tiles_bbox, dst)
+
+
+def _fill_alphas(src, args, handler):
+    """Run the fill, grow/shrink and feather stages, without compositing
+
+    :returns: The filled alpha tiles, the tile bounding box, and
+        whether to trim the result to the box; or None if there is
+        nothing to fill.
+    :rtype: tuple
+
     """
     _, _, width, height = args.bbox
     if width <= 0 or height <= 0 or args.no_op():
-        return
+        return None
 
     tiles_bbox = fc.TileBoundingBox(args.bbox)
 
@@ -344,8 +472,57 @@ def _flood_fill(src, args, dst, handler):
     # When dilating or blurring the fill, only respect the
     # bounding box limits if they are set by an active frame
     trim_result = args.framed and (offset > 0 or feather != 0)
-    if handler.run:
-        composite(handler, args, trim_result, filled, tiles_bbox, dst)
+    return filled, tiles_bbox, trim_result
+
+
+def preview_level(bbox, max_tiles=PREVIEW_MAX_TILES):
+    """Pick the mipmap level a quick preview of a fill should use
+
+    :param bbox: The bounding box limiting the fill.
+    :param int max_tiles: Most tiles the preview's fill may cover.
+    :returns: The smallest mipmap level with few enough tiles, or 0 if
+        the full-size fill is already small enough not to need one.
+    :rtype: int
+
+    >>> preview_level((0, 0, 4 * N, 4 * N))
+    0
+    >>> preview_level((0, 0, 64 * N, 32 * N))
+    3
+    >>> preview_level((0, 0, 10**9, 10**9)) == lib.tiledsurface.MAX_MIPMAP_LEVEL
+    True
+
+    """
+    x, y, w, h = bbox
+    max_level = lib.tiledsurface.MAX_MIPMAP_LEVEL
+    for level in range(max_level + 1):
+        size = N * 2**level
+        tw = (x + w - 1) // size - x // size + 1
+        th = (y + h - 1) // size - y // size + 1
+        if tw * th <= max_tiles:
+            return level
+    return max_level
+
+
+def preview_fill(src, fill_args):
+    """Fill quickly, without compositing, returning the filled alphas
+
+    :param src: Source surface-like object
+    :type src: anything supporting readonly tile_request()
+    :param fill_args: Arguments, already scaled to src's resolution
+    :type fill_args: FloodFillArguments
+    :returns: Filled alpha tiles, by tile coordinate
+    :rtype: dict
+
+    This runs on the calling thread and can't be cancelled, so src
+    should be small: typically a mipmap of the real fill's source.
+    See lib.tiledsurface.MyPaintSurface.flood_fill_preview().
+
+    """
+    result = _fill_alphas(src, fill_args, FillHandler())
+    if result is None:
+        return {}
+    filled, _tiles_bbox, _trim_result = result
+    return filled
 
 
 def update_bbox(bbox, tx, ty):
@@ -379,6 +556,7 @@ def composite(handler, fill_args, trim_result, filled, tiles_bbox, dst):
     full_rgba = myplib.rgba_tile_from_alpha_tile(
         _FULL_TILE, *(fill_col + (0, 0, N - 1, N - 1))
     )
+    full_color = tuple(full_rgba[0, 0])
 
     # Bounding box of tiles that need updating
     dst_changed_bbox = None
@@ -386,10 +564,11 @@ def composite(handler, fill_args, trim_result, filled, tiles_bbox, dst):
 
     skip_empty_dst = fill_args.skip_empty_dst()
     mode = fill_args.mode
-    lock_alpha = fill_args.lock_alpha
     opacity = fill_args.opacity
 
-    tile_combine = myplib.tile_combine
+    # Tiles which need per-pixel compositing are batched up,
+    # and combined concurrently. See _combine_tiles().
+    batch = []
 
     # Composite filled tiles into the destination surface
     for tile_coord, src_tile in iteritems(filled):
@@ -397,56 +576,59 @@ def composite(handler, fill_args, trim_result, filled, tiles_bbox, dst):
         if not handler.run:
             break
 
-        handler.inc_processed()
-
         # Omit tiles outside of the bounding box _if_ the frame is enabled
         # Note:filled tiles outside bbox only originates from dilation/blur
         if trim_result and tiles_bbox.outside(tile_coord):
+            handler.inc_processed()
             continue
 
         # Skip empty destination tiles for erasing and alpha locking
         # Avoids completely unnecessary tile allocation and copying
         if skip_empty_dst and tile_coord not in dst_tiles:
+            handler.inc_processed()
             continue
 
-        with dst.tile_request(*tile_coord, readonly=False) as dst_tile:
+        # Under certain conditions, direct copies and dict manipulation
+        # can be used instead of compositing operations.
+        cut_off = trim_result and tiles_bbox.crossing(tile_coord)
+        full_inner = src_tile is _FULL_TILE and not cut_off
 
-            # Only at this point might the bounding box need to be updated
+        # Flat fills of whole tiles are stored as just their colour.
+        if full_inner and mode == myplib.CombineNormal and opacity == 1.0:
+            handler.inc_processed()
             dst_changed_bbox = update_bbox(dst_changed_bbox, *tile_coord)
+            dst.fill_tile(tile_coord[0], tile_coord[1], full_color)
+            continue
 
-            # Under certain conditions, direct copies and dict manipulation
-            # can be used instead of compositing operations.
-            cut_off = trim_result and tiles_bbox.crossing(tile_coord)
-            full_inner = src_tile is _FULL_TILE and not cut_off
-            if full_inner:
-                if mode == myplib.CombineNormal and opacity == 1.0:
-                    myplib.tile_copy_rgba16_into_rgba16(full_rgba, dst_tile)
-                    continue
-                elif mode == myplib.CombineDestinationOut and opacity == 1.0:
+        # Only at this point might the bounding box need to be updated
+        dst_changed_bbox = update_bbox(dst_changed_bbox, *tile_coord)
+
+        if full_inner and opacity == 1.0:
+            if mode == myplib.CombineDestinationOut:
+                handler.inc_processed()
+                with dst.tile_request(*tile_coord, readonly=False):
                     dst_tiles.pop(tile_coord)
-                    continue
-                elif mode == myplib.CombineDestinationIn and opacity == 1.0:
-                    continue
-                # Even if opacity != 1.0, we can reuse the full rgba tile
-                src_tile_rgba = full_rgba
-            else:
-                if trim_result:
-                    tile_bounds = tiles_bbox.tile_bounds(tile_coord)
-                else:
-                    tile_bounds = (0, 0, N - 1, N - 1)
-                src_tile_rgba = myplib.rgba_tile_from_alpha_tile(
-                    src_tile, *(fill_col + tile_bounds)
-                )
+                continue
+            elif mode == myplib.CombineDestinationIn:
+                handler.inc_processed()
+                with dst.tile_request(*tile_coord, readonly=False):
+                    pass
+                continue
+
+        if full_inner:
+            # Even if opacity != 1.0, we can reuse the full rgba tile
+            tile_bounds = None
+        elif trim_result:
+            tile_bounds = tiles_bbox.tile_bounds(tile_coord)
+        else:
+            tile_bounds = (0, 0, N - 1, N - 1)
+        batch.append((tile_coord, src_tile, tile_bounds))
+        if len(batch) >= _COMPOSITE_BATCH_SIZE:
+            _combine_tiles(handler, fill_args, full_rgba, batch, dst)
+            batch = []
 
-            # If alpha locking is enabled in combination with a mode other than
-            # CombineNormal, we need to copy the dst tile to mask the result
-            if lock_alpha and mode != myplib.CombineSourceAtop:
-                mask = np.copy(dst_tile)
-                mask_mode = myplib.CombineDestinationAtop
-                tile_combine(mode, src_tile_rgba, dst_tile, True, opacity)
-                tile_combine(mask_mode, mask, dst_tile, True, 1.0)
-            else:
-                tile_combine(mode, src_tile_rgba, dst_tile, True, opacity)
+    if batch and handler.run:
+        _combine_tiles(handler, fill_args, full_rgba, batch, dst)
 
     # Handle dst-out and dst-atop: clear untouched tiles
     if mode in [myplib.CombineDestinationIn, myplib.CombineDestinationAtop]:
@@ -476,6 +658,50 @@ def composite(handler, fill_args, trim_result, filled, tiles_bbox, dst):
         GLib.idle_add(dst.notify_observers, *bbox)
 
 
+def _combine_tiles(handler, fill_args, full_rgba, batch, dst):
+    """Composite a batch of filled tiles into dst, concurrently
+
+    :param list batch: (tile_coord, alpha_tile, tile_bounds) tuples;
+        tile_bounds is None to use the full_rgba tile instead.
+
+    The destination tiles are requested and put back by this thread,
+    and only the per-tile pixel work is shared out.
+
+    """
+    fill_col = fill_args.color
+    mode = fill_args.mode
+    lock_alpha = fill_args.lock_alpha
+    opacity = fill_args.opacity
+    tile_combine = myplib.tile_combine
+
+    def _combine(src_tile, tile_bounds, dst_tile):
+        if tile_bounds is None:
+            src_tile_rgba = full_rgba
+        else:
+            src_tile_rgba = myplib.rgba_tile_from_alpha_tile(
+                src_tile, *(fill_col + tile_bounds)
+            )
+        # If alpha locking is enabled in combination with a mode other than
+        # CombineNormal, we need to copy the dst tile to mask the result
+        if lock_alpha and mode != myplib.CombineSourceAtop:
+            mask = np.copy(dst_tile)
+            mask_mode = myplib.CombineDestinationAtop
+            tile_combine(mode, src_tile_rgba, dst_tile, True, opacity)
+            tile_combine(mask_mode, mask, dst_tile, True, 1.0)
+        else:
+            tile_combine(mode, src_tile_rgba, dst_tile, True, opacity)
+        handler.inc_processed()
+
+    with contextlib.ExitStack() as requests:
+        jobs = []
+        for tile_coord, src_tile, tile_bounds in batch:
+            dst_tile = requests.enter_context(
+                dst.tile_request(*tile_coord, readonly=False)
+            )
+            jobs.append((src_tile, tile_bounds, dst_tile))
+        _map_tiles(_combine, jobs)
+
+
 def scanline_fill(handler, src, seed_lists, tiles_bbox, filler):
     """Perform a scanline fill and return the filled tiles
 
@@ -500,38 +726,76 @@ def scanline_fill(handler, src, seed_lists, tiles_bbox, filler):
     inv_edges = (EDGE.south, EDGE.west, EDGE.north, EDGE.east)
 
     # Starting coordinates + direction of origin (from within)
-    tileq = []
+    tileq = deque()
     for seed_tile_coord, seeds in iteritems(seed_lists):
         tileq.append((seed_tile_coord, seeds, myplib.edges.none))
 
     tfs = _TileFillSkipper(tiles_bbox, filler, set({}))
 
+    # The fill proceeds in waves. Each wave takes everything queued
+    # so far, and fills each of its tiles on a worker thread; their
+    # overflows make up the next wave. Tiles are always filled out to
+    # the same connected area whichever order they are visited in, so
+    # the result is the same as that of filling them one at a time.
     while len(tileq) > 0 and handler.run:
-        tile_coord, seeds, from_dir = tileq.pop(0)
-        # Skip if the tile has been fully processed already
-        if tile_coord in tfs.final:
-            continue
-        # Flood-fill one tile
-        with src.tile_request(*tile_coord, readonly=True) as src_tile:
-            # See if the tile can be skipped
-            overflows = tfs.check(tile_coord, src_tile, filled, from_dir)
-            if overflows is None:
+        wave = OrderedDict()
+        while tileq:
+            tile_coord, seeds, from_dir = tileq.popleft()
+            # Skip if the tile has been fully processed already
+            if tile_coord in tfs.final:
+                continue
+            wave.setdefault(tile_coord, []).append((seeds, from_dir))
+        with contextlib.ExitStack() as requests:
+            coords = []
+            jobs = []
+            for tile_coord, tile_seeds in iteritems(wave):
+                src_tile = requests.enter_context(
+                    src.tile_request(*tile_coord, readonly=True)
+                )
+                # See if the tile can be skipped
+                from_dir = tile_seeds[0][1]
+                overflows = tfs.check(tile_coord, src_tile, filled, from_dir)
+                if overflows is not None:
+                    handler.inc_processed()
+                    enqueue_overflows(
+                        tileq, tile_coord, overflows, tiles_bbox, inv_edges
+                    )
+                    continue
                 if tile_coord not in filled:
                     handler.inc_processed()
                     filled[tile_coord] = np.zeros((N, N), "uint16")
-                overflows = filler.fill(
-                    src_tile,
-                    filled[tile_coord],
-                    seeds,
-                    from_dir,
-                    *tiles_bbox.tile_bounds(tile_coord)
+                coords.append(tile_coord)
+                jobs.append(
+                    (
+                        filler,
+                        src_tile,
+                        filled[tile_coord],
+                        tile_seeds,
+                        tiles_bbox.tile_bounds(tile_coord),
+                    )
+                )
+            results = _map_tiles(_fill_tile, jobs)
+        for tile_coord, tile_overflows in zip(coords, results):
+            for overflows in tile_overflows:
+                enqueue_overflows(
+                    tileq, tile_coord, overflows, tiles_bbox, inv_edges
                 )
-            else:
-                handler.inc_processed()
-        enqueue_overflows(tileq, tile_coord, overflows, tiles_bbox, inv_edges)
     return filled
 
 
+def _fill_tile(filler, src_tile, dst_tile, tile_seeds, tile_bounds):
+    """Run the fills for one tile, for each of its (seeds, from_dir) pairs
+
+    :returns: The overflows of each fill, in order.
+    :rtype: list
+
+    """
+    return [
+        filler.fill(src_tile, dst_tile, seeds, from_dir, *tile_bounds)
+        for seeds, from_dir in tile_seeds
+    ]
+
+
 class _TileFillSkipper:
     """Provides checking for, and handling of, uniform tiles"""
 
@@ -613,11 +877,11 @@ def gap_closing_fill(handler, src, seed_lists, tiles_bbox, filler, gap_closing_o
     are marked in separate tiles - one for each tile filled.
     """
 
-    unseep_queue = []
+    unseep_queue = deque()
     filled = {}
     final = set({})
 
-    seed_queue = []
+    seed_queue = deque()
     for seed_tile_coord, seeds in iteritems(seed_lists):
         seed_queue.append((seed_tile_coord, seeds))
 
@@ -629,7 +893,7 @@ def gap_closing_fill(handler, src, seed_lists, tiles_bbox, filler, gap_closing_o
     skip_unseeping = False
 
     while len(seed_queue) > 0 and handler.run:
-        tile_coord, seeds = seed_queue.pop(0)
+        tile_coord, seeds = seed_queue.popleft()
         if tile_coord in final:
             continue
         # Create distance-data and alpha output tiles for the fill
@@ -802,7 +1066,7 @@ def unseep(seed_queue, filled, gc_filler, total_px, tiles_bbox, distances):
     """
     backup = {}
     while len(seed_queue) > 0:
-        tile_coord, seeds, is_initial = seed_queue.pop(0)
+        tile_coord, seeds, is_initial = seed_queue.popleft()
         if tile_coord not in distances or tile_coord not in filled:
             continue
         if tile_coord not in backup:
@@ -16,6 +16,11 @@ import colorsys
 import gc
 import logging
 import sys
+import multiprocessing
+import shutil
+from collections import deque
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 
 from lib.gibindings import GdkPixbuf
 from lib.gettext import C_
@@ -498,12 +503,13 @@ def transform_hsv(hsv, eotf):
     return rgb_to_hsv(r**eotf, g**eotf, b**eotf)
 
 
-def zipfile_writestr(z, arcname, data):
+def zipfile_writestr(z, arcname, data, reuse_key=None):
     """Write a string into a zipfile entry, with standard permissions
 
     :param zipfile.ZipFile z: A zip file open for write.
     :param unicode arcname: Name of the file entry to add.
     :param bytes data: Content to add.
+    :param reuse_key: See OrderedZipWriter.copy_reusable().
 
     Work around bad permissions with the standard
     `zipfile.Zipfile.writestr`: http://bugs.python.org/issue3394. The
@@ -514,7 +520,374 @@ def zipfile_writestr(z, arcname, data):
     zi = zipfile.ZipInfo(arcname)
     zi.external_attr = 0o644 << 16  # wider perms, should match z.write()
     zi.external_attr |= 0o100000 << 16  # regular file
-    z.writestr(zi, data)
+    if isinstance(z, OrderedZipWriter):
+        z.writestr(zi, data, reuse_key=reuse_key)
+    else:
+        z.writestr(zi, data)
+
+
+def zipfile_writestream(z, arcname, write, reuse_key=None):
+    """Write a zipfile entry by streaming data into it
+
+    :param z: A zip file open for write, or an OrderedZipWriter.
+    :param unicode arcname: Name of the file entry to add.
+    :param callable write: Writes the content: called as write(fp),
+        with a binary file-like object open for writing.
+    :param reuse_key: See OrderedZipWriter.copy_reusable().
+
+    This avoids building the whole member in memory first, where the
+    zipfile module allows it. Permissions are as for zipfile_writestr().
+    If `z` is an OrderedZipWriter, `write` is called when the member's
+    turn comes, so anything it reads must not change before then.
+
+    """
+    zi = zipfile.ZipInfo(arcname)
+    zi.external_attr = 0o644 << 16
+    zi.external_attr |= 0o100000 << 16
+    if isinstance(z, OrderedZipWriter):
+        z.writestream(zi, write, reuse_key=reuse_key)
+    else:
+        _zipfile_writestream(z, zi, write)
+
+
+def _zipfile_writestream(z, zinfo, write):
+    if PY2:
+        # ZipFile.open() can't write before Python 3.6
+        buf = BytesIO()
+        write(buf)
+        z.writestr(zinfo, buf.getvalue())
+        return
+    with z.open(zinfo, "w") as fp:
+        write(fp)
+
+
+def zipfile_write_tempfile(
+    z, filename, arcname, produce=None, progress=None, reuse_key=None
+):
+    """Add a temporary file to a zipfile, then delete it
+
+    :param z: A zip file open for write, or an OrderedZipWriter.
+    :param unicode filename: The temporary file to add.
+    :param unicode arcname: Name of the file entry to add.
+    :param callable produce: Creates the file: called as produce(progress).
+    :param progress: Unsized UI feedback object for producing the file.
+    :type progress: lib.feedback.Progress or None
+    :param reuse_key: See OrderedZipWriter.copy_reusable().
+
+    If `z` is an OrderedZipWriter, the file may be produced
+    concurrently with other work, or copied from an earlier zipfile
+    instead of being produced at all. See OrderedZipWriter.write().
+
+    """
+    if isinstance(z, OrderedZipWriter):
+        z.write(
+            filename,
+            arcname,
+            produce=produce,
+            remove=True,
+            progress=progress,
+            reuse_key=reuse_key,
+        )
+        return
+    if produce is not None:
+        produce(progress)
+    z.write(filename, arcname)
+    os.remove(filename)
+
+
+#: Default number of threads an OrderedZipWriter produces files with.
+try:
+    DEFAULT_ZIP_WRITER_THREADS = min(4, multiprocessing.cpu_count())
+except NotImplementedError:
+    DEFAULT_ZIP_WRITER_THREADS = 1
+
+#: Bytes at a time copied when reusing an earlier zipfile's members.
+_ZIP_COPY_CHUNK_SIZE = 1 << 20
+
+
+class OrderedZipWriter(object):
+    """Adds members to a zipfile in order, producing them concurrently
+
+    Some members are expensive to produce, like the layer PNGs of an
+    OpenRaster file. Their producer functions are run on worker
+    threads, but every member is added to the zipfile in the order it
+    was queued, so the result is the same as writing them serially.
+    Only the thread which owns the writer ever touches the zipfile.
+
+    Members can also be copied unchanged from an earlier zipfile,
+    if the caller can name them with a key which changes whenever
+    their content would. See copy_reusable().
+
+    >>> import tempfile, shutil
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> zpath = os.path.join(tmpdir, "test.zip")
+    >>> w = OrderedZipWriter(zipfile.ZipFile(zpath, "w"), threads=3)
+    >>> zipfile_writestr(w, "first", b"1")
+    >>> for i in range(5):
+    ...     fpath = os.path.join(tmpdir, "%d.txt" % (i,))
+    ...     def produce(progress, fpath=fpath, i=i):
+    ...         with open(fpath, "w") as fp:
+    ...             fp.write(str(i))
+    ...     zipfile_write_tempfile(w, fpath, "%d.txt" % (i,), produce)
+    >>> zipfile_writestr(w, "last", b"2")
+    >>> w.close()
+    >>> zipfile.ZipFile(zpath).namelist()
+    ['first', '0.txt', '1.txt', '2.txt', '3.txt', '4.txt', 'last']
+    >>> os.listdir(tmpdir)
+    ['test.zip']
+
+    A second zipfile can reuse the keyed members of the first.
+
+    >>> zpath2 = os.path.join(tmpdir, "test2.zip")
+    >>> z1 = zipfile.ZipFile(zpath)
+    >>> w = OrderedZipWriter(zipfile.ZipFile(zpath2, "w"), reuse_from=(
+    ...     z1, {"key-a": "first"},
+    ... ))
+    >>> w.copy_reusable("renamed", "key-a")
+    True
+    >>> w.copy_reusable("x", "key-b")
+    False
+    >>> zipfile_writestr(w, "x", b"new", reuse_key="key-b")
+    >>> w.close()
+    >>> z1.close()
+    >>> sorted(w.written_keys.items())
+    [('key-a', 'renamed'), ('key-b', 'x')]
+    >>> zipfile.ZipFile(zpath2).read("renamed")
+    b'1'
+
+    Used as a context manager, the writer abandons its queued members
+    and closes the zipfile if an exception is raised.
+
+    >>> def produce_failure(progress):
+    ...     raise IOError("disk full")
+    >>> zpath3 = os.path.join(tmpdir, "test3.zip")
+    >>> try:
+    ...     with OrderedZipWriter(zipfile.ZipFile(zpath3, "w"), threads=2) as w:
+    ...         zipfile_write_tempfile(w, zpath3 + ".tmp", "x", produce_failure)
+    ...         w.flush(wait=True)
+    ... except IOError:
+    ...     pass
+    >>> w._pool is None and w._zip.fp is None
+    True
+    >>> shutil.rmtree(tmpdir)
+
+    """
+
+    def __init__(self, z, threads=None, reuse_from=None):
+        """Initialize, wrapping a zipfile
+
+        :param zipfile.ZipFile z: A zip file open for write.
+        :param int threads: Worker threads, default DEFAULT_ZIP_WRITER_THREADS.
+        :param tuple reuse_from: Earlier zipfile (open for reading),
+            and the dict of reuse keys to its member names.
+
+        With just one thread, everything is written immediately.
+
+        """
+        super(OrderedZipWriter, self).__init__()
+        if threads is None:
+            threads = DEFAULT_ZIP_WRITER_THREADS
+        self._zip = z
+        self._reuse_zip = None
+        self._reusable = {}
+        if reuse_from is not None:
+            self._reuse_zip, self._reusable = reuse_from
+        #: Reuse keys of the members written so far, and their names.
+        #: Pass this as reuse_from next time, with the finished file.
+        self.written_keys = {}
+        self._pool = None
+        if threads > 1:
+            self._pool = ThreadPoolExecutor(
+                max_workers=threads,
+                thread_name_prefix="zipwriter",
+            )
+        self._queue = deque()  # [(future or None, add_func), ...]
+
+    def copy_reusable(self, arcname, reuse_key):
+        """Queue a copy of a member of the earlier zipfile, if possible
+
+        :param unicode arcname: Name of the file entry to add.
+        :param reuse_key: Hashable key naming the content.
+        :returns: True if the member was queued for copying.
+        :rtype: bool
+
+        The member's stored data is copied byte for byte,
+        without being decompressed or recompressed. It is streamed
+        across in chunks, so big members aren't read into memory.
+
+        """
+        if reuse_key is None or self._reuse_zip is None:
+            return False
+        old_name = self._reusable.get(reuse_key)
+        if old_name is None:
+            return False
+        old_zip = self._reuse_zip
+        try:
+            old_info = old_zip.getinfo(old_name)
+        except KeyError:
+            return False
+        if old_info.compress_type != zipfile.ZIP_STORED:
+            return False
+
+        def _add():
+            zi = zipfile.ZipInfo(arcname, date_time=old_info.date_time)
+            zi.external_attr = old_info.external_attr
+            zi.file_size = old_info.file_size
+            with old_zip.open(old_name) as src:
+                _zipfile_writestream(
+                    self._zip,
+                    zi,
+                    lambda fp: shutil.copyfileobj(src, fp, _ZIP_COPY_CHUNK_SIZE),
+                )
+
+        self._queue.append((None, _add))
+        self.written_keys[reuse_key] = arcname
+        self.flush()
+        return True
+
+    def write(
+        self,
+        filename,
+        arcname=None,
+        produce=None,
+        remove=False,
+        progress=None,
+        reuse_key=None,
+    ):
+        """Queue a file to be added to the zipfile
+
+        :param unicode filename: The file to add.
+        :param unicode arcname: Name of the file entry to add.
+        :param callable produce: Creates the file: called as produce(progress).
+        :param bool remove: Delete the file once it has been added.
+        :param progress: Unsized UI feedback object for this member.
+        :type progress: lib.feedback.Progress or None
+        :param reuse_key: See copy_reusable(). If the key's member
+            can be copied, the file is neither produced nor read.
+
+        When producing on a worker thread, `produce` is passed None
+        rather than the progress object, which is then completed when
+        the member is added.
+
+        """
+        if progress is not None:
+            progress.items = 1
+        if produce is not None and self.copy_reusable(arcname, reuse_key):
+            if progress is not None:
+                progress.close()
+            return
+        if reuse_key is not None:
+            self.written_keys[reuse_key] = arcname
+
+        def _add():
+            self._zip.write(filename, arcname)
+            if remove:
+                os.remove(filename)
+            if progress is not None:
+                progress.close()
+
+        future = None
+        if produce is not None:
+            if self._pool is None:
+                produce(progress)
+            else:
+                future = self._pool.submit(produce, None)
+        self._queue.append((future, _add))
+        self.flush()
+
+    def writestr(self, zinfo_or_arcname, data, reuse_key=None):
+        """Queue bytes to be added to the zipfile (see ZipFile.writestr)"""
+        if reuse_key is not None:
+            arcname = getattr(zinfo_or_arcname, "filename", zinfo_or_arcname)
+            self.written_keys[reuse_key] = arcname
+        self._queue.append(
+            (None, lambda: self._zip.writestr(zinfo_or_arcname, data)),
+        )
+        self.flush()
+
+    def writestream(self, zinfo, write, reuse_key=None):
+        """Queue a member to be streamed into the zipfile
+
+        See zipfile_writestream().
+
+        """
+        if reuse_key is not None:
+            self.written_keys[reuse_key] = zinfo.filename
+        self._queue.append(
+            (None, lambda: _zipfile_writestream(self._zip, zinfo, write)),
+        )
+        self.flush()
+
+    def flush(self, wait=False):
+        """Add any finished members to the zipfile, in order
+
+        :param bool wait: Wait for all the queued members to finish.
+
+        Exceptions raised by producers are re-raised here.
+
+        """
+        while self._queue:
+            future, add = self._queue[0]
+            if future is not None:
+                if not (wait or future.done()):
+                    break
+                future.result()
+            self._queue.popleft()
+            add()
+
+    def close(self):
+        """Add all the queued members, then close the zipfile"""
+        try:
+            self.flush(wait=True)
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown(wait=True)
+                self._pool = None
+        self._zip.close()
+
+    def abort(self):
+        """Abandon the queued members, then close the zipfile
+
+        Producers which haven't started are cancelled, and any which
+        are running are waited for, so that the caller can clean up
+        the files they write.
+
+        """
+        try:
+            for future, add in self._queue:
+                if future is not None:
+                    future.cancel()
+            self._queue.clear()
+            if self._pool is not None:
+                self._pool.shutdown(wait=True)
+                self._pool = None
+        finally:
+            self._zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Close normally, or abort if an exception was raised"""
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def zipfile_copy_reusable(z, arcname, reuse_key):
+    """Copy a member from the zipfile an OrderedZipWriter is reusing
+
+    :returns: True if copied, False if the caller must write it.
+    :rtype: bool
+
+    Plain zipfiles never have anything to reuse.
+    See OrderedZipWriter.copy_reusable().
+
+    """
+    if isinstance(z, OrderedZipWriter):
+        return z.copy_reusable(arcname, reuse_key)
+    return False
 
 
 def run_garbage_collector():
@@ -8,12 +8,16 @@
 # (at your option) any later version.
 
 
-"""Non-threaded, prioritizable background processing."""
+"""Prioritizable background processing, in idle time or a thread."""
 
 import collections
+import logging
+import threading
 
 from lib.gibindings import GLib
 
+logger = logging.getLogger(__name__)
+
 
 class Processor(object):
     """Queue of low priority tasks for background processing
@@ -85,3 +89,164 @@ class Processor(object):
         if len(self._queue) == 0:
             self._idle_id = None
         return bool(self._queue)
+
+
+class ThreadedProcessor(object):
+    """Queue of tasks for processing in a background thread
+
+    This has the same interface as `Processor`, but its tasks are run
+    one after the other by a single worker thread, so slow work like
+    encoding and writing files doesn't hold up the GTK main loop.
+
+    Tasks must not touch GTK, or any state the main thread might change
+    while they run. Snapshot everything they need when they're queued.
+
+    When the queue empties, the processor reports back on the main
+    thread via `GLib.idle_add()`. If a task raises an exception, the
+    rest of the queue is abandoned, and the error is reported instead.
+    The processor counts as having work until that report is made.
+
+    Finished and abandoned tasks are released on the main thread too,
+    so that their snapshots' refcounted tiles are only ever dropped
+    there.
+
+    """
+
+    def __init__(self, name="idletask", done_cb=None, error_cb=None):
+        """Initialize, with no thread running yet.
+
+        :param str name: Name for the worker thread.
+        :param callable done_cb: Called as done_cb() when all's done.
+        :param callable error_cb: Called as error_cb(exc) on failure.
+
+        Both callbacks are invoked on the main thread.
+
+        """
+        object.__init__(self)
+        self._name = name
+        self._done_cb = done_cb
+        self._error_cb = error_cb
+        self._queue = collections.deque()
+        self._finished = []  # tasks to release on the main thread
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False  # a task call is in progress
+        self._generation = 0  # bumped by stop()
+        self._error = None
+        self._busy = False  # main thread's view: not yet reported
+
+    def has_work(self):
+        return self._busy
+
+    def add_work(self, func, *args, **kwargs):
+        """Adds work
+
+        :param func: a task callable.
+        :param *args: passed to func
+        :param **kwargs: passed to func
+
+        This starts the worker thread if it isn't already running.
+        Each callable will be called with the given parameters
+        until it returns false, at which point it's discarded.
+
+        """
+        with self._cond:
+            self._queue.append((func, args, kwargs))
+            self._busy = True
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run,
+                    name=self._name,
+                )
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify_all()
+
+    def finish_all(self):
+        """Complete processing: waits for all queued tasks to finish.
+
+        The completion or error callback is invoked before returning.
+
+        """
+        with self._cond:
+            while self._queue or self._running:
+                self._cond.wait()
+        self._report(self._generation)
+        assert len(self._queue) == 0
+
+    def iter_work(self):
+        """Iterate across the queued tasks."""
+        with self._cond:
+            return iter(list(self._queue))
+
+    def stop(self):
+        """Stop processing and clear the queue.
+
+        This waits for any task call that's in progress to return,
+        but no callbacks are invoked for the abandoned work.
+
+        """
+        with self._cond:
+            self._generation += 1
+            self._queue.clear()
+            self._error = None
+            self._busy = False
+            while self._running:
+                self._cond.wait()
+            finished = self._finished
+            self._finished = []
+        del finished[:]
+        assert len(self._queue) == 0
+
+    def _run(self):
+        """Worker thread: process tasks as they're queued."""
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                func, args, kwargs = self._queue[0]
+                generation = self._generation
+                self._running = True
+            error = None
+            func_done = False
+            try:
+                func_done = bool(func(*args, **kwargs))
+            except Exception as e:
+                logger.exception("Background task %r failed", func)
+                error = e
+            with self._cond:
+                self._running = False
+                if generation == self._generation:
+                    if error is not None:
+                        self._error = error
+                        self._finished.extend(self._queue)
+                        self._queue.clear()
+                    elif not func_done:
+                        self._finished.append(self._queue.popleft())
+                    if not self._queue:
+                        GLib.idle_add(self._report, generation)
+                else:
+                    self._finished.append((func, args, kwargs, error))
+                # Only the main thread may drop the last references.
+                del func, args, kwargs, error
+                self._cond.notify_all()
+
+    def _report(self, generation):
+        """Main thread: report that the queue has been emptied."""
+        with self._cond:
+            if generation != self._generation or not self._busy:
+                return False
+            if self._queue or self._running:
+                return False  # more work arrived, report after that
+            self._busy = False
+            error = self._error
+            self._error = None
+            finished = self._finished
+            self._finished = []
+        del finished[:]
+        if error is None:
+            if self._done_cb:
+                self._done_cb()
+        elif self._error_cb:
+            self._error_cb(error)
+        return False
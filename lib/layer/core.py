@@ -684,6 +684,16 @@ class LayerBase(Renderable):
         """
         pass
 
+    def flood_fill_preview(self, fill_args, mipmap_level):
+        """Quickly fills a reduced-size copy of the layer, for previews
+
+        See PaintingLayer.flood_fill_preview() for parameters and
+        return value. The base implementation returns None, meaning
+        that no preview is available.
+
+        """
+        return None
+
     ## Rendering
 
     def get_tile_coords(self):
@@ -702,6 +712,28 @@ class LayerBase(Renderable):
         """
         return []
 
+    def get_tile_stores(self):
+        """Returns the tile stores holding this layer's pixel data
+
+        :returns: lib.tiledsurface.TileStore objects, for accounting
+        :rtype: list
+
+        The base implementation returns an empty list.
+        """
+        return []
+
+    def regenerate_mipmaps(self, max_tiles=0):
+        """Regenerate dirty mipmap tiles ahead of time
+
+        :param int max_tiles: Most tiles to regenerate, 0 for no limit
+        :returns: whether any dirty mipmap tiles remain
+        :rtype: bool
+
+        See lib.tiledsurface.MyPaintSurface.regenerate_mipmaps().
+        The base implementation does nothing, and returns False.
+        """
+        return False
+
     ## Translation
 
     def get_move(self, x, y):
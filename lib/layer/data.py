@@ -24,13 +24,17 @@ from random import randint
 import uuid
 import struct
 import contextlib
+import threading
+from collections import namedtuple
 
+from lib.gibindings import GdkPixbuf
 from lib.brush import BrushInfo
 from lib.gettext import C_
 from lib.tiledsurface import N
 import lib.tiledsurface as tiledsurface
 import lib.strokemap
 import lib.helpers as helpers
+import lib.cache
 import lib.fileutils
 import lib.pixbuf
 import lib.modes
@@ -39,6 +43,7 @@ from . import core
 import lib.layer.error
 import lib.autosave
 import lib.xml
+import lib.eotf
 import lib.feedback
 from . import rendering
 from lib.pycompat import PY3
@@ -94,10 +99,27 @@ class SurfaceBackedLayer(core.LayerBase, lib.autosave.Autosaveable):
         # Only connect observers if using the default tiled surface
         if surface is None:
             self._surface = tiledsurface.Surface()
-            self._surface.observers.append(self._content_changed)
+            self._surface.observers.append(self._surface_changed_cb)
         else:
             self._surface = surface
 
+    @property
+    def _surface(self):
+        """The backing surface, decoded on first use if loaded lazily"""
+        if self.__lazy_source is not None and not self.__lazy_failed:
+            self._load_lazy_source()
+        return self.__surface
+
+    @_surface.setter
+    def _surface(self, surface):
+        self.__surface = surface
+        self._discard_lazy_source()
+
+    def _surface_changed_cb(self, *bbox):
+        """Internal: the surface's pixels changed"""
+        self.autosave_dirty = True
+        self._content_changed(*bbox)
+
     @classmethod
     def new_from_surface_backed_layer(cls, src):
         """Clone from another SurfaceBackedLayer
@@ -191,7 +213,15 @@ class SurfaceBackedLayer(core.LayerBase, lib.autosave.Autosaveable):
         Intended strictly for override by subclasses which need to first
         extract and then keep the file around afterwards.
 
+        Hidden layers are loaded lazily if a cache dir is available:
+        see _defer_orazip_member().
+
         """
+        if self._defer_orazip_member(orazip, cache_dir, src, x, y):
+            if progress:
+                progress.items = 1
+                progress.close()
+            return
         pixbuf = lib.pixbuf.load_from_zipfile(
             datazip=orazip,
             filename=src,
@@ -244,6 +274,162 @@ class SurfaceBackedLayer(core.LayerBase, lib.autosave.Autosaveable):
             y,
         )
 
+    ## Lazy loading
+
+    def _defer_orazip_member(self, orazip, cache_dir, src, x, y):
+        """Try to put off decoding a hidden layer's PNG until it's needed
+
+        :param zipfile.ZipFile orazip: OpenRaster zipfile being loaded
+        :param unicode cache_dir: Document cache dir, or None
+        :param unicode src: Name of the layer's PNG member in orazip
+        :param int x: X position of the PNG's top left pixel
+        :param int y: Y position of the PNG's top left pixel
+        :returns: True if decoding was deferred
+        :rtype: bool
+
+        Hidden layers contribute nothing to the rendered document, so
+        large files with many of them can be opened much faster by not
+        decoding their pixels up front. Instead, the still-compressed
+        member is copied into the cache dir, and the layer's size is
+        read from its PNG header. The copy keeps the data available
+        even if the .ora file is overwritten or deleted afterwards.
+
+        The surface is decoded from the copy the first time anything
+        accesses it: when the layer is shown, rendered, edited, saved,
+        or snapshotted.
+
+        """
+        if self.visible or cache_dir is None:
+            return False
+        if not src.lower().endswith(".png"):
+            return False
+        surface = self.__surface
+        if surface.looped or not surface.is_empty():
+            return False
+        try:
+            with orazip.open(src, mode="r") as fp:
+                header = fp.read(_PNG_IHDR_HEADER_SIZE)
+        except KeyError:
+            return False
+        size = _png_header_size(header)
+        if size is None:
+            return False
+        w, h = size
+        fd, filename = tempfile.mkstemp(
+            suffix=".png",
+            prefix="lazy-",
+            dir=cache_dir,
+        )
+        with os.fdopen(fd, "wb") as dst_fp:
+            with orazip.open(src, mode="r") as src_fp:
+                shutil.copyfileobj(src_fp, dst_fp)
+        self.__lazy_source = _LazySource(filename, x, y, w, h)
+        logger.debug(
+            "Deferred decoding %r (%dx%d%+d%+d) until needed",
+            src,
+            w,
+            h,
+            x,
+            y,
+        )
+        return True
+
+    @property
+    def is_lazy(self):
+        """True if the layer's pixels have not been decoded yet"""
+        return self.__lazy_source is not None
+
+    def _load_lazy_source(self):
+        """Decode deferred pixel data into the surface
+
+        The surface's observers are not told about this, because the
+        layer's content doesn't change as far as anything else can see.
+
+        This may be called from any thread: renderers and savers can be
+        the first to access the surface. If the data can't be decoded,
+        the layer keeps it and shows nothing. Saving then writes out the
+        original PNG, so the user's pixels aren't lost.
+
+        """
+        with _LAZY_DECODE_LOCK:
+            source = self.__lazy_source
+            if source is None or self.__lazy_failed:
+                return  # another thread got here first
+            t0 = time.time()
+            try:
+                tmp_surface = _decode_lazy_source(source)
+            except Exception:
+                logger.exception(
+                    "Failed to decode deferred layer data from %r. "
+                    "It will be saved unchanged.",
+                    source.filename,
+                )
+                self.__lazy_failed = True
+                return
+            surface = self.__surface
+            observers = surface.observers[:]
+            del surface.observers[:]
+            try:
+                surface.load_from_surface(tmp_surface)
+            finally:
+                surface.observers[:] = observers
+            # Only now, so other threads wait for the tiles.
+            self.__lazy_source = None
+            logger.debug(
+                "Decoded deferred layer data in %.3fs",
+                time.time() - t0,
+            )
+
+    def _discard_lazy_source(self):
+        """Forget about any deferred pixel data
+
+        The cached PNG is deleted once no snapshots refer to it either.
+
+        """
+        self.__lazy_source = None
+        self.__lazy_failed = False
+
+    def _get_lazy_source(self):
+        """Get the deferred pixel data, without decoding it
+
+        :rtype: _LazySource or None
+
+        """
+        return self.__lazy_source
+
+    def _set_lazy_source(self, source):
+        """Make the layer's pixels come from deferred data again
+
+        :param _LazySource source: From _get_lazy_source().
+
+        This replaces the surface's tiles, and tells its observers
+        about both the old and the new areas.
+
+        """
+        if source is self.__lazy_source:
+            return
+        old_bbox = self._get_lazy_bbox()
+        surface = self.__surface
+        if not surface.is_empty():
+            surface.clear()
+        self.__lazy_source = source
+        self.__lazy_failed = False
+        new_bbox = self._get_lazy_bbox()
+        for bbox in (old_bbox, new_bbox):
+            if bbox is not None:
+                surface.notify_observers(*bbox)
+
+    def _get_lazy_bbox(self):
+        """Tile-aligned bbox of the deferred pixel data, or None"""
+        source = self.__lazy_source
+        if source is None:
+            return None
+        x0 = (source.x // N) * N
+        y0 = (source.y // N) * N
+        x1 = -((-(source.x + source.w)) // N) * N
+        y1 = -((-(source.y + source.h)) // N) * N
+        return helpers.Rect(x0, y0, x1 - x0, y1 - y0)
+
     def _load_surface_from_oradir_member(self, oradir, cache_dir, src, progress, x, y):
         """Loads the surface from a file in an OpenRaster-like folder
 
@@ -313,12 +499,49 @@ class SurfaceBackedLayer(core.LayerBase, lib.autosave.Autosaveable):
 
     def get_bbox(self):
         """Returns the inherent bounding box of the surface, tile aligned"""
+        bbox = self._get_lazy_bbox()
+        if bbox is not None:
+            return bbox
         return self._surface.get_bbox()
 
     def is_empty(self):
         """Tests whether the surface is empty"""
+        if self.is_lazy:
+            return False
         return self._surface.is_empty()
 
+    ## Thumbnails
+
+    def update_thumbnail(self):
+        """Safely updates the cached preview thumbnail.
+
+        Layers whose data has not been decoded yet get a thumbnail
+        loaded straight from the deferred PNG, at a reduced size.
+
+        """
+        source = self.__lazy_source
+        if source is not None:
+            size = 256
+            try:
+                if max(source.w, source.h) > size:
+                    self._thumbnail = GdkPixbuf.Pixbuf.new_from_file_at_scale(
+                        source.filename,
+                        size,
+                        size,
+                        True,
+                    )
+                else:
+                    self._thumbnail = GdkPixbuf.Pixbuf.new_from_file(
+                        source.filename,
+                    )
+                return
+            except Exception:
+                logger.exception(
+                    "Cannot make a thumbnail from %r",
+                    source.filename,
+                )
+        super(SurfaceBackedLayer, self).update_thumbnail()
+
     ## Flood fill
 
     def flood_fill(self, fill_args, dst_layer=None):
@@ -334,6 +557,16 @@ class SurfaceBackedLayer(core.LayerBase, lib.autosave.Autosaveable):
     def get_tile_coords(self):
         return self._surface.get_tiles().keys()
 
+    def get_tile_stores(self):
+        if self.is_lazy:
+            return []
+        return self._surface.get_tile_stores()
+
+    def regenerate_mipmaps(self, max_tiles=0):
+        if self.is_lazy:
+            return False
+        return self._surface.regenerate_mipmaps(max_tiles)
+
     def get_render_ops(self, spec):
         """Get rendering instructions."""
 
@@ -436,6 +669,22 @@ class SurfaceBackedLayer(core.LayerBase, lib.autosave.Autosaveable):
         png_basename = self.autosave_uuid + ".png"
         png_relpath = os.path.join("data", png_basename)
         png_path = os.path.join(oradir, png_relpath)
+        lazy_source = self.__lazy_source
+        if lazy_source is not None:
+            # Deferred data is already a PNG of the right kind.
+            png_bbox = tuple(lazy_source[1:])
+            if self.autosave_dirty or not os.path.exists(png_path):
+                shutil.copy(lazy_source.filename, png_path)
+                self.autosave_dirty = False
+            png_x, png_y = png_bbox[0:2]
+            manifest.add(png_relpath)
+            elem = self._get_stackxml_element(
+                "layer",
+                png_x - bbox[0],
+                png_y - bbox[1],
+            )
+            elem.attrib["src"] = png_relpath
+            return elem
         png_bbox = self._surface.looped and bbox or tuple(self.get_bbox())
         if self.autosave_dirty or not os.path.exists(png_path):
             task = tiledsurface.PNGFileUpdateTask(
@@ -468,6 +717,21 @@ class SurfaceBackedLayer(core.LayerBase, lib.autosave.Autosaveable):
             suffix = sep + suffix
         return "".join([prefix, sep, path_ref, suffix])
 
+    def _get_ora_reuse_key(self, kind, rect, **kwargs):
+        """Internal: key for reusing saved data if nothing has changed
+
+        See lib.helpers.OrderedZipWriter.copy_reusable().
+
+        """
+        return (
+            kind,
+            self.autosave_uuid,
+            self.save_revision,
+            tuple(rect),
+            lib.eotf.eotf(),
+            repr(sorted(kwargs.items())),
+        )
+
     def _save_rect_to_ora(
         self, orazip, tmpdir, prefix, path, frame_bbox, rect, progress=None, **kwargs
     ):
@@ -475,21 +739,44 @@ class SurfaceBackedLayer(core.LayerBase, lib.autosave.Autosaveable):
         # Write PNG data via a tempfile
         pngname = self._make_refname(prefix, path, ".png")
         pngpath = os.path.join(tmpdir, pngname)
-        t0 = time.time()
-        self._surface.save_as_png(pngpath, *rect, progress=progress, **kwargs)
-        t1 = time.time()
-        logger.debug("%.3fs surface saving %r", t1 - t0, pngname)
-        # Archive and remove
+        lazy_source = self.__lazy_source
+        if lazy_source is not None:
+            # Deferred data is already a PNG of the right kind, and
+            # copying it means the writer never has to decode it.
+            rect = tuple(lazy_source[1:])
+
+            def _write_png(progress):
+                shutil.copy(lazy_source.filename, pngpath)
+
+        else:
+            surface = self._surface
+
+            def _write_png(progress):
+                t0 = time.time()
+                surface.save_as_png(pngpath, *rect, progress=progress, **kwargs)
+                t1 = time.time()
+                logger.debug("%.3fs surface saving %r", t1 - t0, pngname)
+
+        # Archive and remove, possibly after writing it concurrently.
+        # If the layer hasn't changed since the last save, and that
+        # wrote the same area, its PNG may be copied instead.
         storepath = "data/%s" % (pngname,)
-        orazip.write(pngpath, storepath)
-        os.remove(pngpath)
+        reuse_key = self._get_ora_reuse_key(prefix, rect, **kwargs)
+        helpers.zipfile_write_tempfile(
+            orazip,
+            pngpath,
+            storepath,
+            produce=_write_png,
+            progress=progress,
+            reuse_key=reuse_key,
+        )
         # Return details
         png_bbox = tuple(rect)
         png_x, png_y = png_bbox[0:2]
         ref_x, ref_y = frame_bbox[0:2]
         x = png_x - ref_x
         y = png_y - ref_y
-        assert (x == y == 0) or not self._surface.looped
+        assert (x == y == 0) or not self.__surface.looped
         elem = self._get_stackxml_element("layer", x, y)
         elem.attrib["src"] = storepath
         return elem
@@ -587,11 +874,26 @@ class SurfaceBackedLayerSnapshot(core.LayerBaseSnapshot):
 
     def __init__(self, layer):
         super(SurfaceBackedLayerSnapshot, self).__init__(layer)
-        self.surface_sshot = layer._surface.save_snapshot()
+        # Layers whose pixels haven't been decoded yet stay that way.
+        self.lazy_source = layer._get_lazy_source()
+        self._surface_sshot = None
+        if self.lazy_source is None:
+            self._surface_sshot = layer._surface.save_snapshot()
+
+    @property
+    def surface_sshot(self):
+        """Snapshot of the surface, decoded on first use if lazy"""
+        if self._surface_sshot is None:
+            surface = _decode_lazy_source(self.lazy_source)
+            self._surface_sshot = surface.save_snapshot()
+        return self._surface_sshot
 
     def restore_to_layer(self, layer):
         super(SurfaceBackedLayerSnapshot, self).restore_to_layer(layer)
-        layer._surface.load_snapshot(self.surface_sshot)
+        if self.lazy_source is not None:
+            layer._set_lazy_source(self.lazy_source)
+        else:
+            layer._surface.load_snapshot(self.surface_sshot)
 
 
 class FileBackedLayer(SurfaceBackedLayer, core.ExternallyEditable):
@@ -884,6 +1186,82 @@ class FileBackedLayerMove(SurfaceBackedLayerMove):
 ## Utility classes
 
 
+#: Bytes needed to read a PNG's size: signature, then the IHDR chunk's
+#: length, type, width and height fields.
+_PNG_IHDR_HEADER_SIZE = 24
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+#: Serializes decoding deferred layer data, which any thread may start.
+_LAZY_DECODE_LOCK = threading.Lock()
+
+
+class _LazySource(namedtuple("_LazySource", ["filename", "x", "y", "w", "h"])):
+    """Location and placement of a layer's deferred PNG data
+
+    The file is a private copy in the document's cache dir. It may be
+    shared by a layer and by snapshots of the layer, in the undo
+    history for example. It's deleted when the last of them lets go.
+
+    """
+
+    def __del__(self):
+        try:
+            _remove_lazy_source_file(self)
+        except Exception:
+            pass  # interpreter shutdown
+
+
+def _png_header_size(header):
+    """Get the (width, height) of a PNG from the start of its data
+
+    :param bytes header: The first _PNG_IHDR_HEADER_SIZE bytes of a PNG
+    :returns: The image's size, or None if header isn't a valid PNG's
+    :rtype: tuple
+
+    >>> ihdr = struct.pack(">I4sII", 13, b"IHDR", 300, 20)
+    >>> _png_header_size(_PNG_SIGNATURE + ihdr)
+    (300, 20)
+    >>> _png_header_size(b"GIF89a" + ihdr) is None
+    True
+    >>> _png_header_size(_PNG_SIGNATURE) is None
+    True
+
+    """
+    if len(header) < _PNG_IHDR_HEADER_SIZE:
+        return None
+    if not header.startswith(_PNG_SIGNATURE):
+        return None
+    chunk_type, w, h = struct.unpack(">4sII", header[12:24])
+    if chunk_type != b"IHDR" or w <= 0 or h <= 0:
+        return None
+    return (w, h)
+
+
+def _decode_lazy_source(source):
+    """Decode a layer's deferred PNG data into a new surface
+
+    :param _LazySource source: The deferred data.
+    :rtype: lib.tiledsurface.Surface
+
+    """
+    with open(source.filename, "rb") as fp:
+        pixbuf = lib.pixbuf.load_from_stream(fp)
+    arr = helpers.gdkpixbuf2numpy(pixbuf)
+    surface = tiledsurface.Surface()
+    surface.load_from_numpy(arr, source.x, source.y)
+    return surface
+
+
+def _remove_lazy_source_file(source):
+    """Delete the cached copy of a layer's deferred PNG data"""
+    try:
+        os.unlink(source.filename)
+    except OSError:
+        if os.path.exists(source.filename):
+            logger.warning("Failed to remove %r", source.filename)
+
+
 class _ManagedFile(object):
     """Working copy of a file, as used by file-backed layers
 
@@ -1092,15 +1470,25 @@ class BackgroundLayer(SurfaceBackedLayer):
 
         pngname = self._make_refname("background", path, "tile.png")
         tmppath = os.path.join(tmpdir, pngname)
-        t0 = time.time()
-        self._surface.save_as_png(
-            tmppath, x=x + x0, y=y + y0, w=w, h=h, progress=progress.open(), **kwargs
-        )
-        t1 = time.time()
         storename = "data/%s" % (pngname,)
-        logger.debug("%.3fs surface saving %s", t1 - t0, storename)
-        orazip.write(tmppath, storename)
-        os.remove(tmppath)
+
+        def _write_png(progress):
+            t0 = time.time()
+            self._surface.save_as_png(
+                tmppath, x=x + x0, y=y + y0, w=w, h=h, progress=progress, **kwargs
+            )
+            t1 = time.time()
+            logger.debug("%.3fs surface saving %s", t1 - t0, storename)
+
+        tile_rect = (x + x0, y + y0, w, h)
+        helpers.zipfile_write_tempfile(
+            orazip,
+            tmppath,
+            storename,
+            produce=_write_png,
+            progress=progress.open(),
+            reuse_key=self._get_ora_reuse_key("bgtile", tile_rect, **kwargs),
+        )
         elem.attrib[self.ORA_BGTILE_ATTR] = storename
 
         progress.close()
@@ -1359,6 +1747,19 @@ class SimplePaintingLayer(SurfaceBackedLayer):
         dst_layer.autosave_dirty = True  # XXX hmm, not working?
         return self._surface.flood_fill(fill_args, dst=dst_layer._surface)
 
+    def flood_fill_preview(self, fill_args, mipmap_level):
+        """Quickly fills one of the surface's mipmaps, for previews
+
+        :param fill_args: Parameters common to all fill calls
+        :type fill_args: lib.floodfill.FloodFillArguments
+        :param int mipmap_level: The mipmap level to fill at
+        :returns: Filled alpha tiles at mipmap_level, by tile coordinate
+        :rtype: dict
+
+        Nothing is written to any layer.
+        """
+        return self._surface.flood_fill_preview(fill_args, mipmap_level)
+
     ## Simple painting
 
     def get_paintable(self):
@@ -1481,6 +1882,7 @@ class StrokemappedPaintingLayer(SimplePaintingLayer):
         #: List of strokemap.StrokeShape instances (not stroke.Stroke),
         #: ordered by depth.
         self.strokes = []
+        self._stroke_index = lib.strokemap.StrokeIndex()
 
     def clear(self):
         """Clear both the surface and the strokemap"""
@@ -1625,6 +2027,19 @@ class StrokemappedPaintingLayer(SimplePaintingLayer):
 
     ## Strokemap load and save
 
+    def _get_strokemap_stamp(self):
+        """Internal: identifies the current state of the strokemap
+
+        :rtype: int
+
+        Strokes are moved and trimmed, and lists of them are spliced
+        together when layers are merged, without the layer itself
+        always being flagged as dirty. This covers those changes, for
+        deciding whether a strokemap saved earlier can be reused.
+
+        """
+        return hash(tuple((id(s), s.geometry_stamp) for s in self.strokes))
+
     def _load_strokemap_from_file(self, f, translate_x, translate_y, invert):
         assert not self.strokes
         brushes = []
@@ -1662,7 +2077,7 @@ class StrokemappedPaintingLayer(SimplePaintingLayer):
     def get_stroke_info_at(self, x, y):
         """Get the stroke at the given point"""
         x, y = int(x), int(y)
-        for s in reversed(self.strokes):
+        for s in self._stroke_index.get_strokes_at(self.strokes, x, y):
             if s.touches_pixel(x, y):
                 return s
 
@@ -1684,19 +2099,28 @@ class StrokemappedPaintingLayer(SimplePaintingLayer):
         )
         # Store stroke shape data too
         x, y, w, h = self.get_bbox()
-        if PY3:
-            sio = BytesIO()
-        else:
-            sio = StringIO()
-        t0 = time.time()
-        _write_strokemap(sio, self.strokes, -x, -y)
-        t1 = time.time()
-        data = sio.getvalue()
-        sio.close()
         datname = self._make_refname("layer", path, "strokemap.dat")
-        logger.debug("%.3fs strokemap saving %r", t1 - t0, datname)
         storepath = "data/%s" % (datname,)
-        helpers.zipfile_writestr(orazip, storepath, data)
+        reuse_key = (
+            "strokemap",
+            self.autosave_uuid,
+            self.save_revision,
+            self._get_strokemap_stamp(),
+            x,
+            y,
+        )
+        if not helpers.zipfile_copy_reusable(orazip, storepath, reuse_key):
+            strokes = self.strokes[:]
+
+            def _write(fp):
+                t0 = time.time()
+                _write_strokemap(fp, strokes, -x, -y)
+                t1 = time.time()
+                logger.debug("%.3fs strokemap saving %r", t1 - t0, datname)
+
+            helpers.zipfile_writestream(
+                orazip, storepath, _write, reuse_key=reuse_key
+            )
         # Add strokemap XML attrs and return.
         # See comment above for compatibility strategy.
         elem.attrib[self._ORA_STROKEMAP_ATTR] = storepath
@@ -1792,22 +2216,47 @@ def _write_strokemap_stroke(f, stroke, brush2id, dx, dy):
     b = stroke.brush_string
     if b not in brush2id:
         brush2id[b] = len(brush2id)
-        if isinstance(b, unicode):
-            b = b.encode("utf-8")
-        b = zlib.compress(b)
+        zb = _get_compressed_brush_string(b)
         f.write(b"b")
-        f.write(struct.pack(">I", len(b)))
-        f.write(b)
+        f.write(struct.pack(">I", len(zb)))
+        f.write(zb)
 
     # save stroke
-    s = stroke.save_to_string(dx, dy)
     f.write(b"s")
-    f.write(struct.pack(">II", brush2id[stroke.brush_string], len(s)))
-    f.write(s)
+    f.write(struct.pack(">II", brush2id[b], stroke.encoded_size))
+    stroke.write_to_file(f, dx, dy)
+
+
+#: Compressed brush settings strings, by the uncompressed string.
+#: Most of a layer's strokes share a handful of brushes.
+_BRUSH_ZDATA_CACHE = lib.cache.LRUCache(capacity=64)
+_BRUSH_ZDATA_CACHE_LOCK = threading.Lock()
+
+
+def _get_compressed_brush_string(b):
+    """Get the compressed form of a stroke's brush string, for saving
+
+    This is called from the autosave thread as well as the main one.
+
+    """
+    with _BRUSH_ZDATA_CACHE_LOCK:
+        zb = _BRUSH_ZDATA_CACHE.get(b)
+        if zb is None:
+            raw = b
+            if isinstance(raw, unicode):
+                raw = raw.encode("utf-8")
+            zb = zlib.compress(raw)
+            _BRUSH_ZDATA_CACHE[b] = zb
+    return zb
 
 
 class _StrokemapFileUpdateTask(object):
-    """Updates a strokemap file in chunked calls (for autosave)"""
+    """Updates a strokemap file in chunked calls (for autosave)
+
+    The strokes are copied when the task is created,
+    so it can run in the autosave thread.
+
+    """
 
     def __init__(self, strokes, filename, dx, dy):
         super(_StrokemapFileUpdateTask, self).__init__()
@@ -1822,7 +2271,7 @@ class _StrokemapFileUpdateTask(object):
         self._dx = dx
         self._dy = dy
         self._brush2id = {}
-        self._strokes = strokes[:]
+        self._strokes = [s.copy() for s in strokes]
         self._strokes_i = 0
         logger.debug("autosave: scheduled update of %r", self._final_name)
 
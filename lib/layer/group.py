@@ -199,9 +199,13 @@ class LayerStack(core.LayerBase, lib.autosave.Autosaveable):
         """Clears the layer, and removes any child layers"""
         super(LayerStack, self).clear()
         removed = list(self._layers)
+        if not removed:
+            return
+        redraws = [layer.get_full_redraw_bbox() for layer in removed]
         self._layers[:] = []
         for i, layer in reversed(list(enumerate(removed))):
             self._notify_disown(layer, i)
+        self._content_changed(*tuple(core.combine_redraws(redraws)))
 
     def __repr__(self):
         """String representation of a stack
@@ -367,6 +371,12 @@ class LayerStack(core.LayerBase, lib.autosave.Autosaveable):
     def is_empty(self):
         return len(self._layers) == 0
 
+    def get_tile_stores(self):
+        stores = []
+        for layer in self._layers:
+            stores.extend(layer.get_tile_stores())
+        return stores
+
     @property
     def effective_opacity(self):
         """The opacity used when compositing a layer: zero if invisible"""
@@ -20,6 +20,9 @@ from copy import deepcopy
 import os.path
 from warnings import warn
 import contextlib
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 from lib.gibindings import GdkPixbuf
 from lib.gibindings import GLib
@@ -49,9 +52,63 @@ from lib.pycompat import xrange
 logger = logging.getLogger(__name__)
 
 
+## Module constants
+
+#: Default number of threads used by RootLayerStack.render().
+#: A value of 1 means that tiles are rendered serially.
+DEFAULT_RENDER_THREADS = 1
+
+#: Tile batches per render thread, for load balancing.
+_RENDER_BATCHES_PER_THREAD = 4
+
+#: Shared render worker pools, keyed by thread count.
+_render_pools = {}
+_render_pools_lock = threading.Lock()
+
+
+## Module functions
+
+
+def _get_render_pool(nthreads):
+    """Get the shared render worker pool with a given number of threads
+
+    Pools are shared by all layer stacks, and live as long as the app,
+    so closing a document doesn't leave its worker threads behind.
+
+    >>> _get_render_pool(2) is _get_render_pool(2)
+    True
+
+    """
+    with _render_pools_lock:
+        pool = _render_pools.get(nthreads)
+        if pool is None:
+            pool = ThreadPoolExecutor(
+                max_workers=nthreads,
+                thread_name_prefix="render",
+            )
+            _render_pools[nthreads] = pool
+    return pool
+
+
 ## Class defs
 
 
+class RenderSnapshot(
+    namedtuple("RenderSnapshot", ["ops", "dst_has_alpha", "mipmap_level"])
+):
+    """Rendering instructions and pixels captured for later use.
+
+    :ivar list ops: The flat list of ops from get_render_ops().
+    :ivar bool dst_has_alpha: Whether the output has transparent areas.
+    :ivar int mipmap_level: Highest mipmap level that can be rendered.
+
+    The ops refer to copy-on-write clones of the layer surfaces, so a
+    snapshot fixes the pixels of the stack as well as its structure,
+    modes and opacities. See `RootLayerStack.render_snapshot()`.
+
+    """
+
+
 class PlaceholderLayer(group.LayerStack):
     """Trivial temporary placeholder layer, used for moves etc.
 
@@ -111,17 +168,35 @@ class RootLayerStack(group.LayerStack):
 
     ## Initialization
 
-    def __init__(self, doc=None, cache_size=lib.cache.DEFAULT_CACHE_SIZE, **kwargs):
+    def __init__(
+        self,
+        doc=None,
+        cache_size=lib.cache.DEFAULT_CACHE_SIZE,
+        render_threads=DEFAULT_RENDER_THREADS,
+        cache_bytes=lib.cache.DEFAULT_CACHE_BYTES,
+        **kwargs
+    ):
         """Construct, as part of a model
 
         :param doc: The model document. May be None for testing.
         :type doc: lib.document.Document
-        :param cache_size: size of the layer render cache
+        :param cache_size: max tile locations in the layer render cache
         :type cache_size: int
+        :param render_threads: number of tile rendering threads
+        :type render_threads: int
+        :param cache_bytes: memory budget for the layer render cache
+        :type cache_bytes: int
         """
         super(RootLayerStack, self).__init__(**kwargs)
         self.doc = doc
-        self._render_cache = lib.cache.LRUCache(capacity=cache_size)
+        self._render_cache = lib.cache.LRUCache(
+            capacity=cache_size,
+            max_bytes=cache_bytes,
+            sizeof=lib.cache.nbytes,
+        )
+        self._render_cache_lock = threading.Lock()
+        self._render_threads = 1
+        self.render_threads = render_threads
         # Background
         default_bg = (255, 255, 255)
         self._default_background = default_bg
@@ -143,11 +218,11 @@ class RootLayerStack(group.LayerStack):
         self._current_path = ()
         # Temporary overlay for the current layer
         self._current_layer_overlay = None
-        # Self-observation
+        # Self-observation.
+        # Property changes, insertions and deletions which affect the
+        # rendering always come with a content-changed notification for
+        # the affected area, so only that needs to be observed here.
         self.layer_content_changed += self._render_cache_clear_area
-        self.layer_properties_changed += self._render_cache_clear
-        self.layer_deleted += self._render_cache_clear
-        self.layer_inserted += self._render_cache_clear
         # Layer thumbnail updates
         self.layer_content_changed += self._mark_layer_for_rethumb
         self._rethumb_layers = []
@@ -156,24 +231,42 @@ class RootLayerStack(group.LayerStack):
     # Render cache management:
 
     def _render_cache_get(self, key1, key2):
-        try:
-            cache2 = self._render_cache[key1]
-            return cache2[key2]
-        except KeyError:
-            pass
-        return None
+        with self._render_cache_lock:
+            cache2 = self._render_cache.peek(key1)
+            data = None
+            if cache2 is not None:
+                data = cache2.get(key2)
+            self._render_cache.touch(key1, hit=(data is not None))
+        return data
 
     def _render_cache_set(self, key1, key2, data):
-        try:
-            cache2 = self._render_cache[key1]
-        except KeyError:
-            cache2 = dict()  # it'll have ~MAX_MIPMAP_LEVEL items
+        with self._render_cache_lock:
+            # Storing isn't a lookup, so it mustn't affect the stats.
+            cache2 = self._render_cache.peek(key1)
+            if cache2 is None:
+                cache2 = dict()  # it'll have ~MAX_MIPMAP_LEVEL items
+            cache2[key2] = data
+            # (Re)storing the entry measures it against the byte budget.
             self._render_cache[key1] = cache2
-        cache2[key2] = data
 
     def _render_cache_clear_area(self, root, layer, x, y, w, h):
-        """Clears rendered tiles from the cache in a specific area."""
+        """Clears rendered tiles from the cache in a specific area.
+
+        Only the tiles intersecting the area are dropped, at each
+        mipmap level. The cost is bounded by the smaller of the number
+        of tiles in the area and the number of tiles in the cache.
 
+        >>> root = RootLayerStack(None)
+        >>> for key in [(0, 0, 0), (5, 0, 0), (2, 0, 1), (0, 0, 3)]:
+        ...     root._render_cache[key] = {}
+        >>> root._render_cache_clear_area(root, None, 0, 0, 10, 10)
+        >>> sorted(root._render_cache.keys())
+        [(2, 0, 1), (5, 0, 0)]
+        >>> root._render_cache_clear_area(root, None, 0, 0, 0, 0)
+        >>> len(root._render_cache)
+        0
+
+        """
         if (w <= 0) or (h <= 0):  # update all notifications
             self._render_cache_clear()
             return
@@ -185,16 +278,100 @@ class RootLayerStack(group.LayerStack):
         ty_max = (y + h) // n
         mipmap_level_max = lib.mypaintlib.MAX_MIPMAP_LEVEL
 
-        for tx in range(tx_min, tx_max + 1):
-            for ty in range(ty_min, ty_max + 1):
-                for level in range(0, mipmap_level_max + 1):
-                    fac = 2**level
-                    key = ((tx // fac), (ty // fac), level)
-                    self._render_cache.pop(key, None)
+        # Index of the tile range affected at each mipmap level.
+        ranges = []
+        num_keys = 0
+        for level in range(0, mipmap_level_max + 1):
+            fac = 2**level
+            r = (tx_min // fac, ty_min // fac, tx_max // fac, ty_max // fac)
+            ranges.append(r)
+            num_keys += (r[2] - r[0] + 1) * (r[3] - r[1] + 1)
+
+        with self._render_cache_lock:
+            cache = self._render_cache
+            if num_keys > len(cache):
+                # Big area, few cached tiles: test the cached ones.
+                doomed = []
+                for key in cache.keys():
+                    tx, ty, level = key
+                    x0, y0, x1, y1 = ranges[level]
+                    if x0 <= tx <= x1 and y0 <= ty <= y1:
+                        doomed.append(key)
+            else:
+                doomed = (
+                    (tx, ty, level)
+                    for level, (x0, y0, x1, y1) in enumerate(ranges)
+                    for tx in range(x0, x1 + 1)
+                    for ty in range(y0, y1 + 1)
+                )
+            for key in doomed:
+                cache.pop(key, None)
 
     def _render_cache_clear(self, *_ignored):
         """Clears all rendered tiles from the cache."""
-        self._render_cache.clear()
+        with self._render_cache_lock:
+            self._render_cache.clear()
+
+    def get_render_cache_stats(self):
+        """Get usage statistics for the rendered tile cache.
+
+        :rtype: lib.cache.CacheStats
+
+        >>> root = RootLayerStack(None, cache_bytes=1024)
+        >>> stats = root.get_render_cache_stats()
+        >>> stats.items, stats.resident_bytes, stats.max_bytes
+        (0, 0, 1024)
+
+        """
+        with self._render_cache_lock:
+            return self._render_cache.stats()
+
+    def reset_render_cache_stats(self):
+        """Resets the hit, miss and eviction counts of the render cache"""
+        with self._render_cache_lock:
+            self._render_cache.reset_stats()
+
+    @property
+    def render_cache_bytes(self):
+        """Memory budget for the rendered tile cache, in bytes (r/w)"""
+        return self._render_cache.max_bytes
+
+    @render_cache_bytes.setter
+    def render_cache_bytes(self, n):
+        with self._render_cache_lock:
+            self._render_cache.max_bytes = int(n)
+
+    # Render threads:
+
+    @property
+    def render_threads(self):
+        """Number of threads used by render() (read/write).
+
+        Tiles are independent of one another, so rendering can be split
+        across a pool of worker threads. The compositing ops release the
+        GIL while they work, and each tile is rendered exactly as it
+        would be serially. The default is 1, meaning no worker threads.
+
+        >>> root = RootLayerStack(None)
+        >>> root.render_threads
+        1
+        >>> root.render_threads = 4
+        >>> root.render_threads
+        4
+        >>> root.render_threads = 0
+        Traceback (most recent call last):
+        ...
+        ValueError: render_threads must be at least 1 (got 0)
+
+        """
+        return self._render_threads
+
+    @render_threads.setter
+    def render_threads(self, n):
+        n = int(n)
+        if n < 1:
+            raise ValueError("render_threads must be at least 1 (got %d)" % (n,))
+        self._render_threads = n
 
     # Global ops:
 
@@ -276,6 +453,11 @@ class RootLayerStack(group.LayerStack):
         """Returns the set of unique names of all descendents"""
         return set((l.name for l in self.deepiter()))
 
+    def get_tile_stores(self):
+        stores = super(RootLayerStack, self).get_tile_stores()
+        stores.extend(self._background_layer.get_tile_stores())
+        return stores
+
     ## Rendering: root stack API
 
     def _get_render_background(self, spec):
@@ -329,6 +511,19 @@ class RootLayerStack(group.LayerStack):
                 return False
         return True
 
+    def get_render_is_cacheable(self):
+        """True if the current rendering can be cached between redraws
+
+        :rtype: bool
+
+        Display code can keep rendered tiles around while this is true,
+        and reuse them until a content-changed notification arrives for
+        their area. Special viewing modes like layer solo and preview
+        make this false.
+
+        """
+        return self._get_render_spec().cacheable()
+
     def layers_along_path(self, path):
         """Yields all layers along a path, not including the root"""
         if not path:
@@ -468,10 +663,71 @@ class RootLayerStack(group.LayerStack):
             target_surface_is_8bpc = sample_tile.dtype == "uint8"
             if target_surface_is_8bpc:
                 use_cache = spec.cacheable()
+
+        render_args = (
+            surface,
+            mipmap_level,
+            ops,
+            dst_has_alpha,
+            opaque_base_tile,
+            filter,
+            target_surface_is_8bpc,
+            use_cache,
+        )
+        nthreads = min(self._render_threads, len(tiles))
+        if nthreads <= 1:
+            self._render_tiles(tiles, *render_args, progress=progress)
+            progress.close()
+            return
+
+        # Parallel rendering: split the tile list into contiguous
+        # batches, and hand them to the worker pool. Progress is
+        # reported from the calling thread only.
+        nbatches = nthreads * _RENDER_BATCHES_PER_THREAD
+        batch_size = max(1, -(-len(tiles) // nbatches))
+        batches = [
+            tiles[i : i + batch_size] for i in xrange(0, len(tiles), batch_size)
+        ]
+        pool = _get_render_pool(self._render_threads)
+        futures = [
+            pool.submit(self._render_tiles, batch, *render_args)
+            for batch in batches
+        ]
+        try:
+            for future in futures:
+                progress += future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+        progress.close()
+
+    def _render_tiles(
+        self,
+        tiles,
+        surface,
+        mipmap_level,
+        ops,
+        dst_has_alpha,
+        opaque_base_tile,
+        filter,
+        target_surface_is_8bpc,
+        use_cache,
+        progress=None,
+    ):
+        """Render a list of tiles: the inner loop of render().
+
+        :returns: The number of tiles rendered.
+        :rtype: int
+
+        This may be called from a render worker thread, so it must not
+        touch anything shared apart from the target tiles it is given
+        and the (locked) render cache.
+
+        """
         key2 = (id(opaque_base_tile), dst_has_alpha)
 
         # Rendering loop.
-        # Keep this as tight as possible, and consider C++ parallelization.
+        # Keep this as tight as possible.
         tiledims = (tiledsurface.N, tiledsurface.N, 4)
         dst_has_alpha_orig = dst_has_alpha
         for tx, ty in tiles:
@@ -543,8 +799,10 @@ class RootLayerStack(group.LayerStack):
                         conv = lib.mypaintlib.tile_convert_rgbu16_to_rgbu8
                     conv(dst, dst_8bpc_orig, eotf())
 
+                    # Cache a private copy: the target tile may be a view
+                    # into a much larger buffer, and is filtered below.
                     if use_cache:
-                        self._render_cache_set(key1, key2, dst_8bpc_orig)
+                        self._render_cache_set(key1, key2, dst_8bpc_orig.copy())
                 else:
                     # An already 8pbc dst was loaded from the cache.
                     # It will match dst_has_alpha already.
@@ -558,8 +816,95 @@ class RootLayerStack(group.LayerStack):
                     filter(dst)
 
             # end tile_request
-            progress += 1
-        progress.close()
+            if progress is not None:
+                progress += 1
+        return len(tiles)
+
+    def get_render_snapshot(self, overlay=None, mipmap_level=0):
+        """Captures what's needed to render the current state later.
+
+        :param lib.layer.core.LayerBase overlay: A global overlay layer.
+        :param int mipmap_level: Highest mipmap level to be rendered.
+        :rtype: RenderSnapshot
+
+        This must be called from the thread which owns the layer stack,
+        and the snapshot must be dropped there too. Each layer surface
+        is cloned with `lib.tiledsurface.MyPaintSurface.clone_for_rendering()`,
+        which shares its tiles copy-on-write.
+
+        >>> root = RootLayerStack(None)
+        >>> snapshot = root.get_render_snapshot()
+        >>> snapshot.dst_has_alpha
+        False
+        >>> len(snapshot.ops)
+        1
+
+        """
+        spec = self._get_render_spec()
+        if overlay is not None:
+            spec.global_overlay = overlay
+        clones = {}
+        ops = []
+        for opcode, data, mode, opacity in self.get_render_ops(spec):
+            clone_method = getattr(data, "clone_for_rendering", None)
+            if clone_method is not None:
+                clone = clones.get(id(data))
+                if clone is None:
+                    clone = clone_method(mipmap_level)
+                    clones[id(data)] = clone
+                data = clone
+            ops.append((opcode, data, mode, opacity))
+        return RenderSnapshot(
+            ops=ops,
+            dst_has_alpha=not self.get_render_is_opaque(spec=spec),
+            mipmap_level=mipmap_level,
+        )
+
+    def render_snapshot(
+        self,
+        snapshot,
+        surface,
+        tiles,
+        mipmap_level,
+        opaque_base_tile=None,
+        filter=None,
+    ):
+        """Render tiles from a snapshot, maybe in a background thread.
+
+        :param RenderSnapshot snapshot: From get_render_snapshot().
+        :param TileAccesible surface: The target surface.
+        :param iterable tiles: The tile indices to render into "surface".
+        :param int mipmap_level: downscale degree. Ensure tile indices match.
+        :param callable filter: Display filter (8bpc tile array mangler).
+        :returns: The number of tiles rendered.
+        :rtype: int
+
+        Unlike `render()`, this can run while the main thread goes on
+        changing the layers, since it only reads the snapshot's own
+        surface clones. The output shows the stack as it was when the
+        snapshot was taken, so callers should discard it for areas
+        which changed after that. The render cache is not used.
+
+        """
+        if mipmap_level > snapshot.mipmap_level:
+            raise ValueError("Snapshot doesn't cover this mipmap level")
+        tiles = list(tiles)
+        if len(tiles) == 0:
+            return 0
+        tx, ty = tiles[0]
+        with surface.tile_request(tx, ty, readonly=True) as sample_tile:
+            target_surface_is_8bpc = sample_tile.dtype == "uint8"
+        return self._render_tiles(
+            tiles,
+            surface,
+            mipmap_level,
+            snapshot.ops,
+            snapshot.dst_has_alpha,
+            opaque_base_tile,
+            filter,
+            target_surface_is_8bpc,
+            False,
+        )
 
     def render_layer_preview(self, layer, size=256, bbox=None, **options):
         """Render a standardized thumbnail/preview of a specific layer.
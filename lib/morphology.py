@@ -92,9 +92,12 @@ def strand_partition(tiles, dilating=False):
     return final_tiles, strands
 
 
-def morph(handler, offset, tiles):
+def morph(handler, offset, tiles, chords_only=False):
     """Either dilate or erode the given set of alpha tiles, depending
     on the sign of the offset, returning the set of morphed tiles.
+
+    Pixels of larger morphs are decided by distance where possible,
+    unless `chords_only` is true. The result is the same either way.
     """
     # When dilating, create new tiles to account for edge overflow
     # (without checking if they are actually needed)
@@ -107,18 +110,22 @@ def morph(handler, offset, tiles):
     # contiguous strands, which can be processed more efficiently
     morphed, strands = strand_partition(tiles, offset > 0)
     # Run the morph operation (C++, conditionally threaded)
-    myplib.morph(offset, morphed, tiles, strands, handler.controller)
+    myplib.morph(offset, morphed, tiles, strands, handler.controller, chords_only)
     return morphed
 
 
-def blur(handler, radius, tiles):
-    """Return the set of blurred tiles based on the input tiles."""
+def blur(handler, radius, tiles, exact=False):
+    """Return the set of blurred tiles based on the input tiles.
+
+    Larger radii are blurred with a fast approximation of the gaussian,
+    unless `exact` is true.
+    """
     complement_adjacent(tiles)
 
     handler.set_stage(handler.BLUR, len(tiles))
 
     blurred, strands = strand_partition(tiles, dilating=False)
-    myplib.blur(radius, blurred, tiles, strands, handler.controller)
+    myplib.blur(radius, blurred, tiles, strands, handler.controller, exact)
     return blurred
 
 
@@ -25,6 +25,7 @@
 
 #include <stdlib.h>
 #include <math.h>
+#include <vector>
 
 
 void
@@ -65,13 +66,72 @@ void tile_downscale_rgba16(PyObject *src, PyObject *dst, int dst_x, int dst_y) {
   assert(PyArray_ISCARRAY(dst_arr));
 #endif
 
+  Py_BEGIN_ALLOW_THREADS
   tile_downscale_rgba16_c((uint16_t*)PyArray_DATA(src_arr), PyArray_STRIDES(src_arr)[0],
                           (uint16_t*)PyArray_DATA(dst_arr), PyArray_STRIDES(dst_arr)[0],
                           dst_x, dst_y);
+  Py_END_ALLOW_THREADS
 
 }
 
 
+struct DownscaleJob {
+  uint16_t *src;
+  npy_intp src_strides;
+  uint16_t *dst;
+  npy_intp dst_strides;
+  int dst_x;
+  int dst_y;
+};
+
+void tile_downscale_rgba16_batch(PyObject *jobs) {
+  if (!PyList_Check(jobs)) {
+    PyErr_SetString(PyExc_TypeError, "jobs must be a list");
+    return;
+  }
+  // Gather the array pointers while holding the GIL. The list
+  // keeps the arrays alive for the duration of the call.
+  const Py_ssize_t n = PyList_GET_SIZE(jobs);
+  std::vector<DownscaleJob> work;
+  work.reserve(n);
+  for (Py_ssize_t i = 0; i < n; ++i) {
+    PyObject *src = NULL;
+    PyObject *dst = NULL;
+    int dst_x = 0;
+    int dst_y = 0;
+    if (!PyArg_ParseTuple(PyList_GET_ITEM(jobs, i), "OOii",
+                          &src, &dst, &dst_x, &dst_y)) {
+      return;
+    }
+    PyArrayObject* src_arr = ((PyArrayObject*)src);
+    PyArrayObject* dst_arr = ((PyArrayObject*)dst);
+#ifdef HEAVY_DEBUG
+    assert(PyArray_Check(src));
+    assert(PyArray_TYPE(src_arr) == NPY_UINT16);
+    assert(PyArray_ISCARRAY(src_arr));
+    assert(PyArray_Check(dst));
+    assert(PyArray_TYPE(dst_arr) == NPY_UINT16);
+    assert(PyArray_ISCARRAY(dst_arr));
+#endif
+    DownscaleJob job = {
+      (uint16_t*)PyArray_DATA(src_arr), PyArray_STRIDES(src_arr)[0],
+      (uint16_t*)PyArray_DATA(dst_arr), PyArray_STRIDES(dst_arr)[0],
+      dst_x, dst_y,
+    };
+    work.push_back(job);
+  }
+
+  Py_BEGIN_ALLOW_THREADS
+  for (size_t i = 0; i < work.size(); ++i) {
+    const DownscaleJob &job = work[i];
+    tile_downscale_rgba16_c(job.src, job.src_strides,
+                            job.dst, job.dst_strides,
+                            job.dst_x, job.dst_y);
+  }
+  Py_END_ALLOW_THREADS
+}
+
+
 void tile_copy_rgba16_into_rgba16_c(const uint16_t *src, uint16_t *dst) {
   memcpy(dst, src, MYPAINT_TILE_SIZE*MYPAINT_TILE_SIZE*4*sizeof(uint16_t));
 }
@@ -110,8 +170,10 @@ void tile_copy_rgba16_into_rgba16(PyObject * src, PyObject * dst) {
   }
   */
 
+  Py_BEGIN_ALLOW_THREADS
   tile_copy_rgba16_into_rgba16_c((uint16_t *)PyArray_DATA(src_arr),
                                  (uint16_t *)PyArray_DATA(dst_arr));
+  Py_END_ALLOW_THREADS
 }
 
 void tile_clear_rgba8(PyObject * dst) {
@@ -351,11 +413,16 @@ tile_convert_rgba16_to_rgba8 (PyObject *src,
   assert(PyArray_STRIDE(src_arr, 2) ==   sizeof(uint16_t));
 #endif
 
+  // The noise table uses rand(), so fill it before releasing the GIL.
+  precalculate_dithering_noise_if_required();
+
+  Py_BEGIN_ALLOW_THREADS
   tile_convert_rgba16_to_rgba8_c((uint16_t*)PyArray_DATA(src_arr),
                                  PyArray_STRIDES(src_arr)[0],
                                  (uint8_t*)PyArray_DATA(dst_arr),
                                  PyArray_STRIDES(dst_arr)[0],
                                  EOTF);
+  Py_END_ALLOW_THREADS
 }
 
 static inline void
@@ -461,17 +528,23 @@ void tile_convert_rgbu16_to_rgbu8(PyObject * src, PyObject * dst, const float EO
   assert(PyArray_STRIDE(src_arr, 2) ==   sizeof(uint16_t));
 #endif
 
+  precalculate_dithering_noise_if_required();
+
+  Py_BEGIN_ALLOW_THREADS
   tile_convert_rgbu16_to_rgbu8_c((uint16_t*)PyArray_DATA(src_arr), PyArray_STRIDES(src_arr)[0],
                                  (uint8_t*)PyArray_DATA(dst_arr), PyArray_STRIDES(dst_arr)[0],
                                   EOTF);
+  Py_END_ALLOW_THREADS
 }
 
-void tile_convert_rgba8_to_rgba16_const(PyObject * src, PyObject * dst) {
-  PyArrayObject* src_arr = ((PyArrayObject*)src);
-  PyArrayObject* dst_arr = ((PyArrayObject*)dst);
+static void
+tile_convert_rgba8_to_rgba16_c(const uint8_t *src, const npy_intp src_strides,
+                               uint16_t *dst, const npy_intp dst_strides,
+                               const float EOTF)
+{
   for (int y=0; y<MYPAINT_TILE_SIZE; y++) {
-    uint8_t  * src_p = (uint8_t*)((char *)PyArray_DATA(src_arr) + y*PyArray_STRIDES(src_arr)[0]);
-    uint16_t * dst_p = (uint16_t*)((char *)PyArray_DATA(dst_arr) + y*PyArray_STRIDES(dst_arr)[0]);
+    const uint8_t *src_p = (const uint8_t*)((const char *)src + y*src_strides);
+    uint16_t *dst_p = (uint16_t*)((char *)dst + y*dst_strides);
     for (int x=0; x<MYPAINT_TILE_SIZE; x++) {
       uint32_t r, g, b, a;
       r = *src_p++;
@@ -480,9 +553,16 @@ void tile_convert_rgba8_to_rgba16_const(PyObject * src, PyObject * dst) {
       a = *src_p++;
 
       // convert to fixed point (with rounding)
-      r = (r * (1<<15) + 255/2) / 255;
-      g = (g * (1<<15) + 255/2) / 255;
-      b = (b * (1<<15) + 255/2) / 255;
+      if (EOTF == 1.0) {
+        r = (r * (1<<15) + 255/2) / 255;
+        g = (g * (1<<15) + 255/2) / 255;
+        b = (b * (1<<15) + 255/2) / 255;
+      }
+      else {
+        r = uint32_t(fastpow((float)r/255.0, EOTF) * (1<<15) + 0.5);
+        g = uint32_t(fastpow((float)g/255.0, EOTF) * (1<<15) + 0.5);
+        b = uint32_t(fastpow((float)b/255.0, EOTF) * (1<<15) + 0.5);
+      }
       a = (a * (1<<15) + 255/2) / 255;
 
       // premultiply alpha (with rounding), save back
@@ -497,11 +577,6 @@ void tile_convert_rgba8_to_rgba16_const(PyObject * src, PyObject * dst) {
 
 // used mainly for loading layers (transparent PNG)
 void tile_convert_rgba8_to_rgba16(PyObject * src, PyObject * dst, const float EOTF) {
-
-  if (EOTF == 1.0) {
-    tile_convert_rgba8_to_rgba16_const(src, dst);
-    return;
-  }
   PyArrayObject* src_arr = ((PyArrayObject*)src);
   PyArrayObject* dst_arr = ((PyArrayObject*)dst);
 
@@ -525,29 +600,113 @@ void tile_convert_rgba8_to_rgba16(PyObject * src, PyObject * dst, const float EO
   assert(PyArray_STRIDES(src_arr)[2] ==   sizeof(uint8_t));
 #endif
 
-  for (int y=0; y<MYPAINT_TILE_SIZE; y++) {
-    uint8_t  * src_p = (uint8_t*)((char *)PyArray_DATA(src_arr) + y*PyArray_STRIDES(src_arr)[0]);
-    uint16_t * dst_p = (uint16_t*)((char *)PyArray_DATA(dst_arr) + y*PyArray_STRIDES(dst_arr)[0]);
-    for (int x=0; x<MYPAINT_TILE_SIZE; x++) {
-      uint32_t r, g, b, a;
-      r = *src_p++;
-      g = *src_p++;
-      b = *src_p++;
-      a = *src_p++;
+  Py_BEGIN_ALLOW_THREADS
+  tile_convert_rgba8_to_rgba16_c((uint8_t*)PyArray_DATA(src_arr), PyArray_STRIDES(src_arr)[0],
+                                 (uint16_t*)PyArray_DATA(dst_arr), PyArray_STRIDES(dst_arr)[0],
+                                 EOTF);
+  Py_END_ALLOW_THREADS
+}
 
-      // convert to fixed point (with rounding)
-      r = uint32_t(fastpow((float)r/255.0, EOTF) * (1<<15) + 0.5);
-      g = uint32_t(fastpow((float)g/255.0, EOTF) * (1<<15) + 0.5);
-      b = uint32_t(fastpow((float)b/255.0, EOTF) * (1<<15) + 0.5);
-      a = (a * (1<<15) + 255/2) / 255;
 
-      // premultiply alpha (with rounding), save back
-      *dst_p++ = (r * a + (1<<15)/2) / (1<<15);
-      *dst_p++ = (g * a + (1<<15)/2) / (1<<15);
-      *dst_p++ = (b * a + (1<<15)/2) / (1<<15);
-      *dst_p++ = a;
+struct ConvertJob {
+  const uint8_t *src;
+  npy_intp src_strides;
+  uint16_t *dst;
+  npy_intp dst_strides;
+};
+
+
+void tile_convert_rgba8_to_rgba16_batch(PyObject *jobs, const float EOTF) {
+  if (!PyList_Check(jobs)) {
+    PyErr_SetString(PyExc_TypeError, "jobs must be a list");
+    return;
+  }
+  // Gather the array pointers while holding the GIL. The list
+  // keeps the arrays alive for the duration of the call.
+  const Py_ssize_t n = PyList_GET_SIZE(jobs);
+  std::vector<ConvertJob> work;
+  work.reserve(n);
+  for (Py_ssize_t i = 0; i < n; ++i) {
+    PyObject *src = NULL;
+    PyObject *dst = NULL;
+    if (!PyArg_ParseTuple(PyList_GET_ITEM(jobs, i), "OO", &src, &dst)) {
+      return;
     }
+    PyArrayObject* src_arr = ((PyArrayObject*)src);
+    PyArrayObject* dst_arr = ((PyArrayObject*)dst);
+#ifdef HEAVY_DEBUG
+    assert(PyArray_Check(src));
+    assert(PyArray_TYPE(src_arr) == NPY_UINT8);
+    assert(PyArray_STRIDES(src_arr)[1] == 4*sizeof(uint8_t));
+    assert(PyArray_Check(dst));
+    assert(PyArray_TYPE(dst_arr) == NPY_UINT16);
+    assert(PyArray_ISCARRAY(dst_arr));
+#endif
+    ConvertJob job = {
+      (const uint8_t*)PyArray_DATA(src_arr), PyArray_STRIDES(src_arr)[0],
+      (uint16_t*)PyArray_DATA(dst_arr), PyArray_STRIDES(dst_arr)[0],
+    };
+    work.push_back(job);
+  }
+
+  Py_BEGIN_ALLOW_THREADS
+  for (size_t i = 0; i < work.size(); ++i) {
+    const ConvertJob &job = work[i];
+    tile_convert_rgba8_to_rgba16_c(job.src, job.src_strides,
+                                   job.dst, job.dst_strides,
+                                   EOTF);
   }
+  Py_END_ALLOW_THREADS
+}
+
+
+PyObject *
+tile_rgba8_row_nonempty(PyObject *src)
+{
+  PyArrayObject* src_arr = ((PyArrayObject*)src);
+#ifdef HEAVY_DEBUG
+  assert(PyArray_Check(src));
+  assert(PyArray_NDIM(src_arr) == 3);
+  assert(PyArray_DIM(src_arr, 0) == MYPAINT_TILE_SIZE);
+  assert(PyArray_DIM(src_arr, 1) % MYPAINT_TILE_SIZE == 0);
+  assert(PyArray_DIM(src_arr, 2) == 4);
+  assert(PyArray_TYPE(src_arr) == NPY_UINT8);
+  assert(PyArray_STRIDES(src_arr)[1] == 4*sizeof(uint8_t));
+#endif
+  const int ntiles = PyArray_DIM(src_arr, 1) / MYPAINT_TILE_SIZE;
+  const npy_intp row_strides = PyArray_STRIDES(src_arr)[0];
+  const char *data = (const char *)PyArray_DATA(src_arr);
+  std::vector<char> nonempty(ntiles, 0);
+
+  Py_BEGIN_ALLOW_THREADS
+  for (int i = 0; i < ntiles; ++i) {
+    for (int y = 0; y < MYPAINT_TILE_SIZE && !nonempty[i]; ++y) {
+      const uint8_t *p = (const uint8_t *)(data + y*row_strides)
+                       + i*MYPAINT_TILE_SIZE*4;
+      for (int x = 0; x < MYPAINT_TILE_SIZE; ++x) {
+        if (p[x*4 + 3]) {
+          nonempty[i] = 1;
+          break;
+        }
+      }
+    }
+  }
+  Py_END_ALLOW_THREADS
+
+  PyObject* result = PyList_New(0);
+  if (! result) {
+    PyErr_SetString(PyExc_MemoryError, "Unable to create result list");
+    return NULL;
+  }
+  for (int i = 0; i < ntiles; ++i) {
+    if (! nonempty[i]) {
+      continue;
+    }
+    PyObject *index = PyLong_FromLong(i);
+    PyList_Append(result, index);
+    Py_DECREF(index);
+  }
+  return result;
 }
 
 
@@ -871,6 +1030,11 @@ tile_combine (enum CombineMode mode,
         return;
     }
     const TileDataCombineOp *op = combine_mode_info[mode];
+
+    // The combine ops are pure functions of the two buffers, so other
+    // Python threads (e.g. parallel tile renderers) may run meanwhile.
+    Py_BEGIN_ALLOW_THREADS
     op->combine_data(src_p, dst_p, dst_has_alpha, src_opacity);
+    Py_END_ALLOW_THREADS
 }
 
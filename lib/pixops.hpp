@@ -19,6 +19,12 @@
 
 void tile_downscale_rgba16(PyObject *src, PyObject *dst, int dst_x, int dst_y);
 
+// Runs many tile_downscale_rgba16() operations at once, without the GIL.
+// Takes a list of (src, dst, dst_x, dst_y) tuples. Used for regenerating
+// a whole mipmap level in one go.
+
+void tile_downscale_rgba16_batch(PyObject *jobs);
+
 
 // Used to e.g. copy the background before starting to composite over it
 //
@@ -50,9 +56,22 @@ void tile_convert_rgbu16_to_rgbu8(PyObject *src, PyObject *dst, const float EOTF
 
 
 // used mainly for loading layers (transparent PNG)
+// The GIL is released while converting.
 
 void tile_convert_rgba8_to_rgba16(PyObject *src, PyObject *dst, const float EOTF);
 
+// Runs many tile_convert_rgba8_to_rgba16() operations at once, without
+// the GIL. Takes a list of (src, dst) tuples. Used for loading PNGs a
+// tile row at a time on worker threads.
+
+void tile_convert_rgba8_to_rgba16_batch(PyObject *jobs, const float EOTF);
+
+// Scans a row of 8bpp RGBA tiles (an N x (N*ntiles) x 4 array) for tiles
+// with any nonzero alpha, without the GIL. Returns a list of the column
+// indices of those tiles, so that transparent ones can be skipped.
+
+PyObject *tile_rgba8_row_nonempty(PyObject *src);
+
 
 // Flatten a premultiplied rgba layer, using "bg" as background.
 // (bg is assumed to be flat, bg.alpha is ignored)
@@ -124,6 +143,7 @@ combine_mode_get_info(enum CombineMode mode);
 
 
 // Blend and composite one tile, writing into the destination.
+// The GIL is released while the pixel data is being combined.
 
 void
 tile_combine (enum CombineMode mode,
@@ -56,4 +56,42 @@ public:
     return res;
   }
 
+  // Replay recorded events in a single call. The array must be an
+  // aligned, C-contiguous float64 array of shape (N, 9), one row per
+  // event: dtime, x, y, pressure, xtilt, ytilt, viewzoom,
+  // viewrotation, barrel_rotation. It may be read-only. Each row is
+  // passed to stroke_to() exactly as the per-event Python loop would
+  // pass it, so the output is the same. Returns the number of events
+  // replayed, or NULL with a Python exception set if the array is
+  // unsuitable or the surface code raised an exception.
+  PyObject * stroke_to_events (Surface * surface, PyObject * obj, bool linear)
+  {
+    if (! PyArray_Check(obj)) {
+      PyErr_SetString(PyExc_TypeError, "events: expected a numpy array");
+      return NULL;
+    }
+    PyArrayObject* data = (PyArrayObject*)obj;
+    if (PyArray_NDIM(data) != 2 || PyArray_DIM(data, 1) != 9) {
+      PyErr_SetString(PyExc_ValueError, "events: expected shape (n, 9)");
+      return NULL;
+    }
+    if (PyArray_TYPE(data) != NPY_FLOAT64 || ! PyArray_ISCARRAY_RO(data)) {
+      PyErr_SetString(
+        PyExc_ValueError,
+        "events: expected an aligned, C-contiguous float64 array"
+      );
+      return NULL;
+    }
+    const npy_intp n = PyArray_DIM(data, 0);
+    const npy_float64 * ev = (const npy_float64*)PyArray_DATA(data);
+    for (npy_intp i=0; i<n; i++, ev+=9) {
+      Brush::stroke_to (surface, ev[1], ev[2], ev[3], ev[4], ev[5],
+                        ev[0], ev[6], ev[7], ev[8], linear);
+      if (PyErr_Occurred()) {
+        return NULL;
+      }
+    }
+    return PyLong_FromSsize_t(n);
+  }
+
 };
@@ -56,7 +56,8 @@ tile_request_start(MyPaintTiledSurface *tiled_surface, MyPaintTileRequest *reque
         assert(PyArray_ISCARRAY(rgba));
         assert(PyArray_TYPE(rgba) == NPY_UINT16);
 #endif
-        // tiledsurface.py will keep a reference in its tiledict, at least until the final end_atomic()
+        // tiledsurface.py will keep a reference in its tiledict, at least until the final end_atomic().
+        // Uniform tiles' shared read-only arrays are referenced by the _Tile itself.
         Py_DECREF((PyObject *)rgba);
         request->buffer = (uint16_t*)PyArray_DATA(rgba);
     }
@@ -7,11 +7,107 @@
 # the Free Software Foundation; either version 2 of the License, or
 # (at your option) any later version.
 
+import zlib
+
 import numpy as np
 
 from . import brush
 
 
+## Event storage
+
+#: Number of values in each recorded event.
+_EVENT_FIELDS = 9
+
+#: Events room is made for when recording starts; doubled as needed.
+_INITIAL_EVENT_CAPACITY = 256
+
+
+def _encode_events(events):
+    """Pack recorded events into compact compressed bytes
+
+    :param numpy.ndarray events: Events, shape (n, 9), float64.
+    :returns: Compressed data, for `_decode_events()`.
+    :rtype: bytes
+
+    The brush engine takes dtime as a double, but all the other
+    values as single-precision floats, so those are stored as
+    float32 without losing anything the engine would see. Each
+    column's bit patterns are XORed with the previous event's, and
+    their bytes are grouped by significance before compressing.
+    Neighbouring events are similar, so this leaves long runs of
+    zeros for zlib to squeeze.
+
+    >>> ev = np.zeros((1000, 9), "float64")
+    >>> ev[:, 0] = 0.008
+    >>> ev[:, 1] = np.linspace(100, 400, 1000)
+    >>> ev[:, 2] = np.sin(np.linspace(0, 3, 1000)) * 50
+    >>> ev[:, 3] = 0.5
+    >>> data = _encode_events(ev)
+    >>> len(data) < ev.nbytes // 4
+    True
+    >>> ev2 = _decode_events(data, len(ev))
+    >>> ev2.dtype == np.float64 and ev2.shape == ev.shape
+    True
+    >>> bool((ev2[:, 0] == ev[:, 0]).all())
+    True
+    >>> bool((ev2[:, 1:] == ev[:, 1:].astype("float32")).all())
+    True
+
+    """
+    dtimes = np.ascontiguousarray(events[:, 0], dtype="float64")
+    values = np.ascontiguousarray(events[:, 1:].T, dtype="float32")
+    chunks = (
+        _delta_shuffle(dtimes.view("uint64")),
+        _delta_shuffle(values.view("uint32")),
+    )
+    return zlib.compress(b"".join(chunks))
+
+
+def _decode_events(data, n):
+    """Unpack events packed by `_encode_events()`
+
+    :param bytes data: Compressed event data.
+    :param int n: Number of events packed.
+    :returns: Events, shape (n, 9), as float64.
+    :rtype: numpy.ndarray
+
+    """
+    raw = np.frombuffer(zlib.decompress(data), dtype="uint8")
+    split = n * 8
+    dtimes = _unshuffle_undelta(raw[:split], (n,), "uint64")
+    values = _unshuffle_undelta(
+        raw[split:],
+        (_EVENT_FIELDS - 1, n),
+        "uint32",
+    )
+    events = np.empty((n, _EVENT_FIELDS), dtype="float64")
+    events[:, 0] = dtimes.view("float64")
+    events[:, 1:] = values.view("float32").T
+    return events
+
+
+def _delta_shuffle(bits):
+    """XOR each value with its predecessor, then group bytes by position"""
+    deltas = bits.copy()
+    deltas[..., 1:] ^= bits[..., :-1]
+    size = bits.dtype.itemsize
+    planes = deltas.view("uint8").reshape(deltas.shape + (size,))
+    return np.moveaxis(planes, -1, 0).tobytes()
+
+
+def _unshuffle_undelta(raw, shape, dtype):
+    """Inverse of `_delta_shuffle()`"""
+    size = np.dtype(dtype).itemsize
+    planes = raw.reshape((size,) + shape)
+    deltas = np.ascontiguousarray(np.moveaxis(planes, 0, -1))
+    deltas = deltas.view(dtype).reshape(shape)
+    return np.bitwise_xor.accumulate(deltas, axis=-1)
+
+
+## Class defs
+
+
 class Stroke(object):
     """Replayable record of a stroke's data
 
@@ -46,7 +142,11 @@ class Stroke(object):
         self.brush = brush
         self.brush.new_stroke()  # resets the stroke_* members of the brush
 
-        self.tmp_event_list = []
+        self._events = np.empty(
+            (_INITIAL_EVENT_CAPACITY, _EVENT_FIELDS),
+            dtype="float64",
+        )
+        self._event_count = 0
 
     def record_event(
         self,
@@ -61,35 +161,54 @@ class Stroke(object):
         barrel_rotation,
     ):
         assert not self.finished
-        self.tmp_event_list.append(
-            (
-                dtime,
-                x,
-                y,
-                pressure,
-                xtilt,
-                ytilt,
-                viewzoom,
-                viewrotation,
-                barrel_rotation,
-            )
+        n = self._event_count
+        if n == len(self._events):
+            events = np.empty((n * 2, _EVENT_FIELDS), dtype="float64")
+            events[:n] = self._events
+            self._events = events
+        self._events[n] = (
+            dtime,
+            x,
+            y,
+            pressure,
+            xtilt,
+            ytilt,
+            viewzoom,
+            viewrotation,
+            barrel_rotation,
         )
+        self._event_count = n + 1
 
     def stop_recording(self):
         if self.finished:
             return
-        # OPTIMIZE
-        # - for space: just gzip? use integer datatypes?
-        # - for time: maybe already use array storage while recording?
-        data = np.array(self.tmp_event_list, dtype="float64")
-        data = data.tobytes()
-        version = b"2"
+        # Finished strokes live on in the undo stack, so keep them small.
+        # Version 3 is the compressed format of _encode_events().
+        data = _encode_events(self._events[: self._event_count])
+        version = b"3"
         self.stroke_data = version + data
 
         self.total_painting_time = self.brush.get_total_stroke_painting_time()
-        del self.brush, self.tmp_event_list
+        del self.brush, self._events
         self.finished = True
 
+    def get_events(self):
+        """Decode the recorded events of a finished stroke
+
+        :returns: Events, one row per event, in the order
+            (dtime, x, y, pressure, xtilt, ytilt,
+            viewzoom, viewrotation, barrel_rotation).
+        :rtype: numpy.ndarray
+
+        """
+        assert self.finished
+        version, data = self.stroke_data[0:1], self.stroke_data[1:]
+        if version == b"2":
+            events = np.frombuffer(data, dtype="float64")
+            return events.reshape((-1, _EVENT_FIELDS))
+        assert version == b"3"
+        return _decode_events(data, self._event_count)
+
     def is_empty(self):
         return self.total_painting_time == 0
 
@@ -98,41 +217,21 @@ class Stroke(object):
     def render(self, surface):
         assert self.finished
 
-        # OPTIMIZE: check if parsing of settings is a performance bottleneck
-        b = brush.Brush(brush.BrushInfo(self.brush_settings))
+        bi = brush.get_parsed_brushinfo(self.brush_settings)
+        b = brush.Brush(bi)
+        try:
+            self._render_with_brush(surface, b)
+        finally:
+            b.release_brushinfo()
 
-        states = np.fromstring(self.brush_state, dtype="float32")
+    def _render_with_brush(self, surface, b):
+        states = np.frombuffer(self.brush_state, dtype="float32").copy()
         b.set_states_from_array(states)
 
-        version, data = self.stroke_data[0:1], self.stroke_data[1:]
-        assert version == b"2"
-        data = np.fromstring(data, dtype="float64")
-        data.shape = (len(data) // 9, 9)
+        data = self.get_events()
 
         surface.begin_atomic()
-        for (
-            dtime,
-            x,
-            y,
-            pressure,
-            xtilt,
-            ytilt,
-            viewzoom,
-            viewrotation,
-            barrel_rotation,
-        ) in data:
-            b.stroke_to(
-                surface.backend,
-                x,
-                y,
-                pressure,
-                xtilt,
-                ytilt,
-                dtime,
-                viewzoom,
-                viewrotation,
-                barrel_rotation,
-            )
+        b.stroke_to_events(surface.backend, data)
         surface.end_atomic()
 
     def copy_using_different_brush(self, brushinfo):
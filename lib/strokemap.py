@@ -12,6 +12,7 @@
 import struct
 import zlib
 import math
+from io import BytesIO
 from logging import getLogger
 from warnings import warn
 
@@ -26,6 +27,9 @@ from lib.pycompat import PY3, iteritems
 logger = getLogger(__name__)
 TILE_SIZE = N = mypaintlib.TILE_SIZE
 
+#: Header of each tile in the "v2" strokemap format: tx, ty, data size.
+_TILE_HEADER = struct.Struct(">iiI")
+
 
 ## Class defs
 
@@ -37,14 +41,62 @@ class StrokeShape(object):
     information is stored in compressed memory blocks of the size of a
     tile (for fast lookup).
 
+    Each shape also keeps its footprint: the set of tile indices which
+    might hold some of its pixels. Unlike the strokemap itself, this is
+    always up to date, even while there is still work queued for the
+    shape, so it can be used for indexing. See `StrokeIndex`.
+
     """
 
+    #: Bumped whenever any shape's footprint moves or shrinks.
+    #: Indexes use this to tell when they need to be rebuilt.
+    geometry_serial = 0
+
     def __init__(self):
         """Construct a new, blank StrokeShape."""
         object.__init__(self)
         self.tasks = idletask.Processor()
         self.strokemap = {}
         self.brush_string = None
+        self._footprint = set()
+        self._encoded_size = None
+        self._geometry_stamp = 0
+
+    @property
+    def geometry_stamp(self):
+        """The value of `geometry_serial` when the shape last changed
+
+        :rtype: int
+
+        This is 0 for shapes which have never been moved or trimmed.
+        Savers can compare it against a value they recorded earlier
+        to tell whether data they wrote back then is still current.
+
+        >>> shape = StrokeShape._mock()
+        >>> shape.geometry_stamp
+        0
+        >>> shape.translate(N, 0)
+        >>> shape.geometry_stamp == StrokeShape.geometry_serial
+        True
+
+        """
+        return self._geometry_stamp
+
+    @property
+    def footprint(self):
+        """Indices of the tiles which may be touched by the shape
+
+        :rtype: frozenset
+
+        >>> shape = StrokeShape._mock()
+        >>> sorted(shape.footprint)[:3]
+        [(0, 0), (0, 1), (0, 2)]
+        >>> shape.translate(N // 2, 0)
+        >>> (4, 0) in shape.footprint
+        True
+
+        """
+        return frozenset(self._footprint)
 
     @classmethod
     def _mock(cls):
@@ -79,6 +131,7 @@ class StrokeShape(object):
             return None
         shape = cls()
         assert not shape.strokemap
+        shape._footprint = set(changed_idxs)
         shape.tasks.add_work(
             _TileDiffUpdateTask(
                 before.tiledict,
@@ -89,6 +142,31 @@ class StrokeShape(object):
         )
         return shape
 
+    def copy(self):
+        """Returns an independent copy of the shape, for saving.
+
+        Any queued work is completed first. The copy shares the
+        immutable tile data, but not the strokemap dict itself,
+        so it can be written out while the original is changed.
+
+        >>> shape = StrokeShape._mock()
+        >>> shape2 = shape.copy()
+        >>> shape.translate(N, 0)
+        >>> shape2.footprint == shape.footprint
+        False
+        >>> set((tx + 1, ty) for (tx, ty) in shape2.footprint) == shape.footprint
+        True
+
+        """
+        self.tasks.finish_all()
+        shape = StrokeShape()
+        shape.strokemap = dict(self.strokemap)
+        shape.brush_string = self.brush_string
+        shape._footprint = set(self._footprint)
+        shape._encoded_size = self._encoded_size
+        shape._geometry_stamp = self._geometry_stamp
+        return shape
+
     def init_from_string(self, data, translate_x, translate_y):
         """Initialize from a saved compressed byte string.
 
@@ -101,14 +179,18 @@ class StrokeShape(object):
         assert not self.strokemap
         assert translate_x % N == 0
         assert translate_y % N == 0
-        translate_x /= N
-        translate_y /= N
-        while data:
-            tx, ty, size = struct.unpack(">iiI", data[: 3 * 4])
-            compressed_bitmap = data[3 * 4 : size + 3 * 4]
+        translate_x //= N
+        translate_y //= N
+        self._encoded_size = None
+        pos = 0
+        while pos < len(data):
+            tx, ty, size = _TILE_HEADER.unpack_from(data, pos)
+            pos += _TILE_HEADER.size
+            compressed_bitmap = data[pos : pos + size]
+            pos += size
             tile = _Tile.new_from_compressed_bitmap(compressed_bitmap)
             self.strokemap[tx + translate_x, ty + translate_y] = tile
-            data = data[size + 3 * 4 :]
+            self._footprint.add((tx + translate_x, ty + translate_y))
 
     def save_to_string(self, translate_x, translate_y):
         """Return a compressed bytes string representing the stroke shape.
@@ -119,24 +201,64 @@ class StrokeShape(object):
         >>> bstr = shape.save_to_string(-N, 2*N)
         >>> isinstance(bstr, bytes)
         True
+        >>> len(bstr) == shape.encoded_size
+        True
+        >>> shape2 = StrokeShape()
+        >>> shape2.init_from_string(bstr, N, -2*N)
+        >>> shape2.footprint == shape.footprint
+        True
 
         See lib.layer.data.PaintingLayer.save_to_openraster().
         Format: "v2" strokemap format.
 
+        """
+        buf = BytesIO()
+        self.write_to_file(buf, translate_x, translate_y)
+        return buf.getvalue()
+
+    def write_to_file(self, f, translate_x, translate_y):
+        """Write the shape's saved form to a file-like object.
+
+        :param f: Binary file-like object to write to.
+        :param int translate_x: Offset to apply, a multiple of N.
+        :param int translate_y: Offset to apply, a multiple of N.
+
+        The bytes written are the same as `save_to_string()` returns,
+        but each tile's compressed bitmap is written directly
+        rather than being copied into one big string first.
+
         """
         assert translate_x % N == 0
         assert translate_y % N == 0
         translate_x = int(translate_x // N)
         translate_y = int(translate_y // N)
         self.tasks.finish_all()
-        data = b""
+        pack = _TILE_HEADER.pack
         for (tx, ty), tile in iteritems(self.strokemap):
             compressed_bitmap = tile.to_bytes()
             tx = int(tx + translate_x)
             ty = int(ty + translate_y)
-            data += struct.pack(">iiI", tx, ty, len(compressed_bitmap))
-            data += compressed_bitmap
-        return data
+            f.write(pack(tx, ty, len(compressed_bitmap)))
+            f.write(compressed_bitmap)
+
+    @property
+    def encoded_size(self):
+        """Length of the shape's saved form, in bytes
+
+        :rtype: int
+
+        This is remembered between saves until the shape changes,
+        so that writers can emit a stroke's length before its data
+        without encoding it twice.
+
+        """
+        if self._encoded_size is None:
+            self.tasks.finish_all()
+            self._encoded_size = sum(
+                _TILE_HEADER.size + len(tile.to_bytes())
+                for tile in self.strokemap.values()
+            )
+        return self._encoded_size
 
     def _complete_tile_tasks(self, pred):
         """Complete all queued work on a subset of tiles.
@@ -175,11 +297,12 @@ class StrokeShape(object):
         x = int(x)
         y = int(y)
         pixel_ti = (x // N, y // N)
+        if pixel_ti not in self._footprint:
+            return False
         self._complete_tile_tasks(lambda ti: (ti == pixel_ti))
         tile = self.strokemap.get(pixel_ti)
         if tile:
-            array = tile.to_array()
-            return bool(array[y % N, x % N])
+            return tile.get_pixel(x % N, y % N)
         return False
 
     def render_to_surface(self, surf, bbox=None, center=None):
@@ -215,6 +338,17 @@ class StrokeShape(object):
         tmp = {}
         self.tasks.add_work(_TileTranslateTask(self.strokemap, tmp, dx, dy))
         self.tasks.add_work(_TileRecompressTask(tmp, self.strokemap))
+        self._encoded_size = None
+        slices_x = tiledsurface.calc_translation_slices(int(dx))
+        slices_y = tiledsurface.calc_translation_slices(int(dy))
+        self._footprint = set(
+            (tx + targ_tdx, ty + targ_tdy)
+            for (tx, ty) in self._footprint
+            for (_src, (targ_tdx, _x0, _x1)) in slices_x
+            for (_src, (targ_tdy, _y0, _y1)) in slices_y
+        )
+        StrokeShape.geometry_serial += 1
+        self._geometry_stamp = StrokeShape.geometry_serial
 
     def trim(self, rect):
         """Trim the shape to a rectangle, discarding data outside it
@@ -232,9 +366,84 @@ class StrokeShape(object):
         for tx, ty in list(self.strokemap.keys()):
             if tx * N + N < x or ty * N + N < y or tx * N > x + w or ty * N > y + h:
                 self.strokemap.pop((tx, ty))
+        self._footprint = set(self.strokemap.keys())
+        self._encoded_size = None
+        StrokeShape.geometry_serial += 1
+        self._geometry_stamp = StrokeShape.geometry_serial
         return bool(self.strokemap)
 
 
+class StrokeIndex(object):
+    """Inverted index from tiles to the strokes touching them
+
+    Picking a stroke from a layer's strokemap means finding the
+    topmost stroke whose shape has a given pixel set. Testing every
+    stroke gets slow on layers with thousands of them, so this index
+    narrows the search down to the strokes whose footprints include
+    the pixel's tile.
+
+    The index is built from a list of StrokeShapes in painting order,
+    and brought up to date before each query. Appending strokes, the
+    common case, only indexes the new ones. Any other change to the
+    list, or a shape being moved or trimmed, rebuilds the index.
+
+    >>> shapes = [StrokeShape._mock(), StrokeShape._mock()]
+    >>> index = StrokeIndex()
+    >>> index.get_strokes_at(shapes, 1, 0) == [shapes[1], shapes[0]]
+    True
+    >>> index.get_strokes_at(shapes, 1000, 1000)
+    []
+    >>> shapes.append(StrokeShape())
+    >>> len(index.get_strokes_at(shapes, 1, 0))
+    2
+
+    """
+
+    def __init__(self):
+        super(StrokeIndex, self).__init__()
+        self._strokes = []
+        self._tiles = {}  # {(tx, ty): [stroke position, ...]}
+        self._geometry_serial = None
+
+    def _update(self, strokes):
+        """Bring the index up to date with a list of strokes"""
+        indexed = self._strokes
+        n = len(indexed)
+        valid = (
+            self._geometry_serial == StrokeShape.geometry_serial
+            and len(strokes) >= n
+            and all(a is b for (a, b) in zip(indexed, strokes))
+        )
+        if not valid:
+            self._tiles = {}
+            n = 0
+        if n == len(strokes) and valid:
+            return
+        tiles = self._tiles
+        for i in range(n, len(strokes)):
+            for ti in strokes[i].footprint:
+                tiles.setdefault(ti, []).append(i)
+        self._strokes = list(strokes)
+        self._geometry_serial = StrokeShape.geometry_serial
+
+    def get_strokes_at(self, strokes, x, y):
+        """Get the strokes which might touch a pixel, topmost first
+
+        :param list strokes: StrokeShapes, in painting order.
+        :param int x: Pixel X position.
+        :param int y: Pixel Y position.
+        :returns: Candidate StrokeShapes from strokes.
+        :rtype: list
+
+        Each candidate's footprint includes the pixel's tile, but its
+        bitmap must still be tested with `StrokeShape.touches_pixel()`.
+
+        """
+        self._update(strokes)
+        positions = self._tiles.get((int(x) // N, int(y) // N), ())
+        return [strokes[i] for i in reversed(positions)]
+
+
 class _TileDiffUpdateTask:
     """Idle task: update strokemap with tile & pixel diffs of snapshots.
 
@@ -284,8 +493,8 @@ class _TileDiffUpdateTask:
     def _update_tile(self, ti):
         """Diff and update the tile at a specified position."""
         transparent = tiledsurface.transparent_tile
-        data_before = self._before_dict.get(ti, transparent).rgba
-        data_after = self._after_dict.get(ti, transparent).rgba
+        data_before = self._before_dict.get(ti, transparent).readonly_rgba
+        data_after = self._after_dict.get(ti, transparent).readonly_rgba
         self._targ_dict[ti] = _Tile.new_from_diff(data_before, data_after)
 
 
@@ -485,6 +694,18 @@ class _Tile:
         # Can this result always be treated as read-only?
         return array
 
+    def get_pixel(self, x, y):
+        """Test whether a single pixel is set, by tile-relative position
+
+        >>> ones, checks, zeros = _Tile._mocks()
+        >>> ones.get_pixel(0, 0), checks.get_pixel(0, 0)
+        (True, False)
+
+        """
+        if self._all:
+            return True
+        return bool(self.to_array()[y, x])
+
     def to_bytes(self):
         """Convert to a bytestring which is storable in "v2" strokemaps.
 
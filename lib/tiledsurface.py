@@ -16,6 +16,15 @@ import sys
 import os
 import contextlib
 import logging
+import hashlib
+import threading
+import zlib
+import bisect
+import itertools
+import multiprocessing
+from collections import deque
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 from gettext import gettext as _
 import numpy as np
@@ -30,6 +39,7 @@ from lib.surface import TileCompositable
 from .errors import FileHandlingError
 import lib.fileutils
 import lib.modes
+import lib.cache
 import lib.feedback
 import lib.floodfill
 from lib.pycompat import xrange
@@ -53,6 +63,55 @@ SYMMETRY_STRINGS = {
 for sym_type in SYMMETRY_TYPES:
     assert sym_type in SYMMETRY_STRINGS
 
+#: Number of threads converting decoded tile rows in load_from_png().
+#: A value of 1 means that rows are converted serially.
+try:
+    DEFAULT_PNG_LOAD_THREADS = min(4, multiprocessing.cpu_count())
+except NotImplementedError:
+    DEFAULT_PNG_LOAD_THREADS = 1
+
+#: Most decoded tile rows waiting for conversion in load_from_png().
+#: Bounds the memory used when loading huge images.
+PNG_LOAD_MAX_ROWS_IN_FLIGHT = 8
+
+_png_load_pool = None
+_png_load_pool_lock = threading.Lock()
+
+
+def _get_png_load_pool():
+    """Get the shared PNG row conversion pool, or None if serial"""
+    global _png_load_pool
+    if DEFAULT_PNG_LOAD_THREADS <= 1:
+        return None
+    with _png_load_pool_lock:
+        if _png_load_pool is None:
+            _png_load_pool = ThreadPoolExecutor(
+                max_workers=DEFAULT_PNG_LOAD_THREADS,
+                thread_name_prefix="pngload",
+            )
+    return _png_load_pool
+
+
+def _convert_png_tile_row(buf, eotf_value):
+    """Convert one tile row of 8bpc RGBA to fix15 tile arrays
+
+    :param numpy.ndarray buf: uint8 data, N rows high, N*k wide.
+    :param float eotf_value: The EOTF to apply.
+    :returns: (column index, rgba array) for each non-empty tile.
+    :rtype: list
+
+    Fully transparent tiles are skipped. The scan and the conversion
+    both release the GIL, so this can usefully run on a worker thread.
+
+    """
+    cols = mypaintlib.tile_rgba8_row_nonempty(buf)
+    jobs = [
+        (buf[:, i * N : (i + 1) * N, :], np.empty((N, N, 4), "uint16"))
+        for i in cols
+    ]
+    mypaintlib.tile_convert_rgba8_to_rgba16_batch(jobs, eotf_value)
+    return [(i, dst) for (i, (src, dst)) in zip(cols, jobs)]
+
 
 ## Tile class and marker tile constants
 
@@ -65,19 +124,181 @@ class _Tile(object):
     (requiring 16 bits). This is to allow many calculations to divide by
     2**15 instead of (2**16-1).
 
+    Tiles are shared between the TileStores of surfaces and their
+    snapshots. The `refs` count is maintained by the stores, and a tile
+    held by more than one store is read-only: it must be copied before
+    it can be written to. It is only changed with _TILE_STORE_LOCK held.
+
+    A tile whose pixels are all the same can be stored as just that one
+    colour. Such uniform tiles are expanded to a full array the first
+    time their `rgba` is accessed, which is how they get written to.
+    Readers should use `readonly_rgba` instead, which doesn't expand.
+
+    A tile's pixels may also have been swapped out to disk by a
+    TileSwap. Accessing them faults them back in transparently.
+    Tiles with write loans outstanding (see `loans`) are never
+    swapped out, since that would orphan the array being written.
+
+    >>> t = _Tile(color=(0, 0, 0, 1 << 15))
+    >>> t.uniform_color, t.nbytes
+    ((0, 0, 0, 32768), 8)
+    >>> t.readonly_rgba.shape
+    (64, 64, 4)
+    >>> t.rgba[0, 0, 3] = 0
+    >>> t.uniform_color is None
+    True
+    >>> t.compress()
+    False
+
     """
 
-    def __init__(self, copy_from=None):
+    def __init__(self, copy_from=None, color=None, rgba=None):
         super(_Tile, self).__init__()
-        if copy_from is None:
-            self.rgba = np.zeros((N, N, 4), "uint16")
+        self._rgba = None
+        self._color = None
+        self._color_rgba = None  # expanded read-only array, on loan
+        if rgba is not None:
+            self._set_rgba(rgba)
+        elif copy_from is not None:
+            if copy_from._color is not None:
+                self._color = copy_from._color
+            else:
+                self._set_rgba(copy_from.readonly_rgba.copy())
+        elif color is not None:
+            self._color = tuple(int(c) for c in color)
         else:
-            self.rgba = copy_from.rgba.copy()
-        self.readonly = False
+            self._set_rgba(np.zeros((N, N, 4), "uint16"))
+        self.refs = 0
+        self._frozen = False
+        self._swap = None  # _SwapSlot holding a copy of the pixels
+        self.atime = 0  # for choosing which tiles to swap out
+        self.loans = 0  # open tile_request(readonly=False) calls
+
+    @property
+    def rgba(self):
+        """The tile's pixels, expanded if needed, for writing
+
+        Accessing this expands a uniform tile into a private array.
+        It raises AttributeError for the mipmap_dirty_tile marker.
+
+        """
+        rgba = self._rgba
+        if rgba is None:
+            if self._color is not None:
+                rgba = np.empty((N, N, 4), "uint16")
+                rgba[...] = self._color
+                self._set_rgba(rgba)
+                self._color = None
+            else:
+                rgba = self._fault_in()
+        slot = self._swap
+        if slot is not None:
+            # The pixels are about to change, so the copy on disk won't
+            # be any use after this.
+            slot.swap.discard(self)
+        self.atime = next(_TILE_CLOCK)
+        return rgba
+
+    @property
+    def readonly_rgba(self):
+        """The tile's pixels, for reading only
+
+        For uniform tiles, this is an unwriteable array
+        shared with all other uniform tiles of the same colour.
+        The tile keeps it referenced for as long as the tile exists,
+        because native code holds on to the data without a reference
+        until the end of its atomic operation.
+
+        """
+        color = self._color
+        if color is not None:
+            rgba = self._color_rgba
+            if rgba is None:
+                rgba = _get_uniform_rgba(color)
+                self._color_rgba = rgba
+            return rgba
+        rgba = self._rgba
+        if rgba is None:
+            rgba = self._fault_in()
+        self.atime = next(_TILE_CLOCK)
+        return rgba
+
+    def _set_rgba(self, rgba):
+        """Replace the pixel array, keeping count of the memory in use"""
+        old = self._rgba
+        self._rgba = rgba
+        delta = 0
+        if rgba is not None:
+            delta += rgba.nbytes
+        if old is not None:
+            delta -= old.nbytes
+        if delta:
+            _count_resident_bytes(delta)
+
+    def _fault_in(self):
+        """Get swapped-out pixels back, re-reading under the swap lock"""
+        slot = self._swap
+        if slot is None:
+            raise AttributeError("tile has no pixel data")
+        return slot.swap.fault_in(self)
+
+    @property
+    def uniform_color(self):
+        """The colour of a uniform tile as a uint16 RGBA tuple, or None"""
+        return self._color
+
+    @property
+    def nbytes(self):
+        """Size of the pixel data the tile holds in memory"""
+        if self._rgba is not None:
+            return self._rgba.nbytes
+        if self._color is None:
+            return 0  # swapped out
+        return _UNIFORM_TILE_BYTES
+
+    def compress(self):
+        """Store the tile as a single colour, if its pixels are uniform
+
+        :returns: whether the tile is now stored as a uniform colour
+        :rtype: bool
+
+        The array is discarded on success, so this must not be called
+        while the tile's pixels are out on loan for writing.
+
+        """
+        rgba = self._rgba
+        if rgba is None:
+            return self._color is not None
+        first = rgba[0, 0]
+        if not (rgba == first).all():
+            return False
+        self._color = tuple(int(c) for c in first)
+        self._color_rgba = None
+        self._set_rgba(None)
+        if self._swap is not None:
+            self._swap.swap.discard(self)
+        return True
+
+    @property
+    def readonly(self):
+        """True if the tile must not be written to in place"""
+        return self._frozen or self.refs > 1
+
+    @readonly.setter
+    def readonly(self, value):
+        self._frozen = bool(value)
 
     def copy(self):
         return _Tile(copy_from=self)
 
+    def __del__(self):
+        try:
+            self._set_rgba(None)
+            if self._swap is not None:
+                self._swap.swap.discard(self)
+        except Exception:
+            pass  # interpreter shutdown
+
 
 # tile for read-only operations on empty spots
 transparent_tile = _Tile()
@@ -85,7 +306,659 @@ transparent_tile.readonly = True
 
 # tile with invalid pixel memory (needs refresh)
 mipmap_dirty_tile = _Tile()
-del mipmap_dirty_tile.rgba
+mipmap_dirty_tile._set_rgba(None)
+
+# Access counter, for finding the least recently used tiles
+_TILE_CLOCK = itertools.count(1)
+
+# Bytes held by all the full pixel arrays of tiles, and its lock
+_resident_bytes = 0
+_RESIDENT_BYTES_LOCK = threading.Lock()
+
+
+def _count_resident_bytes(delta):
+    global _resident_bytes
+    with _RESIDENT_BYTES_LOCK:
+        _resident_bytes += delta
+
+
+def get_resident_tile_bytes():
+    """Get the memory used by all tiles' full pixel arrays, in bytes
+
+    This is kept up to date as tiles are created, expanded, swapped,
+    compressed and dropped, so it's cheap to call.
+
+    >>> before = get_resident_tile_bytes()
+    >>> t = _Tile()
+    >>> get_resident_tile_bytes() - before == t.nbytes
+    True
+    >>> del t
+    >>> get_resident_tile_bytes() == before
+    True
+
+    """
+    return _resident_bytes
+
+
+# Guards _Tile.loans, which may be changed by worker threads
+_TILE_LOAN_LOCK = threading.Lock()
+
+# Guards the contents of every TileStore, and the tiles' refs counts.
+# Stores are changed by worker threads as well as the main thread.
+_TILE_STORE_LOCK = threading.RLock()
+
+# Generations for dirty mipmap tiles, and the lock for marking them
+_MIPMAP_DIRTY_CLOCK = itertools.count(1)
+_MIPMAP_DIRTY_LOCK = threading.Lock()
+
+# Storage needed by a uniform tile's colour
+_UNIFORM_TILE_BYTES = 4 * np.dtype("uint16").itemsize
+
+# Expanded, unwriteable pixel arrays for uniform tiles, by colour.
+# Eviction is safe because tiles keep their own references to these.
+_UNIFORM_RGBA_CACHE = lib.cache.LRUCache(capacity=256)
+_UNIFORM_RGBA_CACHE_LOCK = threading.Lock()
+
+
+def _get_uniform_rgba(color):
+    """Get a shared read-only tile array filled with one colour"""
+    with _UNIFORM_RGBA_CACHE_LOCK:
+        rgba = _UNIFORM_RGBA_CACHE.get(color)
+        if rgba is None:
+            rgba = np.empty((N, N, 4), "uint16")
+            rgba[...] = color
+            rgba.flags.writeable = False
+            _UNIFORM_RGBA_CACHE[color] = rgba
+    return rgba
+
+
+## Tile storage
+
+
+class TileStore(object):
+    """Copy-on-write mapping of tile indices to tiles
+
+    A TileStore maps (tx, ty) tuples to tiles, like a dict, but it
+    counts how many stores hold each tile. Copying a store is cheap
+    because the copy shares its tiles with the original. Shared tiles
+    are read-only, so whichever surface writes to one first gets a
+    private copy of it (see MyPaintSurface._get_tile_numpy()).
+
+    >>> a = TileStore()
+    >>> t = _Tile()
+    >>> a[(0, 0)] = t
+    >>> t.refs, t.readonly
+    (1, False)
+    >>> b = a.copy()
+    >>> t.refs, t.readonly
+    (2, True)
+    >>> a == b
+    True
+    >>> del b
+    >>> t.refs, t.readonly
+    (1, False)
+
+    Stores may be changed from any thread: fills and background
+    renderers write to them while the main thread takes snapshots.
+    Every change, and every change to a tile's refs, is made with
+    _TILE_STORE_LOCK held, so no update of a share count gets lost.
+    Code iterating over a store which other threads may be changing
+    should iterate over `snapshot_items()` instead.
+
+    A tile which was handed out for writing stays writable until the
+    request ends, so snapshots which must preserve pixels, like those
+    for undo, are taken while nothing else writes to the surface.
+    FloodFill takes its snapshot before starting the fill, for example.
+
+    """
+
+    _SENTINEL = object()
+
+    def __init__(self, tiles=None):
+        super(TileStore, self).__init__()
+        self._tiles = {}
+        #: Bumped by every change, so that caches of the contents
+        #: can tell when they're stale.
+        self.revision = 0
+        if tiles:
+            for pos, tile in tiles.items():
+                self[pos] = tile
+
+    def __del__(self):
+        try:
+            self.clear()
+        except Exception:
+            pass  # interpreter shutdown
+
+    def __repr__(self):
+        return "<TileStore of %d tiles>" % (len(self._tiles),)
+
+    ## Dict-like interface
+
+    def __len__(self):
+        return len(self._tiles)
+
+    def __iter__(self):
+        return iter(self._tiles)
+
+    def __contains__(self, pos):
+        return pos in self._tiles
+
+    def __getitem__(self, pos):
+        return self._tiles[pos]
+
+    def get(self, pos, default=None):
+        return self._tiles.get(pos, default)
+
+    def keys(self):
+        return self._tiles.keys()
+
+    def values(self):
+        return self._tiles.values()
+
+    def items(self):
+        return self._tiles.items()
+
+    def snapshot_items(self):
+        """Returns a list of the (pos, tile) pairs, safe to iterate over
+
+        >>> a = TileStore({(0, 0): _Tile()})
+        >>> for pos, tile in a.snapshot_items():
+        ...     a[(1, 0)] = tile
+        >>> sorted(a.keys())
+        [(0, 0), (1, 0)]
+
+        """
+        with _TILE_STORE_LOCK:
+            return list(self._tiles.items())
+
+    def __setitem__(self, pos, tile):
+        with _TILE_STORE_LOCK:
+            old = self._tiles.get(pos)
+            if old is tile:
+                return
+            tile.refs += 1
+            self._tiles[pos] = tile
+            self.revision += 1
+            if old is not None:
+                old.refs -= 1
+
+    def __delitem__(self, pos):
+        with _TILE_STORE_LOCK:
+            tile = self._tiles.pop(pos)
+            tile.refs -= 1
+            self.revision += 1
+
+    def pop(self, pos, default=_SENTINEL):
+        with _TILE_STORE_LOCK:
+            try:
+                tile = self._tiles.pop(pos)
+            except KeyError:
+                if default is TileStore._SENTINEL:
+                    raise
+                return default
+            tile.refs -= 1
+            self.revision += 1
+            return tile
+
+    def replace(self, pos, old, new):
+        """Replaces a tile, but only if it's still the one at pos
+
+        :returns: whether the tile was replaced
+        :rtype: bool
+
+        """
+        with _TILE_STORE_LOCK:
+            if self._tiles.get(pos) is not old:
+                return False
+            self[pos] = new
+            return True
+
+    def clear(self):
+        with _TILE_STORE_LOCK:
+            tiles = self._tiles
+            self._tiles = {}
+            self.revision += 1
+            for tile in itervalues(tiles):
+                tile.refs -= 1
+
+    def copy(self):
+        """Returns a new store sharing all of this store's tiles"""
+        other = TileStore()
+        with _TILE_STORE_LOCK:
+            other._tiles = self._tiles.copy()
+            for tile in itervalues(other._tiles):
+                tile.refs += 1
+        return other
+
+    def __eq__(self, other):
+        if isinstance(other, TileStore):
+            other = other._tiles
+        return self._tiles == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    __hash__ = None
+
+
+_TILE_MEMORY_REPORT_FIELDS = (
+    "stores",
+    "tiles",
+    "unique_tiles",
+    "shared_tiles",
+    "unique_bytes",
+    "shared_bytes",
+    "saved_bytes",
+)
+
+
+class TileMemoryReport(namedtuple("TileMemoryReport", _TILE_MEMORY_REPORT_FIELDS)):
+    """Memory accounting for the tiles of a set of TileStores.
+
+    :ivar int stores: Number of stores examined.
+    :ivar int tiles: Number of distinct tiles held by those stores.
+    :ivar int unique_tiles: Tiles held by exactly one store.
+    :ivar int shared_tiles: Tiles held by more than one store.
+    :ivar int unique_bytes: Pixel data in the unique tiles.
+    :ivar int shared_bytes: Pixel data in the shared tiles.
+    :ivar int saved_bytes: What sharing saves over private copies.
+
+    The share counts are taken from the tiles themselves,
+    so they include stores that were not examined.
+
+    """
+
+    @property
+    def total_bytes(self):
+        """Pixel data actually held, in bytes"""
+        return self.unique_bytes + self.shared_bytes
+
+
+def get_tile_memory_report(stores):
+    """Account for the memory used by the tiles in some stores.
+
+    :param iterable stores: The TileStores to examine.
+    :rtype: TileMemoryReport
+
+    Each distinct tile is counted once, however many stores hold it.
+
+    >>> a = TileStore({(0, 0): _Tile(), (1, 0): _Tile()})
+    >>> b = a.copy()
+    >>> b[(1, 0)] = _Tile()
+    >>> r = get_tile_memory_report([a, b])
+    >>> r.tiles, r.unique_tiles, r.shared_tiles
+    (3, 2, 1)
+    >>> r.saved_bytes == N * N * 4 * 2
+    True
+
+    """
+    stores = list(stores)
+    seen = set()
+    unique_tiles = shared_tiles = 0
+    unique_bytes = shared_bytes = saved_bytes = 0
+    for store in stores:
+        for pos, tile in store.snapshot_items():
+            if tile in seen:
+                continue
+            seen.add(tile)
+            if tile is mipmap_dirty_tile or tile is transparent_tile:
+                continue
+            if tile.refs > 1:
+                shared_tiles += 1
+                shared_bytes += tile.nbytes
+                saved_bytes += tile.nbytes * (tile.refs - 1)
+            else:
+                unique_tiles += 1
+                unique_bytes += tile.nbytes
+    return TileMemoryReport(
+        stores=len(stores),
+        tiles=unique_tiles + shared_tiles,
+        unique_tiles=unique_tiles,
+        shared_tiles=shared_tiles,
+        unique_bytes=unique_bytes,
+        shared_bytes=shared_bytes,
+        saved_bytes=saved_bytes,
+    )
+
+
+def dedup_tiles(stores):
+    """Make identical tiles in some stores share their memory.
+
+    :param iterable stores: The TileStores to deduplicate.
+    :returns: number of tiles replaced, and the bytes freed by that
+    :rtype: tuple
+
+    Tiles with identical pixel data are replaced by a single shared
+    copy, within a store and across stores. Since shared tiles are
+    read-only, writing to any of them later unshares it again.
+    Surfaces must not be mid-stroke when this is called. Tiles that
+    other threads replace or have out on loan meanwhile are left alone.
+
+    >>> a = TileStore({(0, 0): _Tile(), (1, 0): _Tile()})
+    >>> b = TileStore({(5, 5): _Tile()})
+    >>> dedup_tiles([a, b]) == (2, 2 * N * N * 4 * 2)
+    True
+    >>> a[(0, 0)] is a[(1, 0)] is b[(5, 5)]
+    True
+    >>> dedup_tiles([a, b])
+    (0, 0)
+
+    """
+    by_digest = {}  # {digest or colour: [canonical tile, ...]}
+    canonical = {}  # {tile: canonical tile}
+    replaced = 0
+    freed = 0
+    for store in stores:
+        for pos, tile in store.snapshot_items():
+            target = canonical.get(tile)
+            if target is None:
+                if tile is mipmap_dirty_tile or tile is transparent_tile:
+                    continue
+                if tile.uniform_color is not None:
+                    digest = tile.uniform_color
+                else:
+                    digest = hashlib.sha1(tile.readonly_rgba.tobytes()).digest()
+                candidates = by_digest.setdefault(digest, [])
+                rgba = tile.readonly_rgba
+                for cand in candidates:
+                    if np.array_equal(cand.readonly_rgba, rgba):
+                        target = cand
+                        break
+                else:
+                    candidates.append(tile)
+                    target = tile
+                canonical[tile] = target
+            if target is tile or tile.loans:
+                continue
+            if not store.replace(pos, tile, target):
+                continue
+            replaced += 1
+            if tile.refs == 0:
+                freed += tile.nbytes
+    return replaced, freed
+
+
+def find_tile_stores(obj, exclude=()):
+    """Find the TileStores reachable from an object.
+
+    :param obj: Object to search, e.g. a list of commands.
+    :param iterable exclude: Objects not to search inside.
+    :returns: The stores found, each listed once.
+    :rtype: list
+
+    Standard containers are searched, and so are the attributes of
+    objects defined in MyPaint's lib package. Weak references are not
+    followed. This is how stores held only by undo history get found.
+
+    """
+    found = []
+    seen = set(id(o) for o in exclude)
+    todo = [obj]
+    while todo:
+        o = todo.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        if isinstance(o, TileStore):
+            found.append(o)
+        elif isinstance(o, dict):
+            todo.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset, deque)):
+            todo.extend(o)
+        elif type(o).__module__.startswith("lib."):
+            todo.extend(getattr(o, "__dict__", {}).values())
+    return found
+
+
+## Swapping tiles out to disk
+
+
+_SwapSlot = namedtuple("_SwapSlot", ["swap", "offset", "length", "capacity"])
+
+#: Space in a swap file is handed out in multiples of this many bytes.
+_SWAP_SLOT_ALIGN = 4096
+
+
+class TileSwap(object):
+    """Spills the pixels of the least recently used tiles to disk
+
+    A TileSwap keeps the memory used by full tile arrays under a
+    ceiling. When `trim()` finds more tile data in memory than that,
+    it compresses the least recently used tiles into a swap file,
+    and drops their arrays. Tiles fault their pixels back in from the
+    file the next time they are accessed, e.g. by `tile_request()`.
+    Single-colour tiles are already tiny, so they're never swapped.
+
+    A tile whose pixels are faulted in for reading keeps its copy on
+    disk, so swapping it out again later costs nothing. Writing to
+    it discards the copy.
+
+    >>> import tempfile, shutil
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> swap = TileSwap(tmpdir, max_bytes=2 * _Tile().nbytes)
+    >>> store = TileStore()
+    >>> for i in range(3):
+    ...     store[(i, 0)] = _Tile()
+    ...     store[(i, 0)].rgba[...] = i
+    >>> swap.trim([store])
+    (1, 32768)
+    >>> store[(0, 0)].nbytes
+    0
+    >>> int(store[(0, 0)].readonly_rgba[5, 5, 0])
+    0
+    >>> swap.trim([store])
+    (1, 32768)
+    >>> store[(1, 0)].rgba[...] = 42
+    >>> swap.trim([store])
+    (1, 32768)
+    >>> int(store[(2, 0)].readonly_rgba[0, 0, 3])
+    2
+
+    Tiles which are out on loan for writing stay in memory.
+
+    >>> for t in store.values():
+    ...     t.loans += 1
+    >>> swap.trim([store])
+    (0, 0)
+    >>> for t in store.values():
+    ...     t.loans -= 1
+    >>> store.clear()
+    >>> swap.disk_bytes
+    0
+    >>> swap.close()
+    >>> shutil.rmtree(tmpdir)
+
+    All methods are safe to call from any thread. Tiles which are out
+    on loan for writing via `tile_request()` are skipped by `trim()`.
+    The native brush engine's loans aren't counted, so `trim()` must
+    not be called during a stroke either.
+
+    """
+
+    SWAP_FILE_NAME = "tiles.swap"
+
+    def __init__(self, dirname, max_bytes):
+        """Initialize, creating the swap file
+
+        :param unicode dirname: Existing directory for the swap file.
+        :param int max_bytes: Ceiling for full tile arrays in memory.
+
+        """
+        super(TileSwap, self).__init__()
+        self.max_bytes = max_bytes
+        self._lock = threading.RLock()
+        self._path = os.path.join(dirname, self.SWAP_FILE_NAME)
+        self._file = open(self._path, "w+b")
+        self._end = 0
+        self._free = []  # sorted [(capacity, offset), ...]
+        self._disk_bytes = 0
+
+    def __repr__(self):
+        return "<TileSwap %r max_bytes=%r disk_bytes=%d>" % (
+            self._path,
+            self.max_bytes,
+            self._disk_bytes,
+        )
+
+    @property
+    def disk_bytes(self):
+        """Size of the tile data currently held in the swap file"""
+        return self._disk_bytes
+
+    def close(self):
+        """Close and delete the swap file
+
+        Tiles still swapped out when this is called lose their pixels.
+
+        """
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.close()
+            self._file = None
+            self._free = []
+            self._end = 0
+            self._disk_bytes = 0
+            try:
+                os.unlink(self._path)
+            except OSError:
+                logger.warning("Failed to remove %r", self._path)
+
+    @property
+    def over_budget(self):
+        """Whether trim() could possibly find anything to swap out
+
+        This is a cheap test, which callers can use to avoid gathering
+        the stores to trim. It counts the arrays of every tile in the
+        process, so it may be true when the stores are within budget,
+        but never the other way round.
+
+        """
+        return get_resident_tile_bytes() > self.max_bytes
+
+    def trim(self, stores):
+        """Swap out tiles until their arrays fit within max_bytes
+
+        :param iterable stores: The TileStores to manage.
+        :returns: The number of tiles swapped out, and the bytes freed.
+        :rtype: tuple
+
+        The stores may be being changed by other threads meanwhile.
+
+        """
+        if not self.over_budget:
+            return (0, 0)
+        resident = {}
+        for store in stores:
+            for pos, tile in store.snapshot_items():
+                if tile._rgba is None or tile is transparent_tile:
+                    continue
+                if tile.loans:
+                    continue
+                resident[id(tile)] = tile
+        excess = sum(t._rgba.nbytes for t in resident.values())
+        excess -= self.max_bytes
+        swapped = 0
+        freed = 0
+        if excess <= 0:
+            return swapped, freed
+        for tile in sorted(resident.values(), key=lambda t: t.atime):
+            if excess <= 0:
+                break
+            nbytes = self._swap_out(tile)
+            if nbytes:
+                swapped += 1
+                freed += nbytes
+                excess -= nbytes
+        logger.debug(
+            "Swapped out %d tiles (%d bytes); swap file holds %d bytes",
+            swapped,
+            freed,
+            self._disk_bytes,
+        )
+        return swapped, freed
+
+    def _swap_out(self, tile):
+        """Write a tile's pixels to disk if needed, then drop them"""
+        with self._lock:
+            rgba = tile._rgba
+            if rgba is None or self._file is None or tile.loans:
+                return 0
+            slot = None
+            if tile._swap is None:
+                data = zlib.compress(rgba.tobytes(), 1)
+                slot = self._write(data)
+            with _TILE_LOAN_LOCK:
+                if not tile.loans:
+                    if slot is not None:
+                        tile._swap = slot
+                    tile._set_rgba(None)
+                    return rgba.nbytes
+            # Lent out for writing meanwhile: the new copy is useless.
+            if slot is not None:
+                self._free_slot(slot)
+            return 0
+
+    def fault_in(self, tile):
+        """Read a swapped-out tile's pixels back into memory
+
+        :returns: the tile's new pixel array
+
+        """
+        with self._lock:
+            rgba = tile._rgba
+            if rgba is not None:
+                return rgba  # another thread got here first
+            slot = tile._swap
+            if slot is None:
+                raise AttributeError("tile has no pixel data")
+            if self._file is None:
+                raise ValueError("Tile swap file has been closed")
+            self._file.seek(slot.offset)
+            data = self._file.read(slot.length)
+            buf = zlib.decompress(data)
+            rgba = np.frombuffer(buf, "uint16").reshape((N, N, 4)).copy()
+            tile._set_rgba(rgba)
+            return rgba
+
+    def discard(self, tile):
+        """Forget a tile's copy on disk, freeing its space for reuse"""
+        with self._lock:
+            slot = tile._swap
+            if slot is None:
+                return
+            tile._swap = None
+            self._free_slot(slot)
+
+    def _free_slot(self, slot):
+        """Return a slot's space to the free list"""
+        with self._lock:
+            if self._file is None:
+                return
+            self._disk_bytes -= slot.capacity
+            if self._disk_bytes == 0:
+                # Nothing left in the file: start afresh.
+                self._free = []
+                self._end = 0
+                self._file.truncate(0)
+                return
+            bisect.insort(self._free, (slot.capacity, slot.offset))
+
+    def _write(self, data):
+        """Write data to the smallest free slot that fits"""
+        length = len(data)
+        i = bisect.bisect_left(self._free, (length,))
+        if i < len(self._free):
+            capacity, offset = self._free.pop(i)
+        else:
+            capacity = -(-length // _SWAP_SLOT_ALIGN) * _SWAP_SLOT_ALIGN
+            offset = self._end
+            self._end += capacity
+        self._file.seek(offset)
+        self._file.write(data)
+        self._disk_bytes += capacity
+        return _SwapSlot(self, offset, length, capacity)
 
 
 ## Class defs: surfaces
@@ -95,8 +968,6 @@ class _SurfaceSnapshot(object):
     pass
 
 
-# TODO:
-# - move the tile storage from MyPaintSurface to a separate class
 class MyPaintSurface(TileAccessible, TileBlittable, TileCompositable):
     """Tile-based surface
 
@@ -114,7 +985,7 @@ class MyPaintSurface(TileAccessible, TileBlittable, TileCompositable):
 
         # TODO: pass just what it needs access to, not all of self
         self._backend = mypaintlib.TiledSurface(self)
-        self.tiledict = {}
+        self.tiledict = TileStore()
         self.observers = []
 
         # Used to implement repeating surfaces, like Background
@@ -124,6 +995,9 @@ class MyPaintSurface(TileAccessible, TileBlittable, TileCompositable):
         self.looped_size = looped_size
 
         self.mipmap_level = mipmap_level
+        # Tiles of this mipmap level waiting to be regenerated,
+        # mapped to the generation of the edit which last dirtied them
+        self._dirty_mipmap_tiles = {}
         if mipmap_level == 0:
             assert mipmap_surfaces is None
             self._mipmaps = self._create_mipmap_surfaces()
@@ -196,7 +1070,8 @@ class MyPaintSurface(TileAccessible, TileBlittable, TileCompositable):
 
     def clear(self):
         tiles = self.tiledict.keys()
-        self.tiledict = {}
+        self.tiledict = TileStore()
+        self._dirty_mipmap_tiles.clear()
         self.notify_observers(*lib.surface.get_tiles_bbox(tiles))
         if self.mipmap:
             self.mipmap.clear()
@@ -290,15 +1165,35 @@ class MyPaintSurface(TileAccessible, TileBlittable, TileCompositable):
             ...     assert (t4 == t1).all()
 
         """
-        numpy_tile = self._get_tile_numpy(tx, ty, readonly)
-        yield numpy_tile
-        self._set_tile_numpy(tx, ty, numpy_tile, readonly)
+        if readonly:
+            numpy_tile = self._get_tile_numpy(tx, ty, readonly)
+            yield numpy_tile
+            self._set_tile_numpy(tx, ty, numpy_tile, readonly)
+            return
+        # Pin the tile while it's being written, so that a TileSwap
+        # can't drop its array from under the caller.
+        if self.looped:
+            tx = tx % (self.looped_size[0] // N)
+            ty = ty % (self.looped_size[1] // N)
+        t = self._get_tile(tx, ty, readonly)
+        with _TILE_LOAN_LOCK:
+            t.loans += 1
+        try:
+            numpy_tile = t.rgba
+            yield numpy_tile
+            self._set_tile_numpy(tx, ty, numpy_tile, readonly)
+        finally:
+            with _TILE_LOAN_LOCK:
+                t.loans -= 1
+            # Mipmaps regenerated while the pixels were being written
+            # may be torn, so this makes sure they won't be published.
+            self._mark_mipmap_dirty(tx, ty)
 
     def _regenerate_mipmap(self, t, tx, ty):
-        t = _Tile()
-        self.tiledict[(tx, ty)] = t
-        empty = True
-
+        # The new tile is only published once it's complete,
+        # because parallel renderers may be reading this surface.
+        generation = self._dirty_mipmap_tiles.get((tx, ty))
+        srcs = []
         for x in xrange(2):
             for y in xrange(2):
                 src = self.parent.tiledict.get(
@@ -310,23 +1205,155 @@ class MyPaintSurface(TileAccessible, TileBlittable, TileCompositable):
                         tx * 2 + x,
                         ty * 2 + y,
                     )
-                mypaintlib.tile_downscale_rgba16(
-                    src.rgba, t.rgba, x * N // 2, y * N // 2
-                )
-                if src.rgba is not transparent_tile.rgba:
-                    empty = False
-        if empty:
-            # rare case, no need to speed it up
-            del self.tiledict[(tx, ty)]
-            t = transparent_tile
+                srcs.append((x, y, src))
+        t, jobs = self._plan_mipmap_tile(srcs)
+        for job in jobs:
+            mypaintlib.tile_downscale_rgba16(*job)
+        self._publish_mipmap_tile(tx, ty, t, generation)
         return t
 
+    @staticmethod
+    def _plan_mipmap_tile(srcs):
+        """Internal: make a mipmap tile, and list the work to fill it in
+
+        :param list srcs: (x, y, tile) for the four source tiles
+        :returns: the new tile, and tile_downscale_rgba16() arguments
+        :rtype: tuple
+
+        """
+        if all(src is transparent_tile for (x, y, src) in srcs):
+            return transparent_tile, []
+        # Downscaling four tiles of the same colour gives that colour.
+        colors = set(src.uniform_color for (x, y, src) in srcs)
+        if len(colors) == 1 and None not in colors:
+            return _Tile(color=colors.pop()), []
+        t = _Tile()
+        rgba = t.rgba
+        jobs = []
+        for x, y, src in srcs:
+            if src is transparent_tile:
+                continue  # new tiles are transparent
+            jobs.append((src.readonly_rgba, rgba, x * N // 2, y * N // 2))
+        return t, jobs
+
+    def _publish_mipmap_tile(self, tx, ty, t, generation):
+        """Internal: store a regenerated mipmap tile
+
+        :param generation: The tile's dirty generation before regenerating.
+        :returns: whether the tile was stored
+        :rtype: bool
+
+        If the tile was marked dirty again while it was being made, it
+        may have been made from half-written pixels. It's left dirty.
+
+        """
+        pos = (tx, ty)
+        with _MIPMAP_DIRTY_LOCK:
+            if self._dirty_mipmap_tiles.get(pos) != generation:
+                return False
+            if t is transparent_tile:
+                self.tiledict.pop(pos, None)
+            else:
+                self.tiledict[pos] = t
+            self._dirty_mipmap_tiles.pop(pos, None)
+        return True
+
+    def regenerate_mipmaps(self, max_tiles=0):
+        """Regenerate dirty mipmap tiles in bulk, one level at a time
+
+        :param int max_tiles: Most tiles to regenerate, 0 for no limit
+        :returns: whether any dirty mipmap tiles remain
+        :rtype: bool
+
+        Writing to a surface marks the mipmap tiles above the written
+        tiles as dirty. They are regenerated lazily when read, but that
+        can stall the first zoomed-out redraw after a big change. This
+        method does the work ahead of time instead, in batches which
+        use a single native call per level. Each level is finished
+        before the next one up is started, so its tiles never have to
+        be regenerated recursively.
+
+        >>> s = MyPaintSurface()
+        >>> for tx in range(4):
+        ...     with s.tile_request(tx, 0, readonly=False) as rgba:
+        ...         rgba[...] = 1 << 15
+        >>> s.regenerate_mipmaps(max_tiles=1)
+        True
+        >>> s.regenerate_mipmaps()
+        False
+        >>> s.mipmap.tiledict[(0, 0)].uniform_color
+        (32768, 32768, 32768, 32768)
+
+        """
+        if self.mipmap_level != 0:
+            raise ValueError("Only call this on the top-level surface.")
+        if not self._mipmaps:
+            return False
+        budget = max_tiles
+        for mipmap in self._mipmaps[1:]:
+            dirty = mipmap._dirty_mipmap_tiles
+            if not dirty:
+                continue
+            coords = sorted(dirty)
+            if max_tiles > 0:
+                if budget <= 0:
+                    return True
+                coords = coords[:budget]
+                budget -= len(coords)
+            mipmap._regenerate_mipmap_tiles(coords)
+        return any(m._dirty_mipmap_tiles for m in self._mipmaps[1:])
+
+    def _regenerate_mipmap_tiles(self, coords):
+        """Internal: regenerate some dirty tiles of this mipmap level
+
+        The level below must not have any dirty tiles that these ones
+        depend on. Tiles are published only after all of the native
+        downscaling has finished, since renderers may be reading.
+        """
+        parent_tiles = self.parent.tiledict
+        dirty = self._dirty_mipmap_tiles
+        planned = []
+        jobs = []
+        for tx, ty in coords:
+            with _MIPMAP_DIRTY_LOCK:
+                if self.tiledict.get((tx, ty)) is not mipmap_dirty_tile:
+                    # Regenerated lazily by a reader in the meantime
+                    dirty.pop((tx, ty), None)
+                    continue
+                generation = dirty.get((tx, ty))
+            srcs = []
+            for x in xrange(2):
+                for y in xrange(2):
+                    pos = (tx * 2 + x, ty * 2 + y)
+                    src = parent_tiles.get(pos, transparent_tile)
+                    if src is mipmap_dirty_tile:
+                        src = self.parent._regenerate_mipmap(src, *pos)
+                    srcs.append((x, y, src))
+            t, tile_jobs = self._plan_mipmap_tile(srcs)
+            planned.append((tx, ty, t, generation))
+            jobs.extend(tile_jobs)
+        if jobs:
+            mypaintlib.tile_downscale_rgba16_batch(jobs)
+        for tx, ty, t, generation in planned:
+            self._publish_mipmap_tile(tx, ty, t, generation)
+
     def _get_tile_numpy(self, tx, ty, readonly):
         # OPTIMIZE: do some profiling to check if this function is a bottleneck
         #           yes it is
         # Note: we must return memory that stays valid for writing until the
         # last end_atomic(), because of the caching in tiledsurface.hpp.
 
+        t = self._get_tile(tx, ty, readonly)
+        if readonly:
+            return t.readonly_rgba
+        return t.rgba
+
+    def _get_tile(self, tx, ty, readonly):
+        """Internal: get the tile object for a request
+
+        Requests for writing get a private tile, and mark the mipmaps
+        above it as dirty.
+        """
         if self.looped:
             tx = tx % (self.looped_size[0] // N)
             ty = ty % (self.looped_size[1] // N)
@@ -340,29 +1367,90 @@ class MyPaintSurface(TileAccessible, TileBlittable, TileCompositable):
                 self.tiledict[(tx, ty)] = t
         if t is mipmap_dirty_tile:
             t = self._regenerate_mipmap(t, tx, ty)
-        if t.readonly and not readonly:
-            # shared memory, get a private copy for writing
-            t = t.copy()
-            self.tiledict[(tx, ty)] = t
         if not readonly:
+            # Decide and replace in one go, so that a snapshot taken
+            # by another thread can't share the tile in between.
+            with _TILE_STORE_LOCK:
+                if t.readonly:
+                    # shared memory, get a private copy for writing
+                    t = t.copy()
+                    self.tiledict[(tx, ty)] = t
             # assert self.mipmap_level == 0
             self._mark_mipmap_dirty(tx, ty)
-        return t.rgba
+        return t
+
+    def _get_uniform_color(self, tx, ty):
+        """Returns the colour of a uniform tile, without expanding it
+
+        :returns: uint16 RGBA tuple, or None if not a uniform tile
+        """
+        if self.looped:
+            tx = tx % (self.looped_size[0] // N)
+            ty = ty % (self.looped_size[1] // N)
+        t = self.tiledict.get((tx, ty))
+        if t is None or t is mipmap_dirty_tile:
+            return None
+        return t.uniform_color
+
+    def fill_tile(self, tx, ty, color):
+        """Replaces a tile with a uniform one of a single colour
+
+        :param int tx: Tile X coord (multiply by TILE_SIZE for pixels)
+        :param int ty: Tile Y coord (multiply by TILE_SIZE for pixels)
+        :param tuple color: premultiplied uint16 RGBA colour
+
+        Observers are not notified: callers must do that themselves.
+
+        """
+        self.tiledict[(tx, ty)] = _Tile(color=color)
+        self._mark_mipmap_dirty(tx, ty)
+
+    def compress_uniform_tiles(self, tiles=None):
+        """Store tiles which are all one colour as just that colour
+
+        :param tiles: tile indices to examine, or None for all tiles
+        :returns: The number of tiles newly compressed.
+        :rtype: int
+
+        This doesn't change any pixels, so observers aren't notified.
+        It must not be called mid-stroke.
+
+        """
+        if tiles is None:
+            tiles = list(self.tiledict.keys())
+        compressed = 0
+        for pos in tiles:
+            t = self.tiledict.get(pos)
+            if t is None or t is mipmap_dirty_tile or t is transparent_tile:
+                continue
+            if t.uniform_color is not None:
+                continue
+            if t.readonly:
+                # Shared tiles keep their arrays: others may be reading.
+                continue
+            if t.compress():
+                compressed += 1
+        return compressed
 
     def _set_tile_numpy(self, tx, ty, obj, readonly):
         pass  # Data can be modified directly, no action needed
 
     def _mark_mipmap_dirty(self, tx, ty):
         # assert self.mipmap_level == 0
+        # Levels which are already dirty still get a new generation,
+        # so that any regeneration in progress won't be published.
         if not self._mipmaps:
             return
-        for level, mipmap in enumerate(self._mipmaps):
-            if level == 0:
-                continue
-            fac = 2 ** (level)
-            if mipmap.tiledict.get((tx // fac, ty // fac), None) == mipmap_dirty_tile:
-                break
-            mipmap.tiledict[(tx // fac, ty // fac)] = mipmap_dirty_tile
+        generation = next(_MIPMAP_DIRTY_CLOCK)
+        with _MIPMAP_DIRTY_LOCK:
+            for level, mipmap in enumerate(self._mipmaps):
+                if level == 0:
+                    continue
+                fac = 2 ** (level)
+                pos = (tx // fac, ty // fac)
+                if mipmap.tiledict.get(pos, None) is not mipmap_dirty_tile:
+                    mipmap.tiledict[pos] = mipmap_dirty_tile
+                mipmap._dirty_mipmap_tiles[pos] = generation
 
     def blit_tile_into(
         self, dst, dst_has_alpha, tx, ty, mipmap_level=0, *args, **kwargs
@@ -386,6 +1474,12 @@ class MyPaintSurface(TileAccessible, TileBlittable, TileCompositable):
             raise ValueError("Unsupported destination buffer type %r", dst.dtype)
         dst_is_uint16 = dst.dtype == "uint16"
 
+        if dst_is_uint16:
+            color = self._get_uniform_color(tx, ty)
+            if color is not None:
+                dst[...] = color
+                return
+
         with self.tile_request(tx, ty, readonly=True) as src:
             if src is transparent_tile.rgba:
                 # dst[:] = 0  # <-- notably slower than memset()
@@ -444,6 +1538,13 @@ class MyPaintSurface(TileAccessible, TileBlittable, TileCompositable):
             )
             return
 
+        # Opaque uniform tiles composited normally replace the backdrop.
+        if mode == mypaintlib.CombineNormal and opacity == 1.0:
+            color = self._get_uniform_color(tx, ty)
+            if color is not None and color[3] == (1 << 15):
+                dst[...] = color
+                return
+
         # Tile request at the required level.
         # Try optimizations again if we got the special marker tile
         with self.tile_request(tx, ty, readonly=True) as src:
@@ -461,17 +1562,63 @@ class MyPaintSurface(TileAccessible, TileBlittable, TileCompositable):
     def save_snapshot(self):
         """Creates and returns a snapshot of the surface
 
-        Snapshotting marks all the tiles of the surface as read-only,
-        then just shallow-copes the tiledict. It's quick. See
-        tile_request() for how new read/write tiles can be unlocked.
+        Snapshotting just copies the TileStore, which shares all its
+        tiles with the surface and makes them read-only. It's quick.
+        See tile_request() for how new read/write tiles can be unlocked.
+        Tiles become writable in place again once the last snapshot
+        sharing them is gone.
 
         """
         sshot = _SurfaceSnapshot()
-        for t in itervalues(self.tiledict):
-            t.readonly = True
         sshot.tiledict = self.tiledict.copy()
         return sshot
 
+    def clone_for_rendering(self, mipmap_level=0):
+        """Returns a frozen copy of the surface, for background rendering
+
+        :param int mipmap_level: Highest mipmap level to be rendered.
+        :rtype: MyPaintSurface
+
+        The copy shares its tiles with this surface copy-on-write, down
+        to the requested mipmap level, so making it is quick. Dirty
+        mipmap tiles are regenerated in the copy's own stores when they
+        are read, so another thread can render from the copy without
+        writing to this surface.
+
+        The copy must be dropped on the thread that owns this surface,
+        since that changes the share counts of their tiles.
+
+        >>> surf = MyPaintSurface._mock()
+        >>> clone = surf.clone_for_rendering(1)
+        >>> with surf.tile_request(1, 0, readonly=False) as rgba:
+        ...     rgba[...] = 0
+        >>> with clone.tile_request(1, 0, readonly=True) as rgba:
+        ...     int(rgba.max())
+        32768
+        >>> clone.mipmap.tiledict[(0, 0)] is mipmap_dirty_tile
+        True
+        >>> with clone.mipmap.tile_request(0, 0, readonly=True) as rgba:
+        ...     int(rgba[0, 0, 3])
+        32768
+        >>> surf.mipmap.tiledict[(0, 0)] is mipmap_dirty_tile
+        True
+
+        Surfaces which are never changed in place, like backgrounds,
+        return themselves.
+
+        """
+        if self._mipmaps is None:
+            return self
+        if self.mipmap_level != 0:
+            raise ValueError("Only call this on the top-level surface.")
+        clone = MyPaintSurface(looped=self.looped, looped_size=self.looped_size)
+        for src, dst in zip(self._mipmaps, clone._mipmaps):
+            if src.mipmap_level > mipmap_level:
+                break
+            dst.tiledict = src.tiledict.copy()
+            dst._dirty_mipmap_tiles = dict(src._dirty_mipmap_tiles)
+        return clone
+
     def load_snapshot(self, sshot):
         """Loads a saved snapshot, replacing the internal tiledict"""
         self._load_tiledict(sshot.tiledict)
@@ -501,11 +1648,12 @@ class MyPaintSurface(TileAccessible, TileBlittable, TileCompositable):
 
     def _load_from_pixbufsurface(self, s):
         dirty_tiles = set(self.tiledict.keys())
-        self.tiledict = {}
+        self.tiledict = TileStore()
 
         for tx, ty in s.get_tiles():
             with self.tile_request(tx, ty, readonly=False) as dst:
                 s.blit_tile_into(dst, True, tx, ty)
+        self.compress_uniform_tiles()
 
         dirty_tiles.update(self.tiledict.keys())
         bbox = lib.surface.get_tiles_bbox(dirty_tiles)
@@ -538,6 +1686,11 @@ class MyPaintSurface(TileAccessible, TileBlittable, TileCompositable):
     ):
         """Load from a PNG, one tilerow at a time, discarding empty tiles.
 
+        Decoding happens on the calling thread, while the decoded tile
+        rows are converted to tiles by a pool of worker threads. At most
+        PNG_LOAD_MAX_ROWS_IN_FLIGHT rows are held while waiting for
+        conversion, and they're added to the surface in order.
+
         :param str filename: The file to load
         :param int x: X-coordinate at which to load the replacement data
         :param int y: Y-coordinate at which to load the replacement data
@@ -558,7 +1711,7 @@ class MyPaintSurface(TileAccessible, TileBlittable, TileCompositable):
             raise ValueError("progress arg must be unsized")
 
         dirty_tiles = set(self.tiledict.keys())
-        self.tiledict = {}
+        self.tiledict = TileStore()
 
         ty0 = int(y // N)
         state = {}
@@ -566,6 +1719,9 @@ class MyPaintSurface(TileAccessible, TileBlittable, TileCompositable):
         state["ty"] = ty0  # current tile row being filled into buf
         state["frame_size"] = None
         state["progress"] = progress
+        pool = _get_png_load_pool()
+        eotf_value = eotf()
+        in_flight = deque()  # (ty, future or result), oldest first
 
         def get_buffer(png_w, png_h):
             if state["frame_size"] is None:
@@ -589,14 +1745,14 @@ class MyPaintSurface(TileAccessible, TileBlittable, TileCompositable):
             assert buf_h == N
             if state["buf"] is not None:
                 consume_buf()
-            else:
-                state["buf"] = np.empty((buf_h, buf_w, 4), "uint8")
+            # Rows are handed off to the converters, so each needs
+            # a fresh buffer.
+            state["buf"] = np.zeros((buf_h, buf_w, 4), "uint8")
 
             png_x0 = x
             png_x1 = x + png_w
             subbuf = state["buf"][:, png_x0 - buf_x0 : png_x1 - buf_x0]
             if 1:  # optimize: only needed for first and last
-                state["buf"].fill(0)
                 png_y0 = max(buf_y0, y)
                 png_y1 = min(buf_y0 + buf_h, y + png_h)
                 assert png_y1 > png_y0
@@ -607,12 +1763,27 @@ class MyPaintSurface(TileAccessible, TileBlittable, TileCompositable):
 
         def consume_buf():
             ty = state["ty"] - 1
-            for i in xrange(state["buf"].shape[1] // N):
+            buf = state["buf"]
+            state["buf"] = None
+            if pool is None:
+                result = _convert_png_tile_row(buf, eotf_value)
+            else:
+                result = pool.submit(_convert_png_tile_row, buf, eotf_value)
+            in_flight.append((ty, result))
+            while len(in_flight) > PNG_LOAD_MAX_ROWS_IN_FLIGHT:
+                store_row()
+
+        def store_row():
+            ty, result = in_flight.popleft()
+            if pool is not None:
+                result = result.result()
+            tiles = []
+            for i, rgba in result:
                 tx = x // N + i
-                src = state["buf"][:, i * N : (i + 1) * N, :]
-                if src[:, :, 3].any():
-                    with self.tile_request(tx, ty, readonly=False) as dst:
-                        mypaintlib.tile_convert_rgba8_to_rgba16(src, dst, eotf())
+                self.tiledict[(tx, ty)] = _Tile(rgba=rgba)
+                self._mark_mipmap_dirty(tx, ty)
+                tiles.append((tx, ty))
+            self.compress_uniform_tiles(tiles)
             if state["progress"]:
                 try:
                     state["progress"].completed(ty - ty0)
@@ -637,8 +1808,13 @@ class MyPaintSurface(TileAccessible, TileBlittable, TileCompositable):
                 convert_to_srgb,
             )
         except (IOError, OSError, RuntimeError) as ex:
+            for ty, result in in_flight:
+                if pool is not None:
+                    result.cancel()
             raise FileHandlingError(_("PNG reader failed: %s") % str(ex))
         consume_buf()  # also process the final chunk of data
+        while in_flight:
+            store_row()
         progress.close()
         logger.debug("PNG loader flags: %r", flags)
 
@@ -672,11 +1848,25 @@ class MyPaintSurface(TileAccessible, TileBlittable, TileCompositable):
     def get_tiles(self):
         return self.tiledict
 
+    def get_tile_stores(self):
+        """Returns the tile stores of this surface and its mipmaps"""
+        stores = []
+        surf = self
+        while surf is not None:
+            stores.append(surf.tiledict)
+            surf = getattr(surf, "mipmap", None)
+        return stores
+
     def is_empty(self):
         return not self.tiledict
 
     def remove_empty_tiles(self):
-        """Removes tiles from the tiledict which contain no data"""
+        """Removes tiles from the tiledict which contain no data
+
+        Tiles which are all one colour are also compressed,
+        as a side effect. See compress_uniform_tiles().
+
+        """
         if self.mipmap_level != 0:
             raise ValueError("Only call this on the top-level surface.")
         assert self is self._mipmaps[0]
@@ -689,13 +1879,14 @@ class MyPaintSurface(TileAccessible, TileBlittable, TileCompositable):
             for pos, data in tmp_items_list:
                 total += 1
                 try:
-                    rgba = data.rgba
+                    rgba = data.readonly_rgba
                 except AttributeError:
                     continue
                 if rgba.any():
                     continue
                 surf.tiledict.pop(pos)
                 removed += 1
+            surf.compress_uniform_tiles()
         return removed, total
 
     def remove_tiles(self, indices):
@@ -741,6 +1932,26 @@ class MyPaintSurface(TileAccessible, TileBlittable, TileCompositable):
 
         return flood_fill(self, fill_args, dst)
 
+    def flood_fill_preview(self, fill_args, mipmap_level):
+        """Quickly fills connected areas of one of this surface's mipmaps
+
+        :param fill_args: fill arguments object, at full size
+        :type fill_args: lib.floodfill.FloodFillArguments
+        :param int mipmap_level: The mipmap level to fill at
+        :returns: Filled alpha tiles at mipmap_level, by tile coordinate
+        :rtype: dict
+
+        The fill runs synchronously, and nothing is composited.
+        See lib.floodfill.preview_fill().
+
+        """
+        if self.mipmap_level != 0:
+            raise ValueError("Only call this on the top-level surface.")
+        src = self._mipmaps[mipmap_level]
+        lib.floodfill._EMPTY_RGBA = transparent_tile.rgba
+        args = fill_args.at_mipmap_level(mipmap_level)
+        return lib.floodfill.preview_fill(src, args)
+
     @contextlib.contextmanager
     def cairo_request(self, x, y, w, h, mode=lib.modes.default_mode):
         """Get a Cairo context for a given area, then put back changes.
@@ -1075,7 +2286,7 @@ class _TiledSurfaceMove(object):
                         self.surface.tiledict[targ_t] = targ_tile
                         self.written.add(targ_t)
                     # Copy this source slice to the destination
-                    targ_tile.rgba[targ_y0:targ_y1, targ_x0:targ_x1] = src_tile.rgba[
+                    targ_tile.rgba[targ_y0:targ_y1, targ_x0:targ_x1] = src_tile.readonly_rgba[
                         src_y0:src_y1, src_x0:src_x1
                     ]
                     updated.add(targ_t)
@@ -1239,6 +2450,7 @@ class Background(Surface):
                         dst[:, :, :] = arr[
                             ty * N : (ty + 1) * N, tx * N : (tx + 1) * N, :
                         ]
+            self.compress_uniform_tiles()
             return (x, y, w, h)
         else:
             return super(Background, self).load_from_numpy(arr, x, y)
@@ -0,0 +1,549 @@
+#!/usr/bin/env python
+# This file is part of MyPaint.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""Headless benchmarks for the lib-level hot paths.
+
+Run from the top of the source tree, after building::
+
+    python -m tests.benchmark --list
+    python -m tests.benchmark -c 3 -o results.json load_ora paint_replay
+    python -m tests.benchmark --all
+
+Each run of each benchmark happens in a fresh child process, so that
+its peak memory use can be measured cleanly. The results are written
+as JSON: for every benchmark, the wall time of each measured run, the
+peak RSS of the child process, and the number of tiles held by the
+document or surface the benchmark worked on. Store these alongside
+the commit ID to track regressions between commits. To compare two
+implementations, run the same benchmarks with each checked out and
+built, and diff the two result files.
+
+"""
+
+# Imports:
+
+from __future__ import division, print_function
+
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import platform
+import contextlib
+import subprocess
+from os.path import join
+
+from . import paths
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Windows
+
+
+# Constants:
+
+TEST_BIGIMAGE = "bigimage.ora"
+TEST_FILL_OUTLINES = "fill_outlines.ora"
+TEST_EVENTS = "painting30sec.dat"
+TEST_BRUSH = "brushes/v2/charcoal.myb"
+
+SINGLE_RUN_ARG = "--single-run"
+
+ALL_BENCHMARKS = {}
+
+
+# Benchmark registration and measurement:
+
+
+def benchmark(name=None):
+    """Decorator: registers a benchmark function under a name
+
+    Benchmark functions are called with a Measurement object, and must
+    use its ``timed()`` context manager around the code being measured.
+
+    """
+
+    def _register(func):
+        ALL_BENCHMARKS[name or func.__name__] = func
+        return func
+
+    return _register
+
+
+class Measurement(object):
+    """Results of one benchmark run, in a child process"""
+
+    def __init__(self, tmpdir):
+        super(Measurement, self).__init__()
+        self.tmpdir = tmpdir
+        self.wall_time = 0.0
+        self.tiles = None
+
+    @contextlib.contextmanager
+    def timed(self):
+        """Context manager: adds the time spent inside to wall_time"""
+        t0 = time.time()
+        yield
+        self.wall_time += time.time() - t0
+
+    def count_doc_tiles(self, doc):
+        """Record the number of distinct tiles a document holds"""
+        self.tiles = doc.get_tile_memory_report()["total"].tiles
+
+    def count_surface_tiles(self, surface):
+        """Record the number of tiles in a surface"""
+        self.tiles = len(surface.get_tiles())
+
+    def as_dict(self):
+        return {
+            "wall_time": self.wall_time,
+            "peak_rss": get_peak_rss(),
+            "tiles": self.tiles,
+        }
+
+
+def get_peak_rss():
+    """Peak resident set size of this process, in bytes, or None"""
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return maxrss  # already in bytes
+    return maxrss * 1024
+
+
+def _new_doc(**kwargs):
+    from lib import document
+
+    return document.Document(**kwargs)
+
+
+def _load_events():
+    import numpy as np
+
+    return np.loadtxt(join(paths.TESTS_DIR, TEST_EVENTS))
+
+
+# Benchmarks:
+
+
+@benchmark()
+def load_ora(m):
+    """Load bigimage.ora"""
+    doc = _new_doc()
+    with m.timed():
+        doc.load(join(paths.TESTS_DIR, TEST_BIGIMAGE))
+    m.count_doc_tiles(doc)
+    doc.cleanup()
+
+
+@benchmark()
+def save_ora(m):
+    """Save bigimage.ora as a new file"""
+    doc = _new_doc()
+    doc.load(join(paths.TESTS_DIR, TEST_BIGIMAGE))
+    with m.timed():
+        doc.save(join(m.tmpdir, "test_save.ora"))
+    m.count_doc_tiles(doc)
+    doc.cleanup()
+
+
+@benchmark()
+def save_ora_again(m):
+    """Save bigimage.ora a second time, unchanged"""
+    doc = _new_doc()
+    doc.load(join(paths.TESTS_DIR, TEST_BIGIMAGE))
+    filename = join(m.tmpdir, "test_save.ora")
+    doc.save(filename)
+    with m.timed():
+        doc.save(filename)
+    m.count_doc_tiles(doc)
+    doc.cleanup()
+
+
+@benchmark()
+def save_png(m):
+    """Save bigimage.ora flattened as a PNG"""
+    doc = _new_doc()
+    doc.load(join(paths.TESTS_DIR, TEST_BIGIMAGE))
+    with m.timed():
+        doc.save(join(m.tmpdir, "test_save.png"))
+    m.count_doc_tiles(doc)
+    doc.cleanup()
+
+
+@benchmark()
+def paint_replay(m):
+    """Replay painting30sec.dat at 4x with a charcoal brush"""
+    doc = _new_doc(painting_only=True)
+    with open(join(paths.TESTS_DIR, TEST_BRUSH), "r") as fp:
+        doc.brush.brushinfo.load_from_string(fp.read())
+    events = _load_events()
+    layer = doc.layer_stack.current
+    t_old = events[0][0]
+    with m.timed():
+        for t, x, y, pressure in events:
+            dtime = t - t_old
+            t_old = t
+            layer.stroke_to(
+                doc.brush,
+                x * 4,
+                y * 4,
+                pressure,
+                0.0,
+                0.0,
+                dtime,
+                1.0,  # view zoom
+                0.0,  # view rotation
+                0.0,  # barrel rotation
+            )
+    m.count_doc_tiles(doc)
+
+
+def _flood_fill(m, src_path, gap_closing_options, offset=0, feather=0):
+    from lib import floodfill
+    from lib import mypaintlib
+
+    doc = _new_doc(painting_only=True)
+    doc.load(join(paths.TESTS_DIR, TEST_FILL_OUTLINES))
+    root = doc.layer_stack
+    src = root.deepget(src_path)
+    dst = root.deepget((3, 0))
+    x, y, w, h = src.get_bbox()
+    seed = (x + w // 2, y + h // 2)
+    args = floodfill.FloodFillArguments(
+        target_pos=seed,
+        seeds={seed},
+        color=(0.0, 0.0, 0.0),
+        tolerance=0.2,
+        offset=offset,
+        feather=feather,
+        gap_closing_options=gap_closing_options,
+        mode=mypaintlib.CombineNormal,
+        lock_alpha=False,
+        opacity=1.0,
+        framed=False,
+        bbox=root.get_bbox(),
+    )
+    with m.timed():
+        handle = src.flood_fill(args, dst)
+        handle.wait()
+    m.count_surface_tiles(dst._surface)
+
+
+@benchmark()
+def flood_fill(m):
+    """Fill a large closed outline in fill_outlines.ora"""
+    _flood_fill(m, (0, 2), None)
+
+
+@benchmark()
+def flood_fill_gap_closing(m):
+    """Fill a gappy outline in fill_outlines.ora, closing the gaps"""
+    from lib import floodfill
+
+    _flood_fill(m, (1, 0), floodfill.GapClosingOptions(7, False))
+
+
+@benchmark()
+def flood_fill_grow(m):
+    """Fill a large closed outline, growing the fill by 40px"""
+    _flood_fill(m, (0, 2), None, offset=40)
+
+
+@benchmark()
+def flood_fill_shrink(m):
+    """Fill a large closed outline, shrinking the fill by 40px"""
+    _flood_fill(m, (0, 2), None, offset=-40)
+
+
+@benchmark()
+def flood_fill_feather(m):
+    """Fill a large closed outline, feathering the fill by 40px"""
+    _flood_fill(m, (0, 2), None, feather=40)
+
+
+def _fill_alphas(src_path):
+    """Fill a layer of fill_outlines.ora, returning the alpha tiles"""
+    from lib import floodfill
+    from lib import mypaintlib
+    from lib import fill_common
+
+    doc = _new_doc(painting_only=True)
+    doc.load(join(paths.TESTS_DIR, TEST_FILL_OUTLINES))
+    root = doc.layer_stack
+    layer = root.deepget(src_path)
+    src = layer._surface
+    x, y, w, h = layer.get_bbox()
+    x, y = x + w // 2, y + h // 2
+    bbox = fill_common.TileBoundingBox(root.get_bbox())
+    init = floodfill.starting_coordinates(x, y)
+    r, g, b, a = floodfill.get_target_color(src, *init)
+    filler = mypaintlib.Filler(r, g, b, a, 0.2)
+    seed_lists = floodfill.seeds_by_tile({(x, y)})
+    handler = floodfill.FillHandler()
+    return floodfill.scanline_fill(handler, src, seed_lists, bbox, filler)
+
+
+def _morph_stage(m, offset, chords_only=False):
+    from lib import floodfill
+    from lib import morphology
+
+    tiles = _fill_alphas((0, 2))
+    handler = floodfill.FillHandler()
+    with m.timed():
+        result = morphology.morph(handler, offset, tiles, chords_only=chords_only)
+    m.tiles = len(result)
+
+
+@benchmark()
+def morph_grow(m):
+    """Grow a large fill of fill_outlines.ora by 40px (morph stage only)"""
+    _morph_stage(m, 40)
+
+
+@benchmark()
+def morph_grow_chords(m):
+    """Like morph_grow, but with the chord lookup table only, for comparison"""
+    _morph_stage(m, 40, chords_only=True)
+
+
+@benchmark()
+def morph_shrink(m):
+    """Shrink a large fill of fill_outlines.ora by 40px (morph stage only)"""
+    _morph_stage(m, -40)
+
+
+@benchmark()
+def morph_shrink_chords(m):
+    """Like morph_shrink, but with the chord lookup table only, for comparison"""
+    _morph_stage(m, -40, chords_only=True)
+
+
+def _blur_stage(m, radius, exact):
+    from lib import floodfill
+    from lib import morphology
+
+    tiles = _fill_alphas((0, 2))
+    handler = floodfill.FillHandler()
+    with m.timed():
+        result = morphology.blur(handler, radius, tiles, exact=exact)
+    m.tiles = len(result)
+
+
+@benchmark()
+def blur_feather(m):
+    """Feather a large fill of fill_outlines.ora by 40px (blur stage only)"""
+    _blur_stage(m, 40, exact=False)
+
+
+@benchmark()
+def blur_feather_exact(m):
+    """Like blur_feather, but with the exact gaussian, for comparison"""
+    _blur_stage(m, 40, exact=True)
+
+
+@benchmark()
+def merge_visible(m):
+    """Merge the visible layers of bigimage.ora"""
+    doc = _new_doc(painting_only=True)
+    doc.load(join(paths.TESTS_DIR, TEST_BIGIMAGE))
+    with m.timed():
+        doc.merge_visible_layers()
+    m.count_doc_tiles(doc)
+
+
+def _render_mipmap(m, mipmap_level):
+    from lib import pixbufsurface
+
+    doc = _new_doc(painting_only=True)
+    doc.load(join(paths.TESTS_DIR, TEST_BIGIMAGE))
+    root = doc.layer_stack
+    x, y, w, h = root.get_bbox()
+    scale = 2 ** mipmap_level
+    x //= scale
+    y //= scale
+    w = max(1, w // scale)
+    h = max(1, h // scale)
+    surface = pixbufsurface.Surface(x, y, w, h)
+    tiles = list(surface.get_tiles())
+    root._render_cache_clear()
+    with m.timed():
+        root.render(surface, tiles, mipmap_level)
+    m.count_doc_tiles(doc)
+
+
+def _register_render_benchmarks():
+    from lib import tiledsurface
+
+    for level in range(tiledsurface.MAX_MIPMAP_LEVEL + 1):
+
+        def _bench(m, level=level):
+            _render_mipmap(m, level)
+
+        _bench.__doc__ = (
+            "Render all of bigimage.ora at mipmap level %d" % (level,)
+        )
+        benchmark("render_mipmap_%d" % (level,))(_bench)
+
+
+_register_render_benchmarks()
+
+
+# Running:
+
+
+def run_single(name):
+    """Run one benchmark in this process, and print its results"""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        m = Measurement(tmpdir)
+        ALL_BENCHMARKS[name](m)
+        print(json.dumps(m.as_dict()))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def run_in_child(name):
+    """Run one benchmark in a child process
+
+    :returns: The run's results, or None if it failed.
+    :rtype: dict
+
+    """
+    args = [sys.executable, "-m", "tests.benchmark", SINGLE_RUN_ARG, name]
+    child = subprocess.Popen(
+        args,
+        cwd=paths.TOP_DIR,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    output, _junk = child.communicate()
+    if child.returncode != 0:
+        return None
+    lines = output.strip().splitlines()
+    try:
+        return json.loads(lines[-1])
+    except (IndexError, ValueError):
+        return None
+
+
+def get_commit_id():
+    """The current git commit of the source tree, or None"""
+    try:
+        output = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=paths.TOP_DIR,
+            universal_newlines=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.strip()
+
+
+def summarize(runs):
+    """Combine the results of several runs of a benchmark"""
+    if not runs:
+        return {"failed": True, "runs": []}
+    times = sorted(r["wall_time"] for r in runs)
+    rss = [r["peak_rss"] for r in runs if r["peak_rss"] is not None]
+    return {
+        "failed": False,
+        "runs": runs,
+        "wall_time": times[0],
+        "wall_time_median": times[len(times) // 2],
+        "peak_rss": max(rss) if rss else None,
+        "tiles": runs[-1]["tiles"],
+    }
+
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] == SINGLE_RUN_ARG:
+        run_single(sys.argv[2])
+        return 0
+
+    parser = argparse.ArgumentParser(
+        prog="python -m tests.benchmark",
+        description="Run headless benchmarks and write JSON results.",
+    )
+    parser.add_argument("benchmarks", nargs="*", metavar="NAME")
+    parser.add_argument(
+        "-a", "--all", action="store_true", help="run all benchmarks"
+    )
+    parser.add_argument(
+        "-l", "--list", action="store_true", help="list all benchmarks"
+    )
+    parser.add_argument(
+        "-c",
+        "--count",
+        metavar="N",
+        type=int,
+        default=3,
+        help="number of runs of each benchmark (default: 3)",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        metavar="FILE",
+        help="write JSON results to FILE instead of stdout",
+    )
+    options = parser.parse_args()
+
+    if options.list:
+        for name in sorted(ALL_BENCHMARKS):
+            print("%-24s %s" % (name, ALL_BENCHMARKS[name].__doc__))
+        return 0
+
+    names = options.benchmarks
+    if options.all:
+        names = sorted(ALL_BENCHMARKS)
+    if not names:
+        parser.print_help()
+        return 1
+    for name in names:
+        if name not in ALL_BENCHMARKS:
+            parser.error("unknown benchmark: %r" % (name,))
+
+    results = {}
+    for name in names:
+        runs = []
+        for i in range(options.count):
+            print(
+                "running %s (run %d of %d)" % (name, i + 1, options.count),
+                file=sys.stderr,
+            )
+            run = run_in_child(name)
+            if run is None:
+                print("%s FAILED" % (name,), file=sys.stderr)
+                runs = []
+                break
+            runs.append(run)
+        results[name] = summarize(runs)
+
+    report = {
+        "commit": get_commit_id(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.time(),
+        "benchmarks": results,
+    }
+    if options.output:
+        with open(options.output, "w") as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    failed = any(r["failed"] for r in results.values())
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -11,6 +11,8 @@ import contextlib
 import copy
 from itertools import repeat, chain, product
 
+import numpy as np
+
 from . import paths
 from lib import mypaintlib
 from lib import document
@@ -315,6 +317,24 @@ class CorrectnessTests(FillTestsBase):
                     " src='{layer}'".format(layer=src.name),
                 )
 
+    @fill_test
+    def test_threaded_fill_matches_serial(self):
+        old_threads = floodfill.DEFAULT_FILL_THREADS
+        try:
+            for src in self.large + (self.heavy,):
+                with self.fill_layers() as (f1, f2):
+                    floodfill.DEFAULT_FILL_THREADS = 1
+                    self.fill(src, f1, tol=0.3)
+                    floodfill.DEFAULT_FILL_THREADS = 4
+                    self.fill(src, f2, tol=0.3)
+                    self.assertTrue(
+                        self.layers_identical(f1, f2),
+                        msg="Threaded fill should match a serial fill!"
+                        " src={layer}".format(layer=src.name),
+                    )
+        finally:
+            floodfill.DEFAULT_FILL_THREADS = old_threads
+
     @fill_test
     def test_translation_invariant(self):
         offsets = (
@@ -382,6 +402,87 @@ class CorrectnessTests(FillTestsBase):
                         ),
                     )
 
+    def test_fast_blur_matches_exact(self):
+        """The box cascade blur stays close to the exact gaussian"""
+        # Fraction of full alpha the approximation may be off by
+        tolerance = 0.03
+        radii = (1, 10, 24, 40, 64)
+        handler = floodfill.FillHandler()
+        for src in self.small + self.large:
+            x, y = self.center(src.get_bbox())
+            surf = src._surface
+            r, g, b, a = floodfill.get_target_color(
+                surf, *floodfill.starting_coordinates(x, y)
+            )
+            filler = mypaintlib.Filler(r, g, b, a, 0.2)
+            tiles = floodfill.scanline_fill(
+                handler,
+                surf,
+                floodfill.seeds_by_tile({(x, y)}),
+                fill_common.TileBoundingBox(self.root.get_bbox()),
+                filler,
+            )
+            for radius in radii:
+                exact = morphology.blur(handler, radius, dict(tiles), exact=True)
+                fast = morphology.blur(handler, radius, dict(tiles))
+                self.assertEqual(
+                    set(exact),
+                    set(fast),
+                    msg="Blurs should cover the same tiles!"
+                    " src={layer} radius={radius}".format(
+                        layer=src.name, radius=radius
+                    ),
+                )
+                max_diff = 0
+                for coord, exact_tile in exact.items():
+                    diff = np.abs(exact_tile.astype(int) - fast[coord].astype(int))
+                    max_diff = max(max_diff, diff.max())
+                self.assertLessEqual(
+                    max_diff,
+                    tolerance * fill_common._OPAQUE,
+                    msg="Fast blur is too far from the exact blur!"
+                    " src={layer} radius={radius}".format(
+                        layer=src.name, radius=radius
+                    ),
+                )
+
+    def test_distance_morph_matches_chords(self):
+        """Morphs decided by distance are identical to chord-only ones"""
+        offsets = (-64, -24, -8, 8, 24, 64)
+        handler = floodfill.FillHandler()
+        for src, tolerance in product(self.small + self.large, (0, 0.2)):
+            x, y = self.center(src.get_bbox())
+            surf = src._surface
+            r, g, b, a = floodfill.get_target_color(
+                surf, *floodfill.starting_coordinates(x, y)
+            )
+            filler = mypaintlib.Filler(r, g, b, a, tolerance)
+            tiles = floodfill.scanline_fill(
+                handler,
+                surf,
+                floodfill.seeds_by_tile({(x, y)}),
+                fill_common.TileBoundingBox(self.root.get_bbox()),
+                filler,
+            )
+            for offset in offsets:
+                chords = morphology.morph(
+                    handler, offset, dict(tiles), chords_only=True
+                )
+                distance = morphology.morph(handler, offset, dict(tiles))
+                msg = " src={layer} tolerance={tol} offset={offs}".format(
+                    layer=src.name, tol=tolerance, offs=offset
+                )
+                self.assertEqual(
+                    set(chords),
+                    set(distance),
+                    msg="Morphs should cover the same tiles!" + msg,
+                )
+                for coord, chords_tile in chords.items():
+                    self.assertTrue(
+                        np.array_equal(chords_tile, distance[coord]),
+                        msg="Morphed tiles should be identical!" + msg,
+                    )
+
 
 # Performance tests, not run as part of the standard test suite
 
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+# Imports:
+
+import threading
+import unittest
+
+from lib import idletask
+from lib.gibindings import GLib
+
+
+# Test cases:
+
+
+class ThreadedProcessorTests(unittest.TestCase):
+    """Test the threaded task queue used by autosave."""
+
+    def setUp(self):
+        self.done_calls = 0
+        self.errors = []
+        self.processor = idletask.ThreadedProcessor(
+            name="test-idletask",
+            done_cb=self._done_cb,
+            error_cb=self._error_cb,
+        )
+
+    def tearDown(self):
+        self.processor.stop()
+
+    def _done_cb(self):
+        self.done_calls += 1
+
+    def _error_cb(self, exc):
+        self.errors.append(exc)
+
+    def _iterate_main_loop(self):
+        """Run any pending idle callbacks, like the report."""
+        context = GLib.MainContext.default()
+        while context.pending():
+            context.iteration(False)
+
+    def test_tasks_run_to_completion(self):
+        """Tasks are called until they return false, then reported"""
+        calls = []
+
+        def _task(name, n):
+            calls.append(name)
+            return calls.count(name) < n
+
+        self.processor.add_work(_task, "a", 3)
+        self.processor.add_work(_task, "b", 2)
+        self.assertTrue(self.processor.has_work())
+        self.processor.finish_all()
+        self.assertEqual(calls, ["a", "a", "a", "b", "b"])
+        self.assertFalse(self.processor.has_work())
+        self.assertEqual(self.done_calls, 1)
+        self.assertEqual(self.errors, [])
+        self._iterate_main_loop()
+        self.assertEqual(self.done_calls, 1, "Reported twice")
+
+    def test_error_abandons_queue(self):
+        """A failing task abandons the rest, and is reported as an error"""
+        calls = []
+
+        def _failing_task():
+            calls.append("fail")
+            raise IOError("disk full")
+
+        def _task():
+            calls.append("after")
+            return False
+
+        self.processor.add_work(_failing_task)
+        self.processor.add_work(_task)
+        self.processor.finish_all()
+        self.assertEqual(calls, ["fail"])
+        self.assertEqual(len(self.errors), 1)
+        self.assertIsInstance(self.errors[0], IOError)
+        self.assertEqual(self.done_calls, 0)
+        self.assertFalse(self.processor.has_work())
+
+        # The processor is reusable afterwards.
+        self.processor.add_work(_task)
+        self.processor.finish_all()
+        self.assertEqual(calls, ["fail", "after"])
+        self.assertEqual(self.done_calls, 1)
+        self.assertEqual(len(self.errors), 1)
+
+    def test_stop_waits_and_drops_stale_work(self):
+        """Stopping waits for the running call, and nothing is reported"""
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def _blocking_task():
+            calls.append("blocking")
+            started.set()
+            release.wait(5)
+            return True  # would be called again if it weren't stopped
+
+        def _task():
+            calls.append("queued")
+            return False
+
+        self.processor.add_work(_blocking_task)
+        self.processor.add_work(_task)
+        self.assertTrue(started.wait(5), "Worker thread never started")
+        timer = threading.Timer(0.1, release.set)
+        timer.start()
+        self.processor.stop()
+        self.assertTrue(release.is_set(), "stop() didn't wait for the task")
+        timer.join()
+        self.assertFalse(self.processor.has_work())
+        self.assertEqual(len(list(self.processor.iter_work())), 0)
+
+        # The stopped generation's work is never reported.
+        self._iterate_main_loop()
+        self.assertEqual(calls, ["blocking"])
+        self.assertEqual(self.done_calls, 0)
+        self.assertEqual(self.errors, [])
+
+        # New work after a stop is processed and reported normally.
+        self.processor.add_work(_task)
+        self.processor.finish_all()
+        self.assertEqual(calls, ["blocking", "queued"])
+        self.assertEqual(self.done_calls, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -45,6 +45,24 @@ class TileConversions(unittest.TestCase):
         mypaintlib.tile_convert_rgba16_to_rgba8(src, dst, 2.2)
         self.assertTrue((dst[:, :, 3] == 255).all(), msg="Not fully opaque")
 
+    def test_int8_row_batch_matches_single(self):
+        """Row conversion skips empty tiles, and matches per-tile"""
+        row = np.random.randint(0, 256, (N, N * 4, 4)).astype("uint8")
+        row[:, N : 2 * N, 3] = 0
+        row[:, 3 * N :, 3] = 0
+        row[5, 3 * N + 7, 3] = 1
+        cols = mypaintlib.tile_rgba8_row_nonempty(row)
+        self.assertEqual(cols, [0, 2, 3])
+        jobs = [
+            (row[:, i * N : (i + 1) * N, :], np.zeros((N, N, 4), "uint16"))
+            for i in cols
+        ]
+        mypaintlib.tile_convert_rgba8_to_rgba16_batch(jobs, 2.2)
+        for src, dst in jobs:
+            expected = np.zeros((N, N, 4), "uint16")
+            mypaintlib.tile_convert_rgba8_to_rgba16(src, expected, 2.2)
+            self.assertTrue((dst == expected).all())
+
 
 class Painting(unittest.TestCase):
     """Tests basic painting functionality."""
@@ -113,6 +131,85 @@ class Painting(unittest.TestCase):
 
         s.save_as_png("test_brushPaint.png")
 
+    def test_batch_replay_matches_loop(self):
+        """Replaying an event array in one call paints the same pixels"""
+        myb_path = join(paths.TESTS_DIR, "brushes/v2/charcoal.myb")
+        with open(myb_path, "r") as fp:
+            brush_string = fp.read()
+        raw = np.loadtxt(join(paths.TESTS_DIR, "painting30sec.dat"))
+        events = np.zeros((len(raw), 9), "float64")
+        events[1:, 0] = np.diff(raw[:, 0])
+        events[:, 1:3] = raw[:, 1:3] * 4
+        events[:, 3] = raw[:, 3]
+        events[:, 6] = 1.0
+
+        s1 = tiledsurface.Surface()
+        b1 = brush.Brush(brush.BrushInfo(brush_string))
+        s1.begin_atomic()
+        for dtime, x, y, pressure, xt, yt, zoom, rot, barrel in events:
+            b1.stroke_to(s1.backend, x, y, pressure, xt, yt, dtime, zoom, rot, barrel)
+        s1.end_atomic()
+
+        s2 = tiledsurface.Surface()
+        b2 = brush.Brush(brush.BrushInfo(brush_string))
+        s2.begin_atomic()
+        n = b2.stroke_to_events(s2.backend, events)
+        s2.end_atomic()
+
+        self.assertEqual(n, len(events))
+        self.assertEqual(set(s1.get_tiles()), set(s2.get_tiles()))
+        for tx, ty in s1.get_tiles():
+            with s1.tile_request(tx, ty, readonly=True) as t1:
+                with s2.tile_request(tx, ty, readonly=True) as t2:
+                    self.assertTrue((t1 == t2).all())
+
+        # Old strokes decode to read-only arrays over their bytes.
+        readonly = np.frombuffer(events.tobytes(), "float64").reshape((-1, 9))
+        self.assertFalse(readonly.flags.writeable)
+        s3 = tiledsurface.Surface()
+        b3 = brush.Brush(brush.BrushInfo(brush_string))
+        s3.begin_atomic()
+        n = b3.stroke_to_events(s3.backend, readonly)
+        s3.end_atomic()
+        self.assertEqual(n, len(events))
+        self.assertEqual(set(s1.get_tiles()), set(s3.get_tiles()))
+
+        # Unsuitable arrays raise, rather than failing an assertion.
+        with self.assertRaises(ValueError):
+            mypaintlib.PythonBrush.stroke_to_events(b3, s3.backend, events[:, :8], False)
+
+    def test_batch_mipmaps_match_lazy(self):
+        """Regenerating mipmaps in bulk gives the same tiles as lazily"""
+        events = np.loadtxt(join(paths.TESTS_DIR, "painting30sec.dat"))
+        surfs = []
+        for i in range(2):
+            s = tiledsurface.Surface()
+            s.begin_atomic()
+            for t, x, y, pressure in events:
+                s.draw_dab(x * 4, y * 4, 12, 0.2, 0.4, 0.8, pressure, 0.6)
+            s.end_atomic()
+            surfs.append(s)
+        lazy, batched = surfs
+        self.assertFalse(batched.regenerate_mipmaps())
+        for level in range(1, tiledsurface.MAX_MIPMAP_LEVEL + 1):
+            m1 = lazy._mipmaps[level]
+            m2 = batched._mipmaps[level]
+            self.assertFalse(m2._dirty_mipmap_tiles)
+            for tx, ty in set(m1.get_tiles()) | set(m2.get_tiles()):
+                with m1.tile_request(tx, ty, readonly=True) as t1:
+                    with m2.tile_request(tx, ty, readonly=True) as t2:
+                        self.assertTrue((t1 == t2).all())
+
+    def test_mipmaps_redone_after_write_loan(self):
+        """Mipmaps made while a tile is being written aren't kept"""
+        s = tiledsurface.Surface()
+        with s.tile_request(0, 0, readonly=False) as rgba:
+            s.regenerate_mipmaps()
+            rgba[...] = 1 << 15
+        self.assertFalse(s.regenerate_mipmaps())
+        with s.mipmap.tile_request(0, 0, readonly=True) as rgba:
+            self.assertEqual(int(rgba[0, 0, 3]), 1 << 15)
+
 
 class DocPaint(unittest.TestCase):
     """Test document equality after saving and loading."""
@@ -430,6 +527,83 @@ class Frame(unittest.TestCase):
         )
 
 
+class IncrementalSave(unittest.TestCase):
+    """Test re-saving over an earlier OpenRaster save"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls._old_cwd = os.getcwd()
+        cls._temp_dir = tempfile.mkdtemp()
+        os.chdir(cls._temp_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        os.chdir(cls._old_cwd)
+        shutil.rmtree(cls._temp_dir, ignore_errors=True)
+
+    def _load_strokemaps(self, filename):
+        """Load a file's strokemaps as comparable lists, one per layer"""
+        doc = document.Document()
+        try:
+            doc.load(filename)
+            result = []
+            for path, layer in doc.layer_stack.walk():
+                shapes = getattr(layer, "strokes", [])
+                result.append(
+                    [(s.brush_string, sorted(s.footprint)) for s in shapes]
+                )
+            return result
+        finally:
+            doc.cleanup()
+
+    def _assert_resave_matches_fresh_save(self, doc, change):
+        """Changing the doc and re-saving gives the same as a fresh save"""
+        doc.save("test_incremental.ora")
+        change()
+        doc.save("test_incremental.ora")
+        doc.save("test_fresh.ora")
+        resaved = self._load_strokemaps("test_incremental.ora")
+        fresh = self._load_strokemaps("test_fresh.ora")
+        self.assertEqual(resaved, fresh)
+        return resaved
+
+    def test_moved_strokes_are_resaved(self):
+        """Strokes moved without dirtying the layer aren't reused"""
+        doc = document.Document()
+        try:
+            doc.load(join(paths.TESTS_DIR, "smallimage.ora"))
+            layer = doc.layer_stack.deepget([0])
+            before = [sorted(s.footprint) for s in layer.strokes]
+            self.assertTrue(before)
+
+            def _move_strokes():
+                for stroke in layer.strokes:
+                    stroke.translate(N, 0)
+
+            self._assert_resave_matches_fresh_save(doc, _move_strokes)
+            after = [sorted(s.footprint) for s in layer.strokes]
+            self.assertNotEqual(before, after)
+        finally:
+            doc.cleanup()
+
+    def test_merged_strokes_are_resaved(self):
+        """Merging down writes the combined strokemap"""
+        doc = document.Document()
+        try:
+            doc.load(join(paths.TESTS_DIR, "smallimage.ora"))
+            root = doc.layer_stack
+            counts = [len(root.deepget([i]).strokes) for i in (0, 1)]
+            root.current_path = (0,)
+
+            def _merge_down():
+                self.assertTrue(doc.merge_current_layer_down())
+
+            strokemaps = self._assert_resave_matches_fresh_save(doc, _merge_down)
+            self.assertIn(sum(counts), [len(s) for s in strokemaps])
+        finally:
+            doc.cleanup()
+
+
 if __name__ == "__main__":
     unittest.main()
     # Formerly:
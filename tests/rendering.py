@@ -358,5 +358,145 @@ class Scroll(unittest.TestCase):
         print(msg, end=", ", file=sys.stderr)
 
 
+class ParallelRender(unittest.TestCase):
+    """Threaded rendering must match serial rendering exactly."""
+
+    def _render_doc(self, model, render_threads):
+        import lib.pixbufsurface
+        import lib.helpers
+
+        root = model.layer_stack
+        root.render_threads = render_threads
+        root._render_cache_clear()
+        x, y, w, h = root.get_bbox()
+        surf = lib.pixbufsurface.Surface(x, y, w, h)
+        root.render(surf, list(surf.get_tiles()), 0)
+        return lib.helpers.gdkpixbuf2numpy(surf.epixbuf).copy()
+
+    def test_threads_match_serial(self):
+        model = Document(painting_only=True)
+        model.load(join(paths.TESTS_DIR, "smallimage.ora"))
+        try:
+            serial = self._render_doc(model, 1)
+            for n in (2, 4, 7):
+                threaded = self._render_doc(model, n)
+                self.assertTrue(
+                    (serial == threaded).all(),
+                    msg="%d-thread render differs from serial" % (n,),
+                )
+        finally:
+            model.layer_stack.render_threads = 1
+            model.cleanup()
+
+
+class LazyLayerLoading(unittest.TestCase):
+    """Hidden layers load lazily, and render the same once shown."""
+
+    def test_hidden_layers_decode_on_demand(self):
+        import os
+        import tempfile
+        import shutil
+
+        tmpdir = tempfile.mkdtemp()
+        model = Document()
+        try:
+            model.load(join(paths.TESTS_DIR, "smallimage.ora"))
+            root = model.layer_stack
+            layer = root.deepget([0])
+            bbox = tuple(layer.get_bbox())
+            layer.visible = False
+            filename = os.path.join(tmpdir, "hidden.ora")
+            model.save(filename)
+            model.load(filename)
+            root = model.layer_stack
+            layer = root.deepget([0])
+            self.assertTrue(layer.is_lazy)
+            self.assertFalse(layer.is_empty())
+            lazy_x, lazy_y, lazy_w, lazy_h = layer.get_bbox()
+            x, y, w, h = bbox
+            self.assertTrue(lazy_x <= x and lazy_y <= y)
+            self.assertTrue(lazy_x + lazy_w >= x + w)
+            self.assertTrue(lazy_y + lazy_h >= y + h)
+            layer.visible = True
+            layer.get_alpha(x, y, 1)
+            self.assertFalse(layer.is_lazy)
+            self.assertFalse(layer.is_empty())
+        finally:
+            model.cleanup()
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def test_hidden_layer_snapshots_stay_lazy(self):
+        import os
+        import tempfile
+        import shutil
+        import gc
+        from lib.layer.tree import RootLayerStack
+
+        tmpdir = tempfile.mkdtemp()
+        model = Document()
+        try:
+            model.load(join(paths.TESTS_DIR, "smallimage.ora"))
+            model.layer_stack.deepget([0]).visible = False
+            filename = os.path.join(tmpdir, "hidden.ora")
+            model.save(filename)
+            model.load(filename)
+            root = model.layer_stack
+            layer = root.deepget([0])
+            lazy_file = layer._get_lazy_source().filename
+            # Snapshotting and thumbnailing, as autosave does
+            clone = RootLayerStack(doc=None)
+            clone.load_snapshot(root.save_snapshot())
+            clone.render_thumbnail(tuple(root.get_bbox()))
+            self.assertTrue(layer.is_lazy)
+            self.assertTrue(clone.deepget([0]).is_lazy)
+            # The clone keeps the data after the layer is decoded
+            layer.visible = True
+            layer.get_alpha(0, 0, 1)
+            self.assertFalse(layer.is_lazy)
+            self.assertTrue(os.path.exists(lazy_file))
+            del clone
+            gc.collect()
+            self.assertFalse(os.path.exists(lazy_file))
+        finally:
+            model.cleanup()
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def test_undecodable_hidden_layer_is_saved_unchanged(self):
+        import os
+        import tempfile
+        import shutil
+        import zipfile
+        import lib.layer.data
+
+        def _fail(source):
+            raise IOError("simulated decoding failure")
+
+        tmpdir = tempfile.mkdtemp()
+        model = Document()
+        decode = lib.layer.data._decode_lazy_source
+        try:
+            model.load(join(paths.TESTS_DIR, "smallimage.ora"))
+            model.layer_stack.deepget([0]).visible = False
+            filename = os.path.join(tmpdir, "hidden.ora")
+            model.save(filename)
+            model.load(filename)
+            layer = model.layer_stack.deepget([0])
+            with open(layer._get_lazy_source().filename, "rb") as fp:
+                original = fp.read()
+            lib.layer.data._decode_lazy_source = _fail
+            # The failure leaves the layer empty, but keeps its data
+            self.assertTrue(layer._surface.is_empty())
+            self.assertTrue(layer.is_lazy)
+            resaved = os.path.join(tmpdir, "resaved.ora")
+            model.save(resaved)
+            with zipfile.ZipFile(resaved) as z:
+                pngs = [z.read(n) for n in z.namelist() if n.startswith("data/")]
+            self.assertIn(original, pngs)
+        finally:
+            lib.layer.data._decode_lazy_source = decode
+            model.cleanup()
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+
 if __name__ == "__main__":
     unittest.main()